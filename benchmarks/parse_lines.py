@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+""" Compares the speed of splitting twill script lines with the pyparsing
+    grammar (twill.grammar) and with the tokenizer (twill.parse.tokenize_line).
+
+    Usage: python benchmarks/parse_lines.py [repetitions]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# twill puts an old copy of subprocess on sys.path, which breaks
+# multiprocessing unless twillmanager (importing it) comes first
+import twillmanager
+import twill.parse
+
+SCRIPT = r'''
+# log in and check the dashboard
+go http://example.com/login
+code 200
+formvalue 1 username "twill manager"
+fv 1 password 'secret \'quoted\''
+submit
+code 200
+find "Welcome, [a-z]+" # greeting
+notfind 'Error' i
+follow "Dashboard"
+url http://example\.com/dashboard/?
+setlocal count 10
+echo "items: ${count}"
+'''.strip().split('\n')
+
+def measure(parse, lines, repetitions):
+    start = time.time()
+    for n in xrange(repetitions):
+        for line in lines:
+            parse(line)
+    return (time.time() - start) / (repetitions * len(lines))
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    start = time.time()
+    import twill.grammar
+    import_time = time.time() - start
+
+    for line in SCRIPT:
+        assert twill.grammar.parse(line) == twill.parse.tokenize_line(line), line
+
+    old = measure(twill.grammar.parse, SCRIPT, repetitions)
+    new = measure(twill.parse.tokenize_line, SCRIPT, repetitions)
+
+    print "lines parsed:        %d" % (repetitions * len(SCRIPT))
+    print "pyparsing grammar:   %.2f us/line" % (old * 1e6)
+    print "tokenize_line:       %.2f us/line" % (new * 1e6)
+    print "speedup:             %.1fx" % (old / new)
+    print "grammar import time: %.1f ms" % (import_time * 1e3)
+
+if __name__ == '__main__':
+    main()
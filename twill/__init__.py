@@ -25,10 +25,13 @@ __all__ = [ "TwillCommandLoop",
             "execute_file",
             "execute_string",
             "get_browser",
+            "get_context",
+            "TwillContext",
             "add_wsgi_intercept",
             "remove_wsgi_intercept",
             "set_output",
-            "set_errout"]
+            "set_errout",
+            "set_ssl_context_factory"]
 
 #
 # add extensions (twill/extensions) and the the wwwsearch & pyparsing
@@ -54,6 +57,7 @@ from parse import execute_file, execute_string
 
 # convenience function or two...
 from commands import get_browser
+from context import TwillContext, get_context
 
 def get_browser_state():
     import warnings
@@ -72,17 +76,27 @@ def set_output(fp):
     """
     Have standard output from twill go to the given fp instead of
     stdout.  fp=None will reset to stdout.
+
+    Only affects the current context (see context.py).
     """
-    import commands, browser
-    commands.OUT = browser.OUT = fp
+    import context
+    context.set_output(fp)
 
 def set_errout(fp):
     """
     Have error output from twill go to the given fp instead of stderr.
     fp=None will reset to stderr.
+
+    Only affects the current context (see context.py).
+    """
+    import context
+    context.set_errout(fp)
+
+def set_ssl_context_factory(factory):
+    """
+    Set the function (taking no arguments) creating SSL contexts for
+    HTTPS connections.  The contexts are created on first use & shared by
+    all browsers of the process.  factory=None restores the default.
     """
-    import commands
-    if fp:
-        commands.ERR = fp
-    else:
-        commands.ERR = sys.stderr
+    from _mechanize_dist import _http
+    _http.set_ssl_context_factory(factory)
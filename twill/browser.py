@@ -4,10 +4,9 @@ Implements TwillBrowser, a simple stateful wrapper for mechanize.Browser.
 See _browser.py for mechanize code.
 """
 
-OUT=None
-
 # Python imports
 import re
+import time
 
 # wwwsearch imports
 import _mechanize_dist as mechanize
@@ -18,8 +17,15 @@ from _browser import PatchedMechanizeBrowser
 from utils import print_form, ConfigurableParsingFactory, \
      ResultWrapper, unique_match, HistoryStack
 from errors import TwillException
+import context
+
+# output stream of the current context (see context.py)
+OUT=context.ObjectProxy(context.get_output)
      
 
+# phases of page loads timed by TwillBrowser (see TwillBrowser.journeys)
+JOURNEY_PHASES = ('dns', 'connect', 'tls', 'ttfb', 'body', 'parse', 'hooks')
+
 #
 # TwillBrowser
 #
@@ -30,7 +36,11 @@ class TwillBrowser(object):
 
     Public variables:
 
-      * result -- mechanize-style 'result' object.
+      * result -- mechanize-style 'result' object;
+      * journeys -- list of page loads (see _journey), each a dictionary
+        of the action & its result ('action', 'url', 'code'), its start
+        time ('time') & how long it took ('total'), plus the time in
+        seconds spent in each of JOURNEY_PHASES.
     """
     def __init__(self):
         #
@@ -46,8 +56,10 @@ class TwillBrowser(object):
         b = PatchedMechanizeBrowser(history=HistoryStack(), factory=factory)
 
         self._browser = b
+        self._factory = factory
         
         self.result = None
+        self.journeys = []
         self.last_submit_button = None
 
         #
@@ -160,6 +172,41 @@ class TwillBrowser(object):
         """
         return self._browser.title()
 
+    def get_timings(self):
+        """
+        Return a dictionary mapping phases of HTTP requests ('dns',
+        'connect', 'tls', 'ttfb' & 'body') to the total time in seconds
+        spent in them by this browser.
+        """
+        timings = {}
+        for scheme in ('http', 'https'):
+            handler = self._browser._ua_handlers.get(scheme)
+            if handler is None:
+                continue
+            for phase, seconds in getattr(handler, 'timings', {}).items():
+                timings[phase] = timings.get(phase, 0.0) + seconds
+        return timings
+
+    def set_deadline(self, deadline):
+        """
+        Make HTTP requests time out at 'deadline' (as returned by
+        time.time(); None means no deadline).
+        """
+        for scheme in ('http', 'https'):
+            handler = self._browser._ua_handlers.get(scheme)
+            if handler is not None:
+                handler.deadline = deadline
+
+    def abort(self):
+        """
+        Make HTTP requests in progress fail at once (called from another
+        thread).
+        """
+        for scheme in ('http', 'https'):
+            handler = self._browser._ua_handlers.get(scheme)
+            if handler is not None:
+                handler.abort()
+
     def get_url(self):
         """
         Get the URL of the current page.
@@ -518,32 +565,50 @@ There are %d cookie(s) in the cookiejar.
         self.last_submit_button = None
         self.result = None
 
-        func = getattr(self._browser, func_name)
+        # record the timing of this page load.  the page is parsed lazily,
+        # so its 'parse' time keeps growing after the journey.
+        journey = dict.fromkeys(JOURNEY_PHASES, 0.0)
+        journey.update(action=func_name, url=None, code=None, time=time.time())
+        self.journeys.append(journey)
+        timings = self.get_timings()
+        self._factory.timings = journey
+        self.set_deadline(context.get_context().deadline)
+
         try:
-            r = func(*args, **kwargs)
-        except mechanize.HTTPError, e:
-            r = e
-
-        # seek back to 0 if a seek() function is present.
-        seek_fn = getattr(r, 'seek', None)
-        if seek_fn:
-            seek_fn(0)
-
-        # some URLs, like 'file:' URLs, don't have return codes.  In this
-        # case, assume success (code=200) if no such attribute.
-        code = getattr(r, 'code', 200)
-
-        ## special case refresh loops!?
-        if code == 'refresh':
-            raise TwillException("""\
+            func = getattr(self._browser, func_name)
+            try:
+                r = func(*args, **kwargs)
+            except mechanize.HTTPError, e:
+                r = e
+
+            # seek back to 0 if a seek() function is present.
+            seek_fn = getattr(r, 'seek', None)
+            if seek_fn:
+                seek_fn(0)
+
+            # some URLs, like 'file:' URLs, don't have return codes.  In this
+            # case, assume success (code=200) if no such attribute.
+            code = getattr(r, 'code', 200)
+
+            ## special case refresh loops!?
+            if code == 'refresh':
+                raise TwillException("""\
 infinite refresh loop discovered; aborting.
 Try turning off acknowledge_equiv_refresh...""")
 
-        self.result = ResultWrapper(code, r.geturl(), r.read())
+            self.result = ResultWrapper(code, r.geturl(), r.read())
+            journey['url'] = self.result.get_url()
+            journey['code'] = self.result.get_http_code()
 
-        #
-        # Now call all of the post load hooks with the function name.
-        #
-        
-        for callable in self._post_load_hooks:
-            callable(func_name, *args, **kwargs)
+            #
+            # Now call all of the post load hooks with the function name.
+            #
+
+            start = time.time()
+            for callable in self._post_load_hooks:
+                callable(func_name, *args, **kwargs)
+            journey['hooks'] = time.time() - start
+        finally:
+            for phase, seconds in self.get_timings().items():
+                journey[phase] = journey.get(phase, 0.0) + seconds - timings.get(phase, 0.0)
+            journey['total'] = time.time() - journey['time']
@@ -8,8 +8,11 @@ import _mechanize_dist as mechanize
 from _mechanize_dist import ClientForm
 from _mechanize_dist._headersutil import is_html
 
-OUT=None
-ERR=sys.stderr
+import context
+
+# output streams of the current context (see context.py)
+OUT=context.ObjectProxy(context.get_output)
+ERR=context.ObjectProxy(context.get_errout)
 
 # export:
 __all__ = ['get_browser',
@@ -69,15 +72,16 @@ import re, getpass, time
 
 from browser import TwillBrowser
 
-from errors import TwillException, TwillAssertionError
+from errors import TwillException, TwillAssertionError, TwillTimeout
 import utils
 from utils import set_form_control_value, run_tidy
 from namespaces import get_twill_glocals
-        
-browser = TwillBrowser()
+
+# browser of the current context (see context.py)
+browser = context.ObjectProxy(context.get_browser)
 
 def get_browser():
-    return browser
+    return context.get_browser()
 
 def reset_browser():
     """
@@ -85,13 +89,7 @@ def reset_browser():
 
     Reset the browser completely.
     """
-    global browser
-    browser._browser.close()
-    browser = TwillBrowser()
-
-    global _options
-    _options = {}
-    _options.update(_orig_options)
+    context.reset()
 
 ###
 
@@ -319,7 +317,13 @@ def sleep(interval=1):
     Sleep for the specified amount of time.
     If no interval is given, sleep for 1 second.
     """
-    time.sleep(float(interval))
+    interval = float(interval)
+    remaining = context.get_context().remaining()
+    if remaining is not None and remaining < interval:
+        # no point in sleeping past the deadline
+        time.sleep(max(remaining, 0))
+        raise TwillTimeout("script timed out (sleeping for %s seconds)" % interval)
+    time.sleep(interval)
 
 _agent_map = dict(
     ie5='Mozilla/4.0 (compatible; MSIE 5.0; Windows NT 5.1)',
@@ -811,8 +815,8 @@ _orig_options = dict(readonly_controls_writeable=False,
                      acknowledge_equiv_refresh=True
                      )
 
-_options = {}
-_options.update(_orig_options)           # make a copy
+# options of the current context (see context.py)
+_options = context.DictProxy(context.get_options)
 
 def config(key=None, value=None):
     """
@@ -0,0 +1,225 @@
+"""
+Execution contexts of twill scripts.
+
+A TwillContext bundles everything a running script depends on: the
+browser, the configuration options, the global & local namespaces and
+the output streams.  A context can be passed to execute_string,
+execute_file or _execute_script; while the script runs, the context is
+the *current* context of the thread and all of the commands resolve
+against it.  Scripts executed concurrently in separate threads
+with separate contexts therefore do not interfere with each other.
+
+Threads that never activate a context get a default one, sharing the
+global namespace with the whole process, which keeps the old behavior
+of twill-sh & scripts calling twill from a single thread.
+
+The old module globals (twill.commands.browser, twill.commands.OUT,
+twill.commands.ERR, twill.commands._options and twill.browser.OUT) are
+proxies that resolve against the current context, so the extensions
+using them keep working.
+"""
+
+import sys
+import threading
+import time
+
+class TwillContext(object):
+    """
+    State of a running twill script.
+
+    Public variables:
+
+      * global_dict -- global namespace of the script;
+      * local_dict_stack -- stack of local namespaces;
+      * out, err -- output & error streams (None means stdout/stderr);
+      * lineno -- number (counted from 0) of the script line being executed;
+      * deadline -- time (as returned by time.time()) by which the script
+        must finish, or None.  Commands fail with TwillTimeout once it has
+        passed, and socket operations of the browser time out then.
+    """
+    def __init__(self, out=None, err=None, global_dict=None):
+        """
+        Create a new context.  Unless 'global_dict' is given, the global
+        namespace is a copy of the one set up by namespaces.init_global_dict.
+        """
+        if global_dict is None:
+            import namespaces
+            global_dict = dict(namespaces.global_dict)
+
+        self.global_dict = global_dict
+        self.local_dict_stack = []
+        self.out = out
+        self.err = err
+        self.lineno = None
+        self.deadline = None
+        self._browser = None            # created lazily
+        self._options = None            # created lazily
+
+    def get_browser(self):
+        """
+        Return the browser of this context.
+        """
+        if self._browser is None:
+            from browser import TwillBrowser
+            self._browser = TwillBrowser()
+        return self._browser
+
+    def get_options(self):
+        """
+        Return the configuration options dictionary of this context.
+        """
+        if self._options is None:
+            from commands import _orig_options
+            self._options = dict(_orig_options)
+        return self._options
+
+    def reset(self):
+        """
+        Replace the browser & options with fresh ones.
+        """
+        if self._browser is not None:
+            self._browser._browser.close()
+        self._browser = None
+        self._options = None
+
+    close = reset
+
+    def remaining(self):
+        """
+        Return the number of seconds left until the deadline (None if there
+        is no deadline).
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def check_deadline(self):
+        """
+        Raise TwillTimeout if the deadline has passed.
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            from errors import TwillTimeout
+            raise TwillTimeout("script timed out")
+
+    def abort(self):
+        """
+        Stop the script (run by another thread): expire the deadline, so
+        that the script fails before its next command, and make its HTTP
+        requests in progress fail at once.
+        """
+        self.deadline = time.time()
+        browser = self._browser
+        if browser is not None:
+            browser.set_deadline(self.deadline)
+            browser.abort()
+
+    def get_output(self):
+        return self.out or sys.stdout
+
+    def get_errout(self):
+        return self.err or sys.stderr
+
+###
+
+_thread_local = threading.local()
+
+def get_context():
+    """
+    Return the current context of this thread.
+    """
+    try:
+        return _thread_local.context
+    except AttributeError:
+        import namespaces
+        _thread_local.context = TwillContext(global_dict=namespaces.global_dict)
+        return _thread_local.context
+
+def set_context(context):
+    """
+    Make 'context' the current context of this thread.  Returns the
+    previously set context (None if there was none), to be passed back
+    to set_context when done.  set_context(None) restores the default.
+    """
+    previous = getattr(_thread_local, 'context', None)
+    if context is None:
+        if previous is not None:
+            del _thread_local.context
+    else:
+        _thread_local.context = context
+    return previous
+
+### shortcuts for the current context.
+
+def get_browser():
+    """
+    Return the browser of the current context.
+    """
+    return get_context().get_browser()
+
+def get_options():
+    """
+    Return the configuration options dictionary of the current context.
+    """
+    return get_context().get_options()
+
+def reset():
+    """
+    Replace the browser & options of the current context with fresh ones.
+    """
+    get_context().reset()
+
+def get_local_dict_stack():
+    return get_context().local_dict_stack
+
+def set_output(fp):
+    get_context().out = fp
+
+def set_errout(fp):
+    get_context().err = fp
+
+def get_output():
+    return get_context().get_output()
+
+def get_errout():
+    return get_context().get_errout()
+
+###
+
+class ObjectProxy(object):
+    """
+    Forward attribute access to the object returned by 'getter'.
+    """
+    def __init__(self, getter):
+        object.__setattr__(self, '_getter', getter)
+
+    def __getattr__(self, name):
+        return getattr(self._getter(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._getter(), name, value)
+
+    def __repr__(self):
+        return '<proxy for %r>' % (self._getter(),)
+
+class DictProxy(ObjectProxy):
+    """
+    Forward attribute & item access to the dictionary returned by 'getter'.
+    """
+    def __getitem__(self, key):
+        return self._getter()[key]
+
+    def __setitem__(self, key, value):
+        self._getter()[key] = value
+
+    def __delitem__(self, key):
+        del self._getter()[key]
+
+    def __contains__(self, key):
+        return key in self._getter()
+
+    def __iter__(self):
+        return iter(self._getter())
+
+    def __len__(self):
+        return len(self._getter())
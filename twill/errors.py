@@ -15,3 +15,36 @@ class TwillNameError(TwillException):
     Error to raise when an unknown command is called.
     """
     pass
+
+class TwillTimeout(TwillException):
+    """
+    Error to raise when a script runs past the deadline of its context.
+    """
+    pass
+
+class TwillParseError(TwillException):
+    """
+    Error to raise when a line of a script can't be parsed.
+
+    Attributes (named after pyparsing's ParseException, which it replaces):
+    'msg', the input line 'pstr' and the position 'loc' of the error.
+    """
+    def __init__(self, pstr, loc, msg):
+        TwillException.__init__(self, msg)
+        self.pstr = pstr
+        self.loc = loc
+        self.msg = msg
+
+    def _get_lineno(self):
+        return self.pstr.count('\n', 0, self.loc) + 1
+    lineno = property(_get_lineno)
+
+    def _get_column(self):
+        if self.loc < len(self.pstr) and self.pstr[self.loc] == '\n':
+            return 1
+        return self.loc - self.pstr.rfind('\n', 0, self.loc)
+    column = property(_get_column)
+
+    def __str__(self):
+        return "%s (at char %d), (line:%d, col:%d)" % \
+               (self.msg, self.loc, self.lineno, self.column)
@@ -0,0 +1,61 @@
+"""
+The pyparsing grammar of the twill mini-language.
+
+twill no longer parses scripts with it (see parse.tokenize_line, which is
+a lot faster and doesn't need pyparsing); it is kept as the reference
+definition of the syntax, which the tokenizer is tested against.
+"""
+
+from pyparsing import Word, printables, Optional, alphas, alphanums, \
+     ParseException, ZeroOrMore, restOfLine, Combine, Literal, Group, \
+     removeQuotes, CharsNotIn
+
+# basically, a valid Python identifier:
+command = Word(alphas + "_", alphanums + "_")
+command = command.setResultsName('command')
+command.setName("command")
+
+# arguments to it.
+
+# we need to reimplement all this junk from pyparsing because pcre's
+# idea of escapable characters contains a lot more than the C-like
+# thing pyparsing implements
+_bslash = "\\"
+_sglQuote = Literal("'")
+_dblQuote = Literal('"')
+_escapables = printables
+_escapedChar = Word(_bslash, _escapables, exact=2)
+dblQuotedString = Combine( _dblQuote + ZeroOrMore( CharsNotIn('\\"\n\r') | _escapedChar | '""' ) + _dblQuote ).streamline().setName("string enclosed in double quotes")
+sglQuotedString = Combine( _sglQuote + ZeroOrMore( CharsNotIn("\\'\n\r") | _escapedChar | "''" ) + _sglQuote ).streamline().setName("string enclosed in single quotes")
+quotedArg = ( dblQuotedString | sglQuotedString )
+quotedArg.setParseAction(removeQuotes)
+quotedArg.setName("quotedArg")
+
+plainArgChars = printables.replace('#', '').replace('"', '').replace("'", "")
+plainArg = Word(plainArgChars)
+plainArg.setName("plainArg")
+
+arguments = Group(ZeroOrMore(quotedArg | plainArg))
+arguments = arguments.setResultsName('arguments')
+arguments.setName("arguments")
+
+# comment line.
+comment = Literal('#') + restOfLine
+comment = comment.suppress()
+comment.setName('comment')
+
+full_command = (
+    comment
+    | (command + arguments + Optional(comment))
+    )
+full_command.setName('full_command')
+
+def parse(line):
+    """
+    Parse a line with the grammar; returns the same as parse.tokenize_line.
+    Raises pyparsing's ParseException.
+    """
+    res = full_command.parseString(line)
+    if not res:
+        return None                     # e.g. a comment
+    return res.command, res.arguments.asList()
@@ -18,8 +18,8 @@ def init_global_dict():
     import twill.parse
     twill.parse.command_list.extend(command_list)
 
-# local dictionaries.
-_local_dict_stack = []
+# scripts run with their own global & local dictionaries, see context.py.
+import context
 
 ###
 
@@ -30,7 +30,7 @@ def new_local_dict():
     Initialize a new local dictionary & push it onto the stack.
     """
     d = {}
-    _local_dict_stack.append(d)
+    context.get_local_dict_stack().append(d)
 
     return d
 
@@ -38,20 +38,20 @@ def pop_local_dict():
     """
     Get rid of the current local dictionary.
     """
-    _local_dict_stack.pop()
+    context.get_local_dict_stack().pop()
 
 ###
 
 def get_twill_glocals():
     """
-    Return global dict & current local dictionary.
+    Return global dict & current local dictionary of the current context.
     """
-    global global_dict, _local_dict_stack
     assert global_dict is not None, "must initialize global namespace first!"
 
-    if len(_local_dict_stack) == 0:
+    current = context.get_context()
+    if len(current.local_dict_stack) == 0:
         new_local_dict()
 
-    return global_dict, _local_dict_stack[-1]
+    return current.global_dict, current.local_dict_stack[-1]
 
 ###
@@ -13,7 +13,7 @@ COPYING.txt included with the distribution).
 """
 
 import copy, time, tempfile, htmlentitydefs, re, logging, socket, \
-       urllib2, urllib, httplib, sgmllib
+       urllib2, urllib, httplib, sgmllib, threading, errno
 from urllib2 import URLError, HTTPError, BaseHandler
 from cStringIO import StringIO
 
@@ -611,14 +611,172 @@ class HTTPDefaultErrorHandler(BaseHandler):
         raise response
 
 
+def record_timing(timings, phase, start):
+    """Add the time elapsed since start to timings[phase] (unless timings is
+    None)."""
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + (time.time() - start)
+
+
+# requests that may be sent again when the server closed the persistent
+# connection they were sent on (they may have reached the server)
+RETRIED_METHODS = ("GET", "HEAD")
+
+def _connection_was_closed(error):
+    """Whether error (raised sending a request on a persistent connection)
+    means that the server had closed the connection."""
+    if isinstance(error, httplib.BadStatusLine):
+        return True  # nothing was received
+    if isinstance(error, socket.timeout):
+        return False
+    return (isinstance(error, socket.error) and bool(error.args) and
+            error.args[0] in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED))
+
+
+def _connect(conn):
+    """Connect conn (an httplib.HTTPConnection) like its connect method
+    does, recording time of the name lookup ("dns") & of the TCP connect
+    ("connect") in conn.timings."""
+    start = time.time()
+    addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+    record_timing(conn.timings, "dns", start)
+
+    start = time.time()
+    error = socket.error("getaddrinfo returns an empty list")
+    for af, socktype, proto, canonname, sa in addresses:
+        sock = None
+        try:
+            sock = socket.socket(af, socktype, proto)
+            if conn.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(conn.timeout)
+            if conn.source_address:
+                sock.bind(conn.source_address)
+            sock.connect(sa)
+        except socket.error, error:
+            if sock is not None:
+                sock.close()
+        else:
+            record_timing(conn.timings, "connect", start)
+            conn.sock = sock
+            if conn._tunnel_host:
+                conn._tunnel()
+            return
+    raise error
+
+
+class TimedHTTPConnection(httplib.HTTPConnection):
+    """HTTPConnection recording the time of name lookup & TCP connect in its
+    'timings' dictionary (see AbstractHTTPHandler.timings)."""
+
+    timings = None
+
+    def connect(self):
+        _connect(self)
+
+
+class ConnectionPool:
+    """Idle persistent HTTP connections, keyed by host.
+
+    Connections are taken out of the pool for the time of a request and
+    put back once the response has been read.  At most max_per_host idle
+    connections are kept for each key; connections idle for longer than
+    idle_timeout seconds are closed and dropped.
+
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=60, clock=time.time):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._idle = {}  # key -> list of (connection, time it became idle)
+
+    def get(self, key):
+        """Return an idle connection for key, or None."""
+        self.evict_expired()
+        connections = self._idle.get(key)
+        if not connections:
+            return None
+        conn, idle_since = connections.pop()
+        if not connections:
+            del self._idle[key]
+        return conn
+
+    def put(self, key, conn):
+        """Return a connection (with its last response fully read) to the
+        pool."""
+        self.evict_expired()
+        connections = self._idle.setdefault(key, [])
+        if len(connections) >= self.max_per_host:
+            conn.close()
+        else:
+            connections.append((conn, self._clock()))
+
+    def evict_expired(self):
+        oldest = self._clock() - self.idle_timeout
+        for key, connections in self._idle.items():
+            while connections and connections[0][1] < oldest:
+                conn, idle_since = connections.pop(0)
+                conn.close()
+            if not connections:
+                del self._idle[key]
+
+    def close(self):
+        """Close all idle connections."""
+        for connections in self._idle.values():
+            for conn, idle_since in connections:
+                conn.close()
+        self._idle.clear()
+
+    def __len__(self):
+        return sum([len(connections) for connections in self._idle.values()])
+
+
 class AbstractHTTPHandler(BaseHandler):
 
-    def __init__(self, debuglevel=0):
+    def __init__(self, debuglevel=0, connection_pool=None):
         self._debuglevel = debuglevel
+        if connection_pool is None:
+            connection_pool = ConnectionPool()
+        self.connection_pool = connection_pool
+        # phase of requests ("dns", "connect", "tls", "ttfb" -- time to
+        # first byte, "body") -> total time spent in it (seconds); the
+        # connections made by the handler record their phases here, too
+        self.timings = {}
+        # time (as returned by time.time()) by which requests must be
+        # done, or None; socket operations time out when it passes
+        self.deadline = None
+        self._active = set()  # connections of the requests in progress
+
+    def close(self):
+        self.connection_pool.close()
+
+    def abort(self):
+        """Make the requests in progress fail at once, by shutting down the
+        sockets of their connections (called from another thread)."""
+        for h in list(self._active):
+            sock = h.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
 
     def set_http_debuglevel(self, level):
         self._debuglevel = level
 
+    def _apply_deadline(self, h):
+        """Limit the socket operations of connection h to the time left
+        until the deadline (raising socket.timeout if it has passed)."""
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("timed out (deadline passed)")
+        h.timeout = remaining
+        settimeout = getattr(h.sock, 'settimeout', None)
+        if settimeout is not None:
+            settimeout(remaining)
+
     def do_request_(self, request):
         host = request.get_host()
         if not host:
@@ -656,74 +814,183 @@ class AbstractHTTPHandler(BaseHandler):
         if not host:
             raise URLError('no host given')
 
-        h = http_class(host) # will parse host:port
-        h.set_debuglevel(self._debuglevel)
-
         headers = dict(req.headers)
         headers.update(req.unredirected_hdrs)
-        # We want to make an HTTP/1.1 request, but the addinfourl
-        # class isn't prepared to deal with a persistent connection.
-        # It will try to read all remaining data from the socket,
-        # which will block while the server waits for the next request.
-        # So make sure the connection gets closed after the (only)
-        # request.
-        headers["Connection"] = "close"
+        # Connections are persistent (HTTP/1.1) and kept in the pool
+        # between requests.  addinfourl isn't prepared to deal with a
+        # persistent connection (it would try to read all remaining data
+        # from the socket, blocking while the server waits for the next
+        # request), so the response is read to completion here, before
+        # the connection is reused.
         headers = dict(
             [(name.title(), val) for name, val in headers.items()])
-        try:
-            h.request(req.get_method(), req.get_selector(), req.data, headers)
-            r = h.getresponse()
-        except socket.error, err: # XXX what error?
-            raise URLError(err)
-
-        # Pick apart the HTTPResponse object to get the addinfourl
-        # object initialized properly.
 
-        # Wrap the HTTPResponse object in socket's file object adapter
-        # for Windows.  That adapter calls recv(), so delegate recv()
-        # to read().  This weird wrapping allows the returned object to
-        # have readline() and readlines() methods.
-
-        # XXX It might be better to extract the read buffering code
-        # out of socket._fileobject() and into a base class.
-
-        r.recv = r.read
-        fp = socket._fileobject(r)
+        key = (http_class, host)
+        h = self.connection_pool.get(key)
+        used = []  # connections used by the request (see abort)
+        try:
+            if h is not None:
+                used.append(h)
+                self._active.add(h)
+                try:
+                    r = self._send_request(h, req, headers)
+                except (socket.error, httplib.HTTPException), err:
+                    h.close()
+                    # if the server has closed the idle connection, retry on
+                    # a new one -- unless the request isn't safe to repeat
+                    if (req.get_method() not in RETRIED_METHODS or
+                        not _connection_was_closed(err)):
+                        if isinstance(err, socket.error):
+                            raise URLError(err)
+                        raise
+                    h = None
+            if h is None:
+                h = http_class(host) # will parse host:port
+                h.timings = self.timings
+                used.append(h)
+                self._active.add(h)
+                try:
+                    r = self._send_request(h, req, headers)
+                except (socket.error, httplib.HTTPException), err:
+                    h.close()
+                    if isinstance(err, socket.error):
+                        raise URLError(err)
+                    raise
+
+            start = time.time()
+            try:
+                self._apply_deadline(h)
+                data = r.read()
+            except:
+                h.close()
+                raise
+            record_timing(self.timings, "body", start)
+        finally:
+            for conn in used:
+                self._active.discard(conn)
+
+        if r.will_close:
+            h.close()
+        else:
+            self.connection_pool.put(key, h)
 
-        resp = closeable_response(fp, r.msg, req.get_full_url(),
+        resp = closeable_response(StringIO(data), r.msg, req.get_full_url(),
                                   r.status, r.reason)
         return resp
 
+    def _send_request(self, h, req, headers):
+        h.set_debuglevel(self._debuglevel)
+        self._apply_deadline(h)
+        if h.sock is None:
+            h.connect()
+            self._apply_deadline(h)
+        start = time.time()
+        h.request(req.get_method(), req.get_selector(), req.data, headers)
+        r = h.getresponse()
+        record_timing(self.timings, "ttfb", start)
+        return r
+
 
 class HTTPHandler(AbstractHTTPHandler):
     def http_open(self, req):
-        return self.do_open(httplib.HTTPConnection, req)
+        return self.do_open(TimedHTTPConnection, req)
 
     http_request = AbstractHTTPHandler.do_request_
 
 if hasattr(httplib, 'HTTPS'):
 
+    import ssl
+
+    # SSL contexts are expensive to create (loading the CA certificates
+    # takes tens of milliseconds), so they are created once and shared by
+    # all HTTPS connections: one for connections without a client
+    # certificate, and one for each (key_file, cert_file) pair.
+    _ssl_context_factory = None
+    _ssl_contexts = {}
+    _ssl_contexts_lock = threading.Lock()
+
+    def set_ssl_context_factory(factory):
+        """Set the function (taking no arguments) creating SSL contexts of
+        HTTPS connections.  None restores the default, which is the context
+        httplib would create.
+
+        """
+        global _ssl_context_factory
+        _ssl_contexts_lock.acquire()
+        try:
+            _ssl_context_factory = factory
+            _ssl_contexts.clear()
+        finally:
+            _ssl_contexts_lock.release()
+
+    def get_ssl_context(key_file=None, cert_file=None):
+        """Return the shared SSL context for the given client certificate."""
+        key = (key_file, cert_file)
+        context = _ssl_contexts.get(key)
+        if context is None:
+            _ssl_contexts_lock.acquire()
+            try:
+                context = _ssl_contexts.get(key)
+                if context is None:
+                    if _ssl_context_factory is not None:
+                        context = _ssl_context_factory()
+                    else:
+                        context = ssl._create_default_https_context()
+                    if key_file or cert_file:
+                        context.load_cert_chain(cert_file, key_file)
+                    _ssl_contexts[key] = context
+            finally:
+                _ssl_contexts_lock.release()
+        return context
+
+    class TimedHTTPSConnection(httplib.HTTPSConnection):
+        """HTTPSConnection recording the time of name lookup, TCP connect &
+        TLS handshake in its 'timings' dictionary (see
+        AbstractHTTPHandler.timings)."""
+
+        timings = None
+
+        def connect(self):
+            _connect(self)
+
+            if self._tunnel_host:
+                server_hostname = self._tunnel_host
+            else:
+                server_hostname = self.host
+
+            start = time.time()
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=server_hostname)
+            record_timing(self.timings, "tls", start)
+
     class HTTPSConnectionFactory:
         def __init__(self, key_file, cert_file):
             self._key_file = key_file
             self._cert_file = cert_file
         def __call__(self, hostport):
-            return httplib.HTTPSConnection(
-                hostport,
-                key_file=self._key_file, cert_file=self._cert_file)
+            context = get_ssl_context(self._key_file, self._cert_file)
+            return TimedHTTPSConnection(hostport, context=context)
+        # equal factories make connections for the same pool
+        def __eq__(self, other):
+            return (isinstance(other, HTTPSConnectionFactory) and
+                    (self._key_file, self._cert_file) ==
+                    (other._key_file, other._cert_file))
+        def __ne__(self, other):
+            return not self == other
+        def __hash__(self):
+            return hash((self._key_file, self._cert_file))
 
     class HTTPSHandler(AbstractHTTPHandler):
-        def __init__(self, client_cert_manager=None):
-            AbstractHTTPHandler.__init__(self)
+        def __init__(self, client_cert_manager=None, connection_pool=None):
+            AbstractHTTPHandler.__init__(self, connection_pool=connection_pool)
             self.client_cert_manager = client_cert_manager
 
         def https_open(self, req):
+            key_file = cert_file = None
             if self.client_cert_manager is not None:
                 key_file, cert_file = self.client_cert_manager.find_key_cert(
                     req.get_full_url())
-                conn_factory = HTTPSConnectionFactory(key_file, cert_file)
-            else:
-                conn_factory = httplib.HTTPSConnection
+            conn_factory = HTTPSConnectionFactory(key_file, cert_file)
             return self.do_open(conn_factory, req)
 
         https_request = AbstractHTTPHandler.do_request_
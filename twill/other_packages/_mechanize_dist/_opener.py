@@ -285,6 +285,10 @@ class OpenerDirector(urllib2.OpenerDirector):
     def close(self):
         urllib2.OpenerDirector.close(self)
 
+        # release resources held by handlers (e.g. pooled HTTP connections)
+        for handler in self.handlers:
+            handler.close()
+
         # make it very obvious this object is no longer supposed to be used
         self.open = self.error = self.retrieve = self.add_handler = None
 
@@ -2,59 +2,91 @@
 Code parsing and evaluation for the twill mini-language.
 """
 
+import string
 import sys
+import threading
 from cStringIO import StringIO
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
-from errors import TwillAssertionError, TwillNameError
-from pyparsing import OneOrMore, Word, printables, quotedString, Optional, \
-     alphas, alphanums, ParseException, ZeroOrMore, restOfLine, Combine, \
-     Literal, Group, removeQuotes, CharsNotIn
+from errors import TwillAssertionError, TwillNameError, TwillParseError, \
+     TwillTimeout
 
 import twill.commands as commands
+import twill.context
 import namespaces
 import re
 
-### pyparsing stuff
-
-# basically, a valid Python identifier:
-command = Word(alphas + "_", alphanums + "_")
-command = command.setResultsName('command')
-command.setName("command")
-
-# arguments to it.
-
-# we need to reimplement all this junk from pyparsing because pcre's
-# idea of escapable characters contains a lot more than the C-like
-# thing pyparsing implements
-_bslash = "\\"
-_sglQuote = Literal("'")
-_dblQuote = Literal('"')
-_escapables = printables
-_escapedChar = Word(_bslash, _escapables, exact=2)
-dblQuotedString = Combine( _dblQuote + ZeroOrMore( CharsNotIn('\\"\n\r') | _escapedChar | '""' ) + _dblQuote ).streamline().setName("string enclosed in double quotes")
-sglQuotedString = Combine( _sglQuote + ZeroOrMore( CharsNotIn("\\'\n\r") | _escapedChar | "''" ) + _sglQuote ).streamline().setName("string enclosed in single quotes")
-quotedArg = ( dblQuotedString | sglQuotedString )
-quotedArg.setParseAction(removeQuotes)
-quotedArg.setName("quotedArg")
-
-plainArgChars = printables.replace('#', '').replace('"', '').replace("'", "")
-plainArg = Word(plainArgChars)
-plainArg.setName("plainArg")
-
-arguments = Group(ZeroOrMore(quotedArg | plainArg))
-arguments = arguments.setResultsName('arguments')
-arguments.setName("arguments")
-
-# comment line.
-comment = Literal('#') + restOfLine
-comment = comment.suppress()
-comment.setName('comment')
-
-full_command = (
-    comment
-    | (command + arguments + Optional(comment))
-    )
-full_command.setName('full_command')
+### tokenizer
+
+# Lines are split into a command & arguments by a hand-written tokenizer,
+# equivalent to the pyparsing grammar in grammar.py (& tested against it):
+#
+#  * the command is a valid Python identifier;
+#  * arguments are runs of printable characters other than # " ', or
+#    strings enclosed in double or single quotes.  Within quotes, a
+#    backslash escapes the next printable char & a doubled quote stands
+#    for itself.  Quotes are removed, escapes are left untouched;
+#  * a '#' outside of quotes starts a comment;
+#  * anything else ends the line.
+
+ParseException = TwillParseError        # the name it had with pyparsing
+
+_printables = ''.join([ c for c in string.printable
+                        if c not in string.whitespace ])
+plainArgChars = _printables.replace('#', '').replace('"', '').replace("'", "")
+
+_whitespace = ' \n\t\r'                 # skipped between tokens
+_command_re = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+# the quote closing an argument can't be followed by another one: that
+# would make a doubled quote.
+_argument_re = re.compile(r"""[ \n\t\r]*(?:
+        "((?:[^\\"\n\r]|\\[%(esc)s]|"")*)"(?!")
+      | '((?:[^\\'\n\r]|\\[%(esc)s]|'')*)'(?!')
+      | ([%(plain)s]+)
+    )""" % dict(esc=re.escape(_printables), plain=re.escape(plainArgChars)),
+                          re.VERBOSE)
+
+def tokenize_line(line):
+    """
+    Split a line into a command & a list of its (raw) arguments.  Returns
+    None for comments; raises TwillParseError if the line doesn't start
+    with a command.
+    """
+    if '\t' in line:
+        line = line.expandtabs()
+
+    pos = 0
+    end = len(line)
+    while pos < end and line[pos] in _whitespace:
+        pos += 1
+
+    if line.startswith('#', pos):
+        return None                     # comment
+
+    m = _command_re.match(line, pos)
+    if m is None:
+        raise TwillParseError(line, pos, 'Expected "#"')
+
+    cmd = m.group()
+    args = []
+    match = _argument_re.match
+    m = match(line, m.end())
+    while m is not None:
+        dbl, sgl, plain = m.groups()
+        if dbl is not None:
+            args.append(dbl)
+        elif sgl is not None:
+            args.append(sgl)
+        else:
+            args.append(plain)
+        m = match(line, m.end())
+
+    # the rest of the line (a comment or junk) is ignored.
+    return cmd, args
 
 ###
 
@@ -64,7 +96,7 @@ command_list = []           # filled in by namespaces.init_global_dict().
 
 def process_args(args, globals_dict, locals_dict):
     """
-    Take a list of string arguments parsed via pyparsing and evaluate
+    Take a list of string arguments split by tokenize_line and evaluate
     the special variables ('__*').
 
     Return a new list.
@@ -131,6 +163,32 @@ def execute_command(cmd, args, globals_dict, locals_dict, cmdinfo):
 
     return result
 
+def execute_parsed_command(parsed, args, globals_dict, locals_dict):
+    """
+    Execute a ParsedCommand with the given (substituted) arguments.
+
+    Same as execute_command, but calls the function resolved when the
+    command was parsed instead of compiling & evaluating a call.
+    """
+    cmd = parsed.cmd
+    locals_dict['__cmd__'] = cmd
+    locals_dict['__args__'] = args
+
+    func = parsed.func
+    if func is None or cmd in locals_dict:
+        # not a built-in command (e.g. loaded by 'extend_with' later on)
+        # or shadowed by a local variable; look it up as eval would.
+        if cmd not in command_list:
+            raise TwillNameError("unknown twill command: '%s'" % (cmd,))
+        func = locals_dict.get(cmd, globals_dict.get(cmd))
+
+    result = func(*args)
+
+    # set __url__
+    locals_dict['__url__'] = commands.browser.get_url()
+
+    return result
+
 ###
 
 _print_commands = False
@@ -139,21 +197,111 @@ def parse_command(line, globals_dict, locals_dict):
     """
     Parse command.
     """
-    res = full_command.parseString(line)
+    res = tokenize_line(line)
     if res:
         if _print_commands:
             print>>commands.OUT, "twill: executing cmd '%s'" % (line.strip(),)
             
-        args = process_args(res.arguments.asList(), globals_dict, locals_dict)
-        return (res.command, args)
+        cmd, args = res
+        args = process_args(args, globals_dict, locals_dict)
+        return (cmd, args)
 
     return None, None                   # e.g. a comment
 
 ###
 
+class ParsedCommand(object):
+    """
+    A line of a script, parsed once so that it can be executed many times:
+    the command name, its raw arguments (variables are substituted on
+    each execution) and the function implementing the command.
+
+    If the line can't be parsed, 'error' holds the exception, which is
+    raised when the line is executed.
+    """
+    __slots__ = ('lineno', 'line', 'cmd', 'args', 'func', 'error')
+
+    def __init__(self, lineno, line, cmd=None, args=(), func=None, error=None):
+        self.lineno = lineno
+        self.line = line
+        self.cmd = cmd
+        self.args = args
+        self.func = func
+        self.error = error
+
+def parse_line(lineno, line):
+    """
+    Parse a single line of a script into a ParsedCommand.  Returns None
+    for empty lines & comments.
+    """
+    if not line.strip():                # skip empty lines
+        return None
+
+    try:
+        res = tokenize_line(line)
+    except TwillParseError, e:
+        return ParsedCommand(lineno, line, error=e)
+
+    if res is None:
+        return None                     # e.g. a comment
+
+    cmd, args = res
+    func = None
+    if cmd in command_list:
+        func = namespaces.global_dict.get(cmd)
+
+    return ParsedCommand(lineno, line, cmd, args, func)
+
+def compile_script(inp):
+    """
+    Parse lines taken from a file-like iterator into a list of
+    ParsedCommands, to be executed with execute_compiled.
+    """
+    compiled = []
+    for n, line in enumerate(inp):
+        parsed = parse_line(n, line)
+        if parsed is not None:
+            compiled.append(parsed)
+    return compiled
+
+_compiled_cache = {}
+_compiled_cache_keys = []
+_compiled_cache_lock = threading.Lock()
+compiled_cache_size = 1000
+
+def compile_string(buf):
+    """
+    Compile the lines of a string buffer.  The result is cached by the hash
+    of the buffer (see 'compiled_cache_size'), so compiling the same script
+    over and over again is cheap.
+    """
+    if isinstance(buf, unicode):
+        key = md5(buf.encode('utf-8')).digest()
+    else:
+        key = md5(buf).digest()
+
+    compiled = _compiled_cache.get(key)
+    if compiled is None:
+        compiled = compile_script(buf.split('\n'))
+
+        _compiled_cache_lock.acquire()
+        try:
+            if key not in _compiled_cache:
+                _compiled_cache[key] = compiled
+                _compiled_cache_keys.append(key)
+                while len(_compiled_cache_keys) > compiled_cache_size:
+                    del _compiled_cache[_compiled_cache_keys.pop(0)]
+        finally:
+            _compiled_cache_lock.release()
+
+    return compiled
+
+###
+
 def execute_string(buf, **kw):
     """
-    Execute commands from a string buffer.
+    Execute commands from a string buffer.  Pass a TwillContext as
+    'context' to run them in that context.
     """
     fp = StringIO(buf)
     
@@ -165,7 +313,8 @@ def execute_string(buf, **kw):
 
 def execute_file(filename, **kw):
     """
-    Execute commands from a file.
+    Execute commands from a file.  Pass a TwillContext as 'context' to
+    run them in that context.
     """
     # read the input lines
     if filename == "-":
@@ -176,11 +325,37 @@ def execute_file(filename, **kw):
     kw['source'] = filename
 
     _execute_script(inp, **kw)
+
+def execute_compiled(compiled, **kw):
+    """
+    Execute a script compiled by compile_script/compile_string.  Accepts
+    the same keyword arguments as _execute_script.
+    """
+    _execute_parsed(compiled, **kw)
     
 def _execute_script(inp, **kw):
     """
     Execute lines taken from a file-like iterator.
+
+    If a TwillContext is given as 'context', the script is executed in
+    that context instead of the current one.
     """
+    # lines are parsed one by one, as they are read
+    parsed = ( parse_line(n, line) for n, line in enumerate(inp) )
+    _execute_parsed(parsed, **kw)
+
+def _execute_parsed(parsed, **kw):
+    context = kw.get('context')
+    if context is None:
+        return _execute_parsed_in_context(parsed, **kw)
+
+    previous = twill.context.set_context(context)
+    try:
+        return _execute_parsed_in_context(parsed, **kw)
+    finally:
+        twill.context.set_context(previous)
+
+def _execute_parsed_in_context(parsed_commands, **kw):
     # initialize new local dictionary & get global + current local
     namespaces.new_local_dict()
     globals_dict, locals_dict = namespaces.get_twill_glocals()
@@ -204,21 +379,29 @@ def _execute_script(inp, **kw):
 
     # sourceinfo stuff
     sourceinfo = kw.get('source', "<input>")
+
+    context = twill.context.get_context()
     
     try:
 
-        for n, line in enumerate(inp):
-            if not line.strip():            # skip empty lines
+        for parsed in parsed_commands:
+            if parsed is None:              # empty line or comment
                 continue
 
-            cmdinfo = "%s:%d" % (sourceinfo, n,)
+            n, line = parsed.lineno, parsed.line
+            context.lineno = n
+            context.check_deadline()
 
-            cmd, args = parse_command(line, globals_dict, locals_dict)
-            if cmd is None:
-                continue
+            if parsed.error is not None:
+                raise parsed.error
+
+            if _print_commands:
+                print>>commands.OUT, "twill: executing cmd '%s'" % (line.strip(),)
+
+            args = process_args(parsed.args, globals_dict, locals_dict)
 
             try:
-                execute_command(cmd, args, globals_dict, locals_dict, cmdinfo)
+                execute_parsed_command(parsed, args, globals_dict, locals_dict)
             except SystemExit:
                 # abort script execution, if a SystemExit is raised.
                 return
@@ -242,7 +425,8 @@ Error message: '%s'
 
 ''' % (n, sourceinfo, line.strip(),str(e).strip(),)
 
-                if not catch_errors:
+                # a timed out script can't go on, even if errors are caught
+                if not catch_errors or isinstance(e, TwillTimeout):
                     raise
 
     finally:
@@ -8,12 +8,12 @@ code is implemented in the ConfigurableParsingFactory class.
 from cStringIO import StringIO
 import os
 import base64
+import time
 
 import subprocess
 
 import _mechanize_dist as mechanize
 from _mechanize_dist import ClientForm
-from _mechanize_dist._util import time
 from _mechanize_dist._http import HTTPRefreshProcessor
 from _mechanize_dist import BrowserStateError
 
@@ -290,6 +290,23 @@ def run_tidy(html):
 
     return (clean_html, errors)
 
+def _timed_parsing(method):
+    """
+    Decorate a ConfigurableParsingFactory method, adding the time it takes
+    to the factory's 'timings' (as 'parse').
+    """
+    def timed(self, *args):
+        start = time.time()
+        try:
+            return method(self, *args)
+        finally:
+            if self.timings is not None:
+                elapsed = time.time() - start
+                self.timings['parse'] = self.timings.get('parse', 0.0) + elapsed
+    timed.__name__ = method.__name__
+    timed.__doc__ = method.__doc__
+    return timed
+
 class ConfigurableParsingFactory(mechanize.Factory):
     """
     A factory that listens to twill config options regarding parsing.
@@ -297,7 +314,10 @@ class ConfigurableParsingFactory(mechanize.Factory):
     First: clean up passed-in HTML using tidy?
     Second: parse using the regular parser, or BeautifulSoup?
     Third: should we fail on, or ignore, parse errors?
+
+    Time spent parsing is added to the 'timings' dictionary, if set.
     """
+    timings = None
     
     def __init__(self):
         self.basic_factory = mechanize.DefaultFactory()
@@ -309,6 +329,7 @@ class ConfigurableParsingFactory(mechanize.Factory):
         self.basic_factory.set_request_class(request_class)
         self.soup_factory.set_request_class(request_class)
 
+    @_timed_parsing
     def set_response(self, response):
         if not response:
             self.factory = None
@@ -324,16 +345,20 @@ class ConfigurableParsingFactory(mechanize.Factory):
         cleaned_response = self._cleanup_html(response)
         self.factory.set_response(cleaned_response)
 
+    @_timed_parsing
     def links(self):
         return self.factory.links()
     
+    @_timed_parsing
     def forms(self):
         return self.factory.forms()
 
+    @_timed_parsing
     def get_global_form(self):
         return self.factory.global_form
     global_form = property(get_global_form)
 
+    @_timed_parsing
     def _get_title(self):
         return self.factory.title
     title = property(_get_title)
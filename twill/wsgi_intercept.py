@@ -7,11 +7,13 @@ Use 'add_wsgi_intercept' and 'remove_wsgi_intercept' to control this behavior.
 """
 
 import sys
-from httplib import HTTPConnection
 import urllib
 from cStringIO import StringIO
 import traceback
 
+# records the timing of (not intercepted) connections, see _mechanize_dist
+from _mechanize_dist._http import TimedHTTPConnection
+
 debuglevel = 0
 # 1 basic
 # 2 verbose
@@ -302,7 +304,7 @@ class wsgi_fake_socket:
 # WSGI_HTTPConnection
 #
 
-class WSGI_HTTPConnection(HTTPConnection):
+class WSGI_HTTPConnection(TimedHTTPConnection):
     """
     Intercept all traffic to certain hosts & redirect into a WSGI
     application object.
@@ -338,7 +340,7 @@ class WSGI_HTTPConnection(HTTPConnection):
                 self.sock = wsgi_fake_socket(app, self.host, self.port,
                                              script_name)
             else:
-                HTTPConnection.connect(self)
+                TimedHTTPConnection.connect(self)
                 
         except Exception, e:
             if debuglevel:              # intercept & print out tracebacks
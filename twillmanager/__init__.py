@@ -7,26 +7,39 @@ import sys
 from optparse import OptionParser
 
 import cherrypy
+try:
+    from cherrypy.lib.reprconf import as_dict
+except ImportError: # CherryPy 3.1
+    from cherrypy._cpconfig import as_dict
 
 import twillmanager.web
+from twillmanager.db import create_db_connection, create_tables
 from twillmanager.osutil import daemonize
+from twillmanager.transfer import import_watches, FIELDS, FORMATS
+from twillmanager.watch import Watch
 
 __all__ = ['start']
 
 def start():
     """ Starts the application """
 
-    p = OptionParser(usage='Usage: %prog [options] config_file')
+    p = OptionParser(usage='Usage: %prog [options] config_file [import|export file]')
     p.add_option('-d', '--daemonize', action='store_true', dest='daemonize',
                  help='Start twillmanager in daemon mode')
+    p.add_option('-f', '--format', dest='format', choices=FORMATS.keys(),
+                 help='Format of imported/exported watch definitions: json or csv '
+                      '(by default depending on the file name)')
     opts, args = p.parse_args()
 
 
-    if len(args) != 1:
+    if len(args) not in (1, 3) or (len(args) == 3 and args[1] not in ('import', 'export')):
         print p.get_usage()
         sys.exit(1)
     config_file = args[0]
 
+    if len(args) == 3:
+        sys.exit(transfer(config_file, args[1], args[2], opts.format))
+
     static_directory = os.path.normpath(os.path.join(os.path.dirname(__file__), 'static'))
     local_config = {'/static': {'tools.staticdir.on': True,
             'tools.staticdir.dir': static_directory}}
@@ -52,3 +65,40 @@ def start():
     cherrypy.engine.start()
     cherrypy.engine.block()
     app.finish()
+
+def transfer(config_file, command, filename, format=None):
+    """ Imports or exports definitions of watches (see `twillmanager.transfer`)
+        to/from given file ("-" for standard input/output). Returns exit status.
+
+        Watches imported while twillmanager is running are scheduled when it's restarted.
+    """
+    config = as_dict(config_file)['twillmanager']
+    if not format:
+        format = filename.lower().endswith('.csv') and 'csv' or 'json'
+    exporter, reader, content_type = FORMATS[format]
+    connection = create_db_connection(config)
+    create_tables(connection)
+
+    try:
+        if command == 'export':
+            file = filename == '-' and sys.stdout or open(filename, 'wb')
+            for chunk in exporter(Watch.iterate_all(connection, FIELDS)):
+                file.write(chunk)
+            if file is not sys.stdout:
+                file.close()
+            return 0
+
+        file = filename == '-' and sys.stdin or open(filename, 'rb')
+        try:
+            created, updated, errors = import_watches(connection, reader(file))
+        except ValueError, e:
+            print >> sys.stderr, e
+            return 1
+        for number, error in errors:
+            print >> sys.stderr, (u"Watch %d: %s" % (number, error)).encode('utf-8')
+        if errors:
+            return 1
+        print >> sys.stderr, "Created %d watches, updated %d watches" % (len(created), len(updated))
+        return 0
+    finally:
+        connection.close()
@@ -4,16 +4,28 @@
 
 from __future__ import absolute_import
 
+import errno
+import os
 from Queue import Empty
 from multiprocessing import Process, Queue
+import signal
 
 __all__ = ['Worker', 'WorkerProxy']
 
 class WorkerProxy(object):
     """ Proxy for controlling worker from another process """
-    def __init__(self):
-        self.queue = Queue(0)
+    def __init__(self, queue=None):
+        """ Create a proxy
+
+            :param queue: Command queue of the worker. Several workers may share
+                one queue - each command is then executed by one of them.
+                If not given, a new queue is created.
+        """
+        if queue is None:
+            queue = Queue(0)
+        self.queue = queue
         self.process = None
+        self.sentinel = None # read end of a pipe whose write end is held by the process
 
     def is_alive(self):
         """ Whether the worker process is alive """
@@ -22,6 +34,24 @@ class WorkerProxy(object):
     def already_started(self):
         return self.process
 
+    def join(self, timeout=None):
+        """ Waits (up to `timeout` seconds) for the worker process to exit """
+        if self.process is not None:
+            self.process.join(timeout)
+
+    def terminate(self):
+        """ Asks the worker process to exit at once (SIGTERM) """
+        if self.is_alive():
+            self.process.terminate()
+
+    def kill(self):
+        """ Kills the worker process (SIGKILL) """
+        if self.is_alive():
+            try:
+                os.kill(self.process.pid, signal.SIGKILL)
+            except OSError: # exited in the meantime
+                pass
+
     def queue_command(self, name, *arguments):
         """ Queue a command to be executed by the worker
             
@@ -39,9 +69,28 @@ class WorkerProxy(object):
 
         worker = self.make_worker(self.queue)
 
+        # the process inherits the write end of the pipe, which is closed
+        # (and the read end becomes readable) only when it exits
+        self.sentinel, write = os.pipe()
         self.process = Process(target=worker.main)
         self.process.daemon = daemon
-        self.process.start()
+        try:
+            self.process.start()
+        finally:
+            os.close(write)
+
+    def wait(self):
+        """ Waits until the worker process exits (however it happens), without polling """
+        try:
+            while True:
+                try:
+                    if not os.read(self.sentinel, 1):
+                        break
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+        finally:
+            os.close(self.sentinel)
 
     def make_worker(self, queue):
         """ Construct instance of the `Worker` to be used by the worker process
@@ -76,12 +125,18 @@ class Worker(object):
             self.running = True
             while self.running:
                 try:
-                    self.execute_command(self.queue.get(True, self.tick_interval))
+                    self.execute_command(self.next_command())
                 except Empty:
                     self.tick()
         finally:
             self.running = False
 
+    def next_command(self):
+        """ Waits for the next command queued by `queue_command`.
+            Raises `Empty` if there is none within ``tick_interval`` seconds.
+        """
+        return self.queue.get(True, self.tick_interval)
+
     def tick(self):
         """ Executed by the event loop every ``tick_interval`` seconds.
 
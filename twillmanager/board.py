@@ -0,0 +1,201 @@
+# encoding: utf-8
+
+""" Shared-memory status board of the workers.
+
+    The board has a fixed-size entry (a "lane") for each script a worker may run
+    at once - ``workers.concurrency`` lanes per pool slot. A worker writes the
+    state of its runs (which watch is running since when, how the last run
+    ended) into its lanes, and the manager process reads them, with no pickling,
+    queues or feeder threads involved.
+
+    Each lane has a single writer at a time and is protected by a sequence lock:
+    the writer makes the sequence number odd while it changes the lane, readers
+    copy the lane and retry if the number was odd or changed meanwhile. Writers
+    and readers never wait for each other. (That relies on the stores of a
+    process becoming visible to others in order, as they do on x86.)
+
+    Lanes also count e-mail notifications sent by the workers and how long
+    sending them took, in a histogram (exported by `twillmanager.metrics`).
+
+    The manager may ask the writer of a lane to cancel the run in progress there
+    (see `StatusBoard.cancel`) - that's kept apart from the lanes, so they keep
+    a single writer.
+
+    After each change the writer rings a "doorbell" - writes a byte into a pipe
+    the manager may wait on (see `StatusBoard.wait`).
+
+    The board must be created before the worker processes (and the template
+    process they are forked from) are started, so that they inherit it.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import ctypes
+import errno
+import fcntl
+import multiprocessing
+import os
+import select
+
+__all__ = ['StatusBoard', 'IDLE', 'RUNNING', 'CLAIMED', 'MAIL_BUCKETS']
+
+# states of a lane
+IDLE = 0
+RUNNING = 1
+CLAIMED = 2 # the watch was taken from the job queue, its run hasn't started yet
+
+# upper bounds (seconds) of the buckets of the histogram of e-mail sending
+# times (there is also an unbounded one)
+MAIL_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+class Lane(ctypes.Structure):
+    """ Entry of the board """
+    _fields_ = [('seq', ctypes.c_ulong), # sequence number, odd while the lane is being written
+                ('state', ctypes.c_int), # IDLE, RUNNING or CLAIMED
+                ('watch_id', ctypes.c_long), # watch being run (or run last)
+                ('started', ctypes.c_double), # time the run was started
+                ('status', ctypes.c_int), # code of the status of the last run (-1: unknown)
+                ('time', ctypes.c_double), # time the last run ended
+                ('duration', ctypes.c_double), # how long (seconds) the last run took
+                ('runs', ctypes.c_ulong), # number of runs finished in the lane
+                ('mails', ctypes.c_ulong), # number of e-mails sent (or attempted)...
+                ('mail_failures', ctypes.c_ulong), # ...those that failed...
+                ('mail_seconds', ctypes.c_double), # ...total time of sending them...
+                ('mail_buckets', ctypes.c_ulong * (len(MAIL_BUCKETS) + 1)), # ...and its histogram
+               ]
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+class StatusBoard(object):
+    """ Shared-memory status board (see the module documentation) """
+    # how many times a reader tries to copy a lane that is being written
+    READ_ATTEMPTS = 1000
+
+    def __init__(self, size):
+        """ :param size: Number of lanes """
+        self.size = size
+        self.lanes = multiprocessing.RawArray(Lane, size)
+        for lane in self.lanes:
+            lane.status = -1
+        # start times of the runs cancelled by the manager, by lane
+        self.cancels = multiprocessing.RawArray(ctypes.c_double, size)
+        self._doorbell, self._bell = os.pipe()
+        _set_nonblocking(self._doorbell)
+        _set_nonblocking(self._bell)
+
+    def claim(self, lane, id):
+        """ Records that watch with given id was taken from the job queue """
+        self._write(lane, state=CLAIMED, watch_id=id)
+
+    def unclaim(self, lane):
+        """ Records that the claimed watch won't be run after all """
+        self._write(lane, state=IDLE)
+
+    def start(self, lane, id, started):
+        """ Records the start of a run of watch with given id """
+        self._write(lane, state=RUNNING, watch_id=id, started=started)
+
+    def finish(self, lane, id, status, time, duration):
+        """ Records the end of a run of watch with given id
+
+            :param status: Code of the status the run ended with (-1: unknown)
+        """
+        entry = self.lanes[lane]
+        self._write(lane, state=IDLE, watch_id=id, status=status, time=time,
+                    duration=duration, runs=entry.runs + 1)
+
+    def cancel(self, lane, started):
+        """ Asks the writer of the lane to cancel the run started at given time """
+        self.cancels[lane] = started
+
+    def is_cancelled(self, lane, started):
+        """ Whether the run started at given time in the lane was cancelled """
+        return self.cancels[lane] == started
+
+    def record_mail(self, lane, seconds, failed=False):
+        """ Counts an e-mail sent (or attempted, if failed) in given time """
+        entry = self.lanes[lane]
+        entry.seq += 1
+        entry.mails += 1
+        entry.mail_failures += failed and 1 or 0
+        entry.mail_seconds += seconds
+        entry.mail_buckets[bisect.bisect_left(MAIL_BUCKETS, seconds)] += 1
+        entry.seq += 1
+        # no need to ring - the manager doesn't wait for these
+
+    def _write(self, lane, **fields):
+        entry = self.lanes[lane]
+        entry.seq += 1
+        for name, value in fields.iteritems():
+            setattr(entry, name, value)
+        entry.seq += 1
+        self.ring()
+
+    def read(self, lane):
+        """ Returns a consistent copy of the lane (a `Lane`), or None if the lane
+            kept changing (or its writer died while writing it, see `reset`)
+        """
+        entry = self.lanes[lane]
+        copy = Lane()
+        for attempt in xrange(self.READ_ATTEMPTS):
+            seq = entry.seq
+            if seq % 2:
+                continue # being written
+            ctypes.memmove(ctypes.addressof(copy), ctypes.addressof(entry), ctypes.sizeof(Lane))
+            if entry.seq == seq == copy.seq:
+                return copy
+        return None
+
+    def snapshot(self):
+        """ Returns copies of all the lanes (None for those that couldn't be read) """
+        return [self.read(lane) for lane in xrange(self.size)]
+
+    def reset(self, lane):
+        """ Marks the lane idle, returning (a copy of) its last state. Called
+            when the process writing the lane has exited - even in the middle
+            of writing it.
+        """
+        entry = self.lanes[lane]
+        copy = Lane.from_buffer_copy(entry)
+        entry.seq += entry.seq % 2
+        self._write(lane, state=IDLE)
+        return copy
+
+    def ring(self):
+        """ Wakes up the process waiting for changes of the board (if there is one) """
+        if self._bell is None:
+            return # closed
+        try:
+            os.write(self._bell, 'x')
+        except OSError, e:
+            # the pipe is full - the bell rings already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        """ Waits (up to `timeout` seconds) until the board changes or `ring` is called.
+            Returns whether it happened. Only one thread may wait at a time.
+        """
+        try:
+            readable = select.select([self._doorbell], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if not readable:
+            return False
+        try:
+            while os.read(self._doorbell, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def close(self):
+        """ Closes the doorbell (`ring` does nothing then) """
+        bell, self._bell = self._bell, None
+        os.close(self._doorbell)
+        os.close(bell)
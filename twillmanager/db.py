@@ -1,28 +1,223 @@
 # encoding: utf-8
 
+""" Database connections.
+
+    Connections are taken from a bounded pool (one per database file and process)
+    and bound to the thread using them until `close_db_connection` returns them.
+    Every connection counts how many times each statement was executed and how
+    long it took (see `QueryStats`).
+"""
+
 from __future__ import absolute_import
+from __future__ import with_statement
 
+import os
 import sqlite3
+import threading
+import time
 from threading import local
 
 _thread_local = local()
 
-__all__ = ['get_db_connection', 'close_db_connection' ,'create_db_connection', 'create_tables']
+__all__ = ['get_db_connection', 'close_db_connection' ,'create_db_connection', 'create_tables', 'enable_wal',
+           'ConnectionPool', 'PoolTimeout', 'QueryStats', 'get_pool', 'query_stats']
+
+class QueryStats(object):
+    """ Number of executions and time spent executing each SQL statement
+        (executing only - fetching rows of a result is not counted)
+    """
+    # statements above that number are counted together
+    MAX_STATEMENTS = 200
+    OTHER = '(other)'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {} # sql -> [count, total time, max time]
+
+    def record(self, sql, seconds):
+        with self._lock:
+            stats = self._stats.get(sql)
+            if stats is None:
+                if len(self._stats) >= self.MAX_STATEMENTS:
+                    sql = self.OTHER
+                stats = self._stats.setdefault(sql, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def dict(self):
+        """ Statistics as a dict: sql -> dict with ``count``, ``total`` and ``max`` time (seconds) """
+        with self._lock:
+            return dict((sql, {'count': count, 'total': total, 'max': max_time})
+                        for sql, (count, total, max_time) in self._stats.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+# statistics of all the connections of this process
+query_stats = QueryStats()
+
+class TimedCursor(sqlite3.Cursor):
+    """ Cursor recording times of executed statements in `query_stats` """
+    def execute(self, sql, parameters=()):
+        start = time.time()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            query_stats.record(sql, time.time() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.time()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, parameters)
+        finally:
+            query_stats.record(sql, time.time() - start)
+
+class TimedConnection(sqlite3.Connection):
+    """ Connection creating `TimedCursor` cursors (also for `execute` shortcuts) """
+    def cursor(self, factory=TimedCursor):
+        return sqlite3.Connection.cursor(self, factory)
 
 def create_db_connection(config):
-    con = sqlite3.connect(config['sqlite.file'])
+    """ Creates a new connection (not taken from the pool), configured by options:
+
+        * ``sqlite.wal`` - whether to switch the database to write-ahead logging (see `enable_wal`),
+        * ``sqlite.busy_timeout`` - how long (seconds) to wait for a lock held by another connection,
+        * ``sqlite.synchronous`` - value of the ``synchronous`` pragma (``NORMAL`` is safe in WAL mode),
+        * ``sqlite.cached_statements`` - number of prepared statements cached by the connection.
+
+        The connection may be used by another thread than the one that created it
+        (but not by two threads at once).
+    """
+    con = sqlite3.connect(config['sqlite.file'],
+                          timeout=float(config.get('sqlite.busy_timeout', 5)),
+                          cached_statements=int(config.get('sqlite.cached_statements', 100)),
+                          check_same_thread=False,
+                          factory=TimedConnection)
     con.row_factory = sqlite3.Row
+    if config.get('sqlite.wal', True):
+        enable_wal(con)
+    con.execute("PRAGMA synchronous=%s" % config.get('sqlite.synchronous', 'NORMAL'))
     return con
 
+class PoolTimeout(Exception):
+    """ Raised when no connection of a pool became free in time """
+
+class ConnectionPool(object):
+    """ Bounded pool of connections to a database.
+
+        At most ``sqlite.pool_size`` connections are open at once; a thread
+        acquiring a connection when all of them are in use waits for one up to
+        ``sqlite.pool_timeout`` seconds.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.size = int(config.get('sqlite.pool_size', 10))
+        self.timeout = float(config.get('sqlite.pool_timeout', 30))
+        self._condition = threading.Condition(threading.Lock())
+        self._idle = []
+        self.open = 0 # number of connections open (idle or in use)
+        self.waits = 0 # number of times a thread had to wait for a connection
+
+    def acquire(self):
+        """ Returns a connection (waits if all the connections are in use) """
+        with self._condition:
+            deadline = None
+            while not self._idle and self.open >= self.size:
+                if deadline is None:
+                    deadline = time.time() + self.timeout
+                    self.waits += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("No database connection available after %s seconds" % self.timeout)
+                self._condition.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self.open += 1
+
+        try:
+            return create_db_connection(self.config)
+        except:
+            with self._condition:
+                self.open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection):
+        """ Returns the connection to the pool (rolling back its uncommitted changes) """
+        try:
+            connection.rollback()
+        except sqlite3.Error:
+            with self._condition:
+                self.open -= 1
+                self._condition.notify()
+            connection.close()
+            return
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def close(self):
+        """ Closes the idle connections """
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self.open -= len(idle)
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        with self._condition:
+            return {'size': self.size,
+                    'open': self.open,
+                    'idle': len(self._idle),
+                    'waits': self.waits}
+
+_pools = {} # database file -> pool
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+def get_pool(config):
+    """ Returns the connection pool of this process for the database of given configuration """
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # connections must not be shared with the parent process
+            _pools = {}
+            _pools_pid = os.getpid()
+        pool = _pools.get(config['sqlite.file'])
+        if pool is None:
+            pool = _pools[config['sqlite.file']] = ConnectionPool(config)
+        return pool
+
 def get_db_connection(config):
+    """ Returns connection of current thread, acquiring one from the pool if needed """
     if not hasattr(_thread_local, 'connection'):
-        _thread_local.connection = create_db_connection(config)
+        pool = get_pool(config)
+        _thread_local.connection = pool.acquire()
+        _thread_local.pool = pool
+        _thread_local.pid = os.getpid()
     return _thread_local.connection
 
 def close_db_connection():
+    """ Returns connection of current thread to the pool (a connection inherited
+        from the parent process is closed)
+    """
     if hasattr(_thread_local, 'connection'):
-        _thread_local.connection.close()
+        if _thread_local.pid == os.getpid():
+            _thread_local.pool.release(_thread_local.connection)
+        else:
+            _thread_local.connection.close()
         del _thread_local.connection
+        del _thread_local.pool
+        del _thread_local.pid
+
+def enable_wal(connection):
+    """ Switches the database to write-ahead logging, so that readers don't block
+        the writer (and vice versa). The mode is persistent. Returns the journal mode
+        actually used (in-memory databases can't use WAL).
+    """
+    return connection.execute("PRAGMA journal_mode=WAL").fetchone()[0]
 
 def create_tables(connection):
     c = connection.cursor()
@@ -38,5 +233,50 @@ def create_tables(connection):
             status VARCHAR(100) NOT NULL,
             time INTEGER,
             reminder_interval INTEGER,
-            last_alert INTEGER)""")
+            last_alert INTEGER,
+            duration REAL,
+            status_since REAL)""")
+    add_missing_columns(connection)
+    # used to list watches; name is indexed by its UNIQUE constraint
+    c.execute("CREATE INDEX IF NOT EXISTS twills_status ON twills(status)")
+    c.execute("CREATE INDEX IF NOT EXISTS twills_time ON twills(time)")
+
+    # history of runs, see `twillmanager.history`
+    c.execute("""CREATE TABLE IF NOT EXISTS runs(
+        watch_id INTEGER NOT NULL,
+        started_at REAL NOT NULL,
+        duration REAL,
+        status VARCHAR(100) NOT NULL,
+        failing_line INTEGER,
+        steps TEXT,
+        aggregated INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (watch_id, started_at))""")
+    c.execute("CREATE INDEX IF NOT EXISTS runs_aggregated ON runs(aggregated)")
+    c.execute("CREATE INDEX IF NOT EXISTS runs_started_at ON runs(started_at)")
+    c.execute("""CREATE TABLE IF NOT EXISTS run_aggregates(
+        watch_id INTEGER NOT NULL,
+        resolution INTEGER NOT NULL,
+        period_start INTEGER NOT NULL,
+        runs INTEGER NOT NULL,
+        statuses TEXT NOT NULL,
+        duration_sum REAL NOT NULL,
+        duration_max REAL NOT NULL,
+        histogram TEXT NOT NULL,
+        PRIMARY KEY (watch_id, resolution, period_start))""")
     connection.commit()
+
+# Columns added to tables after they were first released, as tuples
+# (table, column, definition). Databases created before are upgraded by `create_tables`.
+ADDED_COLUMNS = [
+    ('twills', 'duration', 'REAL'),
+    ('twills', 'status_since', 'REAL'),
+    ('twills', 'timeout', 'REAL'),
+]
+
+def add_missing_columns(connection):
+    c = connection.cursor()
+    for table, column, definition in ADDED_COLUMNS:
+        existing = [row[1] for row in c.execute("PRAGMA table_info(%s)" % table)]
+        if column not in existing:
+            c.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, definition))
+    c.close()
@@ -0,0 +1,74 @@
+# encoding: utf-8
+
+""" Engine letting a single worker process run several twill scripts at once.
+
+    Each script runs in its own twill context (see `twill.context`),
+    so scripts of different watches can share a process. Most of the time
+    a script waits on a socket (releasing the interpreter lock), so a handful
+    of processes may serve hundreds of watches.
+"""
+
+from __future__ import absolute_import
+
+import Queue
+import threading
+
+from twillmanager.log import logger
+
+__all__ = ['ThreadEngine', 'create_engine']
+
+class ThreadEngine(object):
+    """ Runs calls in a fixed number of threads """
+    def __init__(self, concurrency):
+        """ :param concurrency: Maximum number of calls running at once """
+        self.concurrency = concurrency
+        self._slots = threading.Semaphore(concurrency)
+        self._calls = Queue.Queue(0)
+        for n in xrange(concurrency):
+            thread = threading.Thread(target=self._thread_main)
+            thread.daemon = True
+            thread.start()
+
+    def spawn(self, func, *args):
+        """ Run ``func(*args)`` in the background.
+
+            Blocks while ``concurrency`` calls are already running,
+            so that the worker doesn't take jobs it can't start yet.
+        """
+        self._slots.acquire()
+        self._calls.put((func, args))
+
+    def join(self):
+        """ Wait for all the running calls to finish """
+        for n in xrange(self.concurrency):
+            self._slots.acquire()
+        for n in xrange(self.concurrency):
+            self._slots.release()
+
+    def _thread_main(self):
+        while True:
+            func, args = self._calls.get()
+            try:
+                func(*args)
+            except Exception, e:
+                logger.error("Call %s%r failed with exception: %s" % (func.__name__, args, e))
+            finally:
+                self._slots.release()
+
+def create_engine(config):
+    """ Create the engine configured by ``workers.engine`` (only ``threads``)
+        and ``workers.concurrency`` options.
+
+        Returns None if scripts should be run one by one, in the worker main thread.
+    """
+    concurrency = int(config.get('workers.concurrency', 1))
+    engine = config.get('workers.engine', 'threads')
+
+    if engine == 'gevent':
+        logger.warn("The gevent engine is not supported, using threads to run scripts")
+    elif engine != 'threads':
+        raise RuntimeError("Invalid worker engine: %s" % engine)
+
+    if concurrency > 1:
+        return ThreadEngine(concurrency)
+    return None
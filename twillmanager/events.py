@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+""" Fan-out of events about watches (runs starting and ending, status changes)
+    to subscribers, like clients of the ``/events`` stream of the dashboard.
+
+    Every subscriber has a bounded buffer of events. A subscriber that doesn't
+    keep up (whose buffer is full) is dropped, so a slow client never delays
+    the publisher or other subscribers.
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import collections
+import simplejson
+import threading
+
+__all__ = ['EventHub', 'Subscription', 'format_event']
+
+class Subscription(object):
+    """ Events published to a single subscriber of an `EventHub` """
+    def __init__(self, hub, buffer_size):
+        self.hub = hub
+        self.buffer_size = buffer_size
+        self._condition = threading.Condition(threading.Lock())
+        self._events = collections.deque()
+        self.dropped = False # the subscriber didn't keep up
+        self.closed = False
+
+    def put(self, event):
+        """ Adds the event to the buffer. Returns False (and drops the subscriber)
+            if the buffer is full.
+        """
+        with self._condition:
+            if self.closed:
+                return False
+            if len(self._events) >= self.buffer_size:
+                self.dropped = self.closed = True
+                self._events.clear()
+                self._condition.notifyAll()
+                return False
+            self._events.append(event)
+            self._condition.notifyAll()
+            return True
+
+    def get(self, timeout):
+        """ Returns the next event, waiting up to `timeout` seconds.
+            Returns None if there is none, or the subscription is closed.
+        """
+        with self._condition:
+            if not self._events and not self.closed:
+                self._condition.wait(timeout)
+            if self._events:
+                return self._events.popleft()
+            return None
+
+    def close(self):
+        """ Unsubscribes (wakes up a thread waiting in `get`) """
+        with self._condition:
+            self.closed = True
+            self._condition.notifyAll()
+        self.hub.unsubscribe(self)
+
+class EventHub(object):
+    """ Publishes events to all the current subscribers.
+
+        Events are tuples (id, type, data); ids are consecutive numbers.
+    """
+    def __init__(self, buffer_size=100, max_subscribers=100):
+        """ :param buffer_size: Number of events buffered for each subscriber
+            :param max_subscribers: Maximum number of subscribers at once
+        """
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self.last_id = 0
+        self.dropped = 0 # number of subscribers dropped so far
+
+    def __len__(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def subscribe(self):
+        """ Returns a new `Subscription` (None if there are too many subscribers) """
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscription = Subscription(self, self.buffer_size)
+            self._subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, type, data):
+        """ Sends an event to all the subscribers
+
+            :param type: Type of the event (string)
+            :param data: Data of the event (JSON-serializable)
+        """
+        with self._lock:
+            self.last_id += 1
+            event = (self.last_id, type, data)
+            for subscription in list(self._subscribers):
+                if not subscription.put(event):
+                    self._subscribers.discard(subscription)
+                    if subscription.dropped:
+                        self.dropped += 1
+
+    def close(self):
+        """ Closes all the subscriptions """
+        with self._lock:
+            subscriptions = list(self._subscribers)
+        for subscription in subscriptions:
+            subscription.close()
+
+def format_event(event):
+    """ Formats an event for a ``text/event-stream`` response (Server-Sent Events) """
+    id, type, data = event
+    return "id: %d\nevent: %s\ndata: %s\n\n" % (id, type, simplejson.dumps(data))
@@ -0,0 +1,231 @@
+# encoding: utf-8
+
+""" History of watch runs.
+
+    Every run of a watch is stored in the ``runs`` table. Raw runs are
+    periodically rolled up (see `rollup`) into per-minute and per-hour aggregates
+    (``run_aggregates`` table), each of them keeping a histogram of run durations.
+    Statistics over long periods - like the 95th percentile of the duration
+    of a watch over a week - are computed from a few hundred aggregates
+    instead of thousands of raw runs (see `summarize`).
+
+    Raw runs and aggregates are kept only for a limited time (see `rollup`).
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import simplejson
+import time
+
+__all__ = ['MINUTE', 'HOUR', 'DAY', 'BUCKETS', 'Run', 'Aggregate',
+           'rollup', 'load_aggregates', 'summarize']
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# Upper bounds (in seconds) of buckets of the duration histograms.
+# The last bucket (over 300 seconds) is unbounded.
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300]
+
+class Run(object):
+    """ A single run of a watch """
+
+    # Rows in database table
+    COLUMNS = ['watch_id', 'started_at', 'duration', 'status', 'failing_line', 'steps']
+
+    def __init__(self, watch_id, started_at, duration, status, failing_line=None, steps=None):
+        """ Create a new `Run`
+
+            :param watch_id: Id of the watch
+            :param started_at: Start time of the run (as number of seconds since epoch)
+            :param duration: How long (seconds) the run took
+            :param status: Resulting status of the watch
+            :param failing_line: Number (counted from 1) of the script line that failed, if any
+            :param steps: List of dicts describing pages loaded by the script, with time
+                spent loading them (see `twill.browser.TwillBrowser.journeys`)
+        """
+        self.watch_id = watch_id
+        self.started_at = started_at
+        self.duration = duration
+        self.status = status
+        self.failing_line = failing_line
+        self.steps = steps or []
+
+    @classmethod
+    def insert_many(cls, runs, connection):
+        """ Inserts runs into the database (doesn't commit).
+
+            Runs already stored (e.g. by a batch written again after an error) are
+            skipped, so that runs already counted by `rollup` aren't counted again.
+        """
+        c = connection.cursor()
+        c.executemany("INSERT OR IGNORE INTO runs (watch_id, started_at, duration, status, failing_line, steps) VALUES (?,?,?,?,?,?)",
+            [(r.watch_id, r.started_at, r.duration, r.status, r.failing_line, simplejson.dumps(r.steps)) for r in runs])
+        c.close()
+
+    @classmethod
+    def load_recent(cls, watch_id, connection, limit=100):
+        """ Loads most recent runs of the watch (that weren't removed by `rollup` yet) """
+        runs = []
+        c = connection.cursor()
+        c.execute("SELECT watch_id, started_at, duration, status, failing_line, steps FROM runs "
+                  "WHERE watch_id = ? ORDER BY started_at DESC LIMIT ?", (watch_id, limit))
+        for row in c:
+            runs.append(cls(row['watch_id'], row['started_at'], row['duration'], row['status'],
+                            row['failing_line'], simplejson.loads(row['steps'] or '[]')))
+        c.close()
+        return runs
+
+class Aggregate(object):
+    """ Statistics of watch runs in a period of time """
+    def __init__(self, runs=0, statuses=None, duration_sum=0.0, duration_max=0.0, histogram=None):
+        """ Create a new `Aggregate`
+
+            :param runs: Number of runs
+            :param statuses: Dict mapping statuses to number of runs that ended with them
+            :param duration_sum: Total duration of the runs
+            :param duration_max: Duration of the longest run
+            :param histogram: Number of runs in each of the `BUCKETS` (list)
+        """
+        self.runs = runs
+        self.statuses = statuses or {}
+        self.duration_sum = duration_sum
+        self.duration_max = duration_max
+        self.histogram = histogram or [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration, status):
+        """ Counts a single run """
+        self.runs += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.duration_sum += duration
+        self.duration_max = max(self.duration_max, duration)
+        self.histogram[bisect.bisect_left(BUCKETS, duration)] += 1
+
+    def merge(self, other):
+        """ Adds runs counted by another aggregate """
+        self.runs += other.runs
+        for status, count in other.statuses.iteritems():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.duration_sum += other.duration_sum
+        self.duration_max = max(self.duration_max, other.duration_max)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def mean(self):
+        """ Mean duration of the runs (None if there were none) """
+        if not self.runs:
+            return None
+        return self.duration_sum / self.runs
+
+    def percentile(self, fraction):
+        """ Estimates percentile of the durations from the histogram, interpolating
+            linearly within buckets. Returns None if there were no runs.
+
+            :param fraction: The percentile as a fraction, e.g. 0.95 for 95th percentile
+        """
+        if not self.runs:
+            return None
+        rank = fraction * self.runs
+        seen = 0
+        for n, count in enumerate(self.histogram):
+            if count and seen + count >= rank:
+                lower = n and BUCKETS[n - 1] or 0.0
+                if n < len(BUCKETS):
+                    upper = min(BUCKETS[n], self.duration_max)
+                else:
+                    upper = self.duration_max
+                return lower + (upper - lower) * max(rank - seen, 0) / count
+            seen += count
+        return self.duration_max
+
+    def dict(self):
+        """ Summary of the runs as dictionary """
+        return {'runs': self.runs,
+                'statuses': self.statuses,
+                'mean': self.mean(),
+                'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95),
+                'max': self.runs and self.duration_max or None}
+
+    @classmethod
+    def construct_from_row(cls, row):
+        return cls(row['runs'], simplejson.loads(row['statuses']), row['duration_sum'],
+                   row['duration_max'], simplejson.loads(row['histogram']))
+
+def load_aggregates(connection, watch_id, resolution, since, until=None):
+    """ Loads aggregates of the watch with given resolution (`MINUTE` or `HOUR`)
+        covering given period. Returns a list of tuples (period start, `Aggregate`).
+
+        The aggregates are complete only up to the last `rollup`.
+    """
+    if until is None:
+        until = time.time()
+    since = int(since // resolution * resolution)
+    result = []
+    c = connection.cursor()
+    c.execute("SELECT period_start, runs, statuses, duration_sum, duration_max, histogram FROM run_aggregates "
+              "WHERE watch_id = ? AND resolution = ? AND period_start >= ? AND period_start < ? ORDER BY period_start",
+              (watch_id, resolution, since, until))
+    for row in c:
+        result.append((row['period_start'], Aggregate.construct_from_row(row)))
+    c.close()
+    return result
+
+def summarize(connection, watch_id, since, until=None, resolution=HOUR):
+    """ Returns an `Aggregate` of all the runs of the watch in given period,
+        e.g. ``summarize(connection, id, time.time() - 7 * DAY).percentile(0.95)``.
+
+        The period is extended to whole minutes or hours (depending on `resolution`).
+    """
+    total = Aggregate()
+    for period_start, aggregate in load_aggregates(connection, watch_id, resolution, since, until):
+        total.merge(aggregate)
+    return total
+
+def rollup(connection, now=None, raw_retention=2 * DAY, minute_retention=14 * DAY, hour_retention=400 * DAY):
+    """ Adds raw runs that weren't aggregated yet to the per-minute and
+        per-hour aggregates and deletes runs and aggregates older than their
+        retention periods (in seconds).
+
+        Meant to be run periodically; each call handles only the runs
+        stored since the previous one, so every run is counted once, no matter
+        how many times (or from how many connections) it is called.
+        Returns the number of runs aggregated.
+    """
+    if now is None:
+        now = time.time()
+
+    c = connection.cursor()
+    # claim the runs first: the update starts a write transaction, so a rollup
+    # running on another connection waits for this one, then finds nothing to do
+    c.execute("UPDATE runs SET aggregated = -1 WHERE aggregated = 0")
+    c.execute("SELECT watch_id, started_at, duration, status FROM runs WHERE aggregated = -1")
+    rows = c.fetchall()
+
+    aggregates = {}
+    for row in rows:
+        for resolution in (MINUTE, HOUR):
+            key = (row['watch_id'], resolution, int(row['started_at'] // resolution * resolution))
+            if key not in aggregates:
+                aggregates[key] = Aggregate()
+            aggregates[key].add(row['duration'], row['status'])
+
+    for key, aggregate in aggregates.iteritems():
+        c.execute("SELECT runs, statuses, duration_sum, duration_max, histogram FROM run_aggregates "
+                  "WHERE watch_id = ? AND resolution = ? AND period_start = ?", key)
+        for row in c.fetchall():
+            aggregate.merge(Aggregate.construct_from_row(row))
+        c.execute("INSERT OR REPLACE INTO run_aggregates (watch_id, resolution, period_start, runs, statuses, duration_sum, duration_max, histogram) "
+                  "VALUES (?,?,?,?,?,?,?,?)",
+                  key + (aggregate.runs, simplejson.dumps(aggregate.statuses), aggregate.duration_sum,
+                         aggregate.duration_max, simplejson.dumps(aggregate.histogram)))
+
+    c.execute("UPDATE runs SET aggregated = 1 WHERE aggregated = -1")
+
+    c.execute("DELETE FROM runs WHERE aggregated = 1 AND started_at < ?", (now - raw_retention,))
+    c.execute("DELETE FROM run_aggregates WHERE resolution = ? AND period_start < ?", (MINUTE, now - minute_retention))
+    c.execute("DELETE FROM run_aggregates WHERE resolution = ? AND period_start < ?", (HOUR, now - hour_retention))
+    c.close()
+    connection.commit()
+    return len(rows)
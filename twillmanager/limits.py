@@ -0,0 +1,172 @@
+# encoding: utf-8
+
+""" Limits of the time and resources taken by twill scripts.
+
+    A script has a deadline: twill checks it before each command (and in the
+    ``sleep`` command), and the browser limits its socket operations to the time
+    left (see `twill.context.TwillContext.deadline`). That covers scripts waiting
+    for a server; a script run by the main thread of a worker is also interrupted
+    by a signal shortly after its deadline, or when it used up its CPU time.
+
+    Signals are handled only by the main thread, so scripts run by the threads
+    of an engine (``workers.concurrency`` > 1) are interrupted after their
+    deadlines by the `Watchdog` thread of the worker instead - as are scripts
+    cancelled by the manager. The CPU time of such scripts isn't limited (it's
+    counted per process).
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import contextlib
+import ctypes
+import resource
+import signal
+import thread
+import threading
+import time
+
+__all__ = ['ScriptTimeout', 'ScriptCancelled', 'script_limits', 'Watchdog',
+           'set_memory_limit']
+
+# how long (seconds) after its deadline a script is interrupted by a signal,
+# if it didn't time out by itself
+SIGNAL_GRACE = 1.0
+
+class ScriptTimeout(Exception):
+    """ Raised in a script interrupted by `script_limits` (or a `Watchdog`) """
+    def __init__(self, message="Script timed out"):
+        Exception.__init__(self, message)
+
+class ScriptCancelled(Exception):
+    """ Raised in a script interrupted by a `Watchdog` """
+
+def _raise_timeout(signum, frame):
+    if signum == signal.SIGXCPU:
+        raise ScriptTimeout("Script exceeded its CPU time limit")
+    raise ScriptTimeout("Script timed out")
+
+def cpu_time():
+    """ CPU time (user and system, in seconds) used by this process so far """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+@contextlib.contextmanager
+def script_limits(timeout=None, cpu_limit=None):
+    """ Interrupts the code run in the block with `ScriptTimeout` if it takes
+        longer than ``timeout`` (plus `SIGNAL_GRACE`) seconds, or more than
+        ``cpu_limit`` seconds of CPU time. Must be used by the main thread
+        (signals are handled only there), and only by one block at a time.
+    """
+    alarm_handler = cpu_handler = cpu_rlimit = None
+    if timeout:
+        alarm_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout + SIGNAL_GRACE)
+    if cpu_limit:
+        cpu_rlimit = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = int(cpu_time() + cpu_limit) + 1
+        if cpu_rlimit[1] != resource.RLIM_INFINITY:
+            soft = min(soft, cpu_rlimit[1])
+        cpu_handler = signal.signal(signal.SIGXCPU, _raise_timeout)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, cpu_rlimit[1]))
+    try:
+        yield
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, alarm_handler)
+        if cpu_limit:
+            resource.setrlimit(resource.RLIMIT_CPU, cpu_rlimit)
+            signal.signal(signal.SIGXCPU, cpu_handler)
+
+def _raise_in_thread(ident, exception):
+    """ Makes the thread with given ident raise the exception (a class) when it
+        runs Python code next. None withdraws an exception not raised yet.
+    """
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(ident),
+                                               exception and ctypes.py_object(exception))
+
+class _GuardedRun(object):
+    def __init__(self, context, cancelled, deadline):
+        self.context = context
+        self.cancelled = cancelled
+        self.deadline = deadline
+        self.interrupted = False
+
+class Watchdog(object):
+    """ Thread interrupting the scripts run by other threads of the process when
+        they are cancelled, or shortly (`SIGNAL_GRACE`) after their deadlines:
+        the twill context of the script is aborted (see
+        `twill.context.TwillContext.abort`), so that the requests it waits for
+        fail, and `ScriptCancelled` or `ScriptTimeout` is raised in its thread.
+        (A thread blocked in other code, like ``time.sleep``, raises it only
+        once that returns.)
+    """
+    # how often (seconds) the scripts are checked
+    INTERVAL = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = {} # thread ident -> _GuardedRun
+        self._stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.main, name="watchdog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stops the thread (guarded scripts aren't interrupted anymore) """
+        self._stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    @contextlib.contextmanager
+    def guard(self, context, cancelled=None, deadline=None):
+        """ Guards the script run by the calling thread in the block, with given
+            twill context: it's interrupted when ``cancelled()`` returns True,
+            or its ``deadline`` (as returned by ``time.time()``) has passed
+        """
+        ident = thread.get_ident()
+        run = _GuardedRun(context, cancelled, deadline)
+        with self._lock:
+            self._runs[ident] = run
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._runs[ident]
+                if run.interrupted:
+                    # the exception may still be pending
+                    _raise_in_thread(ident, None)
+
+    def main(self):
+        while not self._stopped.wait(self.INTERVAL):
+            self.check()
+
+    def check(self):
+        """ Interrupts the guarded scripts that were cancelled or timed out """
+        now = time.time()
+        with self._lock:
+            for ident, run in self._runs.iteritems():
+                if run.interrupted:
+                    continue
+                if run.cancelled and run.cancelled():
+                    exception = ScriptCancelled
+                elif run.deadline is not None and now >= run.deadline + SIGNAL_GRACE:
+                    exception = ScriptTimeout
+                else:
+                    continue
+                run.interrupted = True
+                run.context.abort()
+                _raise_in_thread(ident, exception)
+
+def set_memory_limit(limit):
+    """ Limits the address space of this process to ``limit`` bytes
+        (allocations above it fail with `MemoryError`)
+    """
+    hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
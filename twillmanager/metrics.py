@@ -0,0 +1,213 @@
+# encoding: utf-8
+
+""" Metrics of twillmanager, exported in the Prometheus text format (see `render`).
+
+    The metrics are collected by the manager process from the data it receives
+    anyway, so the workers don't send anything more: runs (their statuses,
+    durations and timings of the pages loaded) are counted as their results
+    arrive to the status writer, starts of the runs (and the scheduler lag) are
+    read from the status board, and so is the utilization of the pool. The only
+    metric kept by the workers - latency of sending e-mail - is counted in their
+    lanes of the board (see `twillmanager.board`).
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import bisect
+import threading
+
+from twill.browser import JOURNEY_PHASES
+
+from twillmanager.board import RUNNING, MAIL_BUCKETS
+
+__all__ = ['Histogram', 'Metrics', 'render', 'CONTENT_TYPE']
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (seconds) of the buckets of the histograms (there is also
+# an unbounded one). Durations of runs are exported for each watch, so their
+# buckets are fewer than those of the history (see `twillmanager.history.BUCKETS`).
+DURATION_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+PHASE_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+LAG_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+COMMIT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]
+
+class Histogram(object):
+    """ Counts of observed values in buckets, with their sum (thread-safe) """
+    def __init__(self, buckets):
+        """ :param buckets: Sorted upper bounds of the buckets """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last bucket is unbounded
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """ Returns a tuple (counts of the buckets, sum of the values) """
+        with self._lock:
+            return list(self.counts), self.sum
+
+class Metrics(object):
+    """ Metrics of the runs, fed by `twillmanager.watch.WorkerSet` """
+    def __init__(self, watches=None):
+        """ :param watches: Container of the ids of the watches whose runs are
+                counted (e.g. the status table); runs of the others - watches
+                deleted while running - are skipped. All are counted if not given.
+        """
+        self._lock = threading.Lock()
+        self.watches = watches
+        self.runs = {} # (watch id, status) -> number of runs
+        self.durations = {} # watch id -> `Histogram` of durations of the runs
+        self.phases = dict((phase, Histogram(PHASE_BUCKETS)) for phase in JOURNEY_PHASES)
+        self.scheduler_lag = Histogram(LAG_BUCKETS)
+
+    def run_ended(self, id, status, duration, steps):
+        """ Counts a run (with given steps - see `twillmanager.history.Run`) """
+        with self._lock:
+            # checked under the lock, so that a watch removed from ``watches``
+            # before its metrics are removed doesn't get new ones
+            if self.watches is not None and id not in self.watches:
+                return
+            self.runs[id, status] = self.runs.get((id, status), 0) + 1
+            histogram = self.durations.get(id)
+            if histogram is None:
+                histogram = self.durations[id] = Histogram(DURATION_BUCKETS)
+        if duration is not None:
+            histogram.observe(duration)
+        for step in steps:
+            for phase in JOURNEY_PHASES:
+                # phases that took no time didn't happen (like connecting,
+                # when the connection was reused)
+                if step.get(phase):
+                    self.phases[phase].observe(step[phase])
+
+    def run_started(self, lag):
+        """ Records the lag of a run - how long after its planned time it started """
+        self.scheduler_lag.observe(max(lag, 0))
+
+    def remove(self, id):
+        """ Forgets the metrics of a (deleted) watch - removed from ``watches`` before """
+        with self._lock:
+            for key in [key for key in self.runs if key[0] == id]:
+                del self.runs[key]
+            self.durations.pop(id, None)
+
+    def snapshot(self):
+        """ Returns a tuple (copy of ``runs``, copy of ``durations``) """
+        with self._lock:
+            return dict(self.runs), dict(self.durations)
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in labels)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+class Exposition(object):
+    """ Lines of metrics in the Prometheus text format """
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, type, help):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, type))
+
+    def sample(self, name, value, labels=()):
+        self.lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+    def histogram(self, name, buckets, counts, total_value, labels=()):
+        """ Samples of a histogram, given counts of its buckets (not cumulative) """
+        total = 0
+        for bound, count in zip(list(buckets) + [float('inf')], counts):
+            total += count
+            self.sample(name + '_bucket', total, list(labels) + [('le', format_value(bound))])
+        self.sample(name + '_sum', total_value, labels)
+        self.sample(name + '_count', total, labels)
+
+    def text(self):
+        return u'\n'.join(self.lines) + u'\n'
+
+def render(worker_set, pool_stats=None):
+    """ Returns the metrics of given `twillmanager.watch.WorkerSet` (and the stats
+        of the database connection pool) in the Prometheus text format
+    """
+    out = Exposition()
+    metrics = worker_set.metrics
+    runs, durations = metrics.snapshot()
+
+    def watch_labels(id):
+        status = worker_set.status_table.get(id)
+        return [('watch_id', id), ('watch', status['name'] if status else '')]
+
+    out.family('twillmanager_runs_total', 'counter', 'Runs of the watches by resulting status')
+    for (id, status), count in sorted(runs.iteritems()):
+        out.sample('twillmanager_runs_total', count, watch_labels(id) + [('status', status)])
+
+    out.family('twillmanager_run_duration_seconds', 'histogram', 'Durations of the runs of the watches')
+    for id, histogram in sorted(durations.iteritems()):
+        counts, seconds = histogram.snapshot()
+        out.histogram('twillmanager_run_duration_seconds', histogram.buckets, counts, seconds, watch_labels(id))
+
+    out.family('twillmanager_http_phase_seconds', 'histogram', 'Time spent in phases of page loads by the scripts')
+    for phase in JOURNEY_PHASES:
+        counts, seconds = metrics.phases[phase].snapshot()
+        out.histogram('twillmanager_http_phase_seconds', PHASE_BUCKETS, counts, seconds, [('phase', phase)])
+
+    out.family('twillmanager_scheduler_lag_seconds', 'histogram', 'Time from the planned start of the runs to their actual start')
+    counts, seconds = metrics.scheduler_lag.snapshot()
+    out.histogram('twillmanager_scheduler_lag_seconds', LAG_BUCKETS, counts, seconds)
+
+    lanes = worker_set.board.snapshot()
+    busy = len([lane for lane in lanes if lane is not None and lane.state == RUNNING])
+    out.family('twillmanager_worker_lanes', 'gauge', 'Scripts the worker pool can run at once')
+    out.sample('twillmanager_worker_lanes', len(lanes))
+    out.family('twillmanager_worker_lanes_busy', 'gauge', 'Scripts being run by the worker pool')
+    out.sample('twillmanager_worker_lanes_busy', busy)
+    out.family('twillmanager_worker_restarts_total', 'counter', 'Workers restarted after they died')
+    out.sample('twillmanager_worker_restarts_total', worker_set.worker_restarts)
+
+    out.family('twillmanager_mail_send_seconds', 'histogram', 'Latency of sending e-mail notifications')
+    counts = [0] * (len(MAIL_BUCKETS) + 1)
+    seconds = 0.0
+    failures = 0
+    for lane in lanes:
+        if lane is None:
+            continue
+        counts = [total + count for total, count in zip(counts, lane.mail_buckets)]
+        seconds += lane.mail_seconds
+        failures += lane.mail_failures
+    out.histogram('twillmanager_mail_send_seconds', MAIL_BUCKETS, counts, seconds)
+    out.family('twillmanager_mail_failures_total', 'counter', 'E-mail notifications that could not be sent')
+    out.sample('twillmanager_mail_failures_total', failures)
+
+    writer = worker_set.writer
+    out.family('twillmanager_db_commit_seconds', 'histogram', 'Latency of transactions storing results of the runs')
+    counts, seconds = writer.commit_latencies.snapshot()
+    out.histogram('twillmanager_db_commit_seconds', COMMIT_BUCKETS, counts, seconds)
+    queue_depth = writer.queue_depth()
+    if queue_depth is not None:
+        out.family('twillmanager_writer_queue_depth', 'gauge', 'Results of runs waiting to be stored')
+        out.sample('twillmanager_writer_queue_depth', queue_depth)
+
+    if pool_stats is not None:
+        out.family('twillmanager_db_connections', 'gauge', 'Database connections of the web server by state')
+        out.sample('twillmanager_db_connections', pool_stats['open'] - pool_stats['idle'], [('state', 'used')])
+        out.sample('twillmanager_db_connections', pool_stats['idle'], [('state', 'idle')])
+        out.family('twillmanager_db_connection_waits_total', 'counter', 'Requests that waited for a database connection')
+        out.sample('twillmanager_db_connection_waits_total', pool_stats['waits'])
+
+    return out.text()
@@ -0,0 +1,143 @@
+# encoding: utf-8
+
+""" This module contains the schedule of watch runs shared by all the workers """
+
+from __future__ import absolute_import
+
+import heapq
+import random
+import time
+
+__all__ = ['Scheduler']
+
+class Scheduler(object):
+    """ Time-ordered schedule of watches.
+
+        Runs are scheduled at a fixed rate: the deadline of the next run is
+        the previous deadline plus the interval of the watch, so the period
+        does not drift by the time it takes to dispatch or execute the script.
+        Runs missed because the schedule fell behind are skipped, not made up.
+
+        Each run may be delayed by a random jitter (a fraction of the interval);
+        the jitter is not accumulated in the deadlines.
+
+        The scheduler keeps a heap of ``(time, id)`` entries, one live entry
+        per watch. Removing or rescheduling a watch does not touch the heap -
+        stale entries are dropped when they reach the top of the heap.
+
+        The scheduler is not synchronized, callers are responsible for locking.
+    """
+
+    # shortest interval accepted - protects from busy looping on zero intervals
+    MIN_INTERVAL = 1
+
+    def __init__(self, clock=time.time, jitter=0.0, random=random.random):
+        """ Create an empty schedule
+
+            :param clock: Zero-argument callable returning current time (in seconds)
+            :param jitter: Maximum random delay of each run, as a fraction of the interval
+            :param random: Zero-argument callable returning a random number in [0, 1)
+        """
+        self.clock = clock
+        self.jitter = jitter
+        self.random = random
+        self.deadlines = {}
+        self.intervals = {}
+        self._run_times = {}
+        self._heap = []
+
+    def __contains__(self, id):
+        return id in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, id, interval, delay=None):
+        """ Schedule watch with given id to be run every `interval` seconds.
+            If the watch is already scheduled, it is rescheduled.
+
+            :param id: Id of the watch
+            :param interval: Interval (in seconds) between runs
+            :param delay: Time (in seconds) until the first run, defaults to `interval`
+        """
+        interval = max(interval, self.MIN_INTERVAL)
+        if delay is None:
+            delay = interval
+        self.intervals[id] = interval
+        self._push(id, self.clock() + delay)
+
+    def add_spread(self, ids_and_intervals):
+        """ Schedule a number of watches, spreading their first runs evenly
+            over their intervals, so that they don't all fire at once.
+
+            :param ids_and_intervals: List of tuples (id, interval)
+        """
+        count = len(ids_and_intervals)
+        for n, (id, interval) in enumerate(ids_and_intervals):
+            self.add(id, interval, max(interval, self.MIN_INTERVAL) * n / float(count))
+
+    def change_interval(self, id, interval):
+        """ Change the interval of a scheduled watch, keeping its place in the schedule:
+            the next run is due `interval` seconds after the previous one was
+            (or at once, if that time has passed). Watches that are not
+            scheduled are added.
+        """
+        if id not in self.deadlines:
+            self.add(id, interval)
+            return
+        interval = max(interval, self.MIN_INTERVAL)
+        if interval == self.intervals[id]:
+            return
+        deadline = max(self.deadlines[id] - self.intervals[id] + interval, self.clock())
+        self.intervals[id] = interval
+        self._push(id, deadline)
+
+    def remove(self, id):
+        """ Remove watch with given id from the schedule.
+
+            It is safe to call this method even if the watch is not scheduled.
+        """
+        self.deadlines.pop(id, None)
+        self.intervals.pop(id, None)
+        self._run_times.pop(id, None)
+
+    def next_deadline(self):
+        """ Time of the earliest scheduled run (None if nothing is scheduled) """
+        self._drop_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self):
+        """ Returns ids of watches whose runs are due, scheduling their next runs """
+        return [id for id, run_time in self.pop_due_times()]
+
+    def pop_due_times(self):
+        """ Like `pop_due`, but returns tuples (id, time the run was planned for) """
+        now = self.clock()
+        due = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            run_time, id = heapq.heappop(self._heap)
+            due.append((id, run_time))
+
+            interval = self.intervals[id]
+            deadline = self.deadlines[id] + interval
+            if deadline <= now:
+                deadline += interval * ((now - deadline) // interval + 1)
+            self._push(id, deadline)
+
+            self._drop_stale()
+        return due
+
+    def _push(self, id, deadline):
+        run_time = deadline
+        if self.jitter:
+            run_time += self.jitter * self.intervals[id] * self.random()
+        self.deadlines[id] = deadline
+        self._run_times[id] = run_time
+        heapq.heappush(self._heap, (run_time, id))
+
+    def _drop_stale(self):
+        while self._heap and self._run_times.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
@@ -0,0 +1,127 @@
+# encoding: utf-8
+
+""" In-memory table of statuses of the watches, kept by the manager process.
+
+    The dashboard polls statuses of all the watches all the time, so they are
+    served from memory, as JSON serialized once per change of the table.
+    Dashboards may also ask only for the statuses changed since the version
+    they already have, waiting for a change if there was none (see `StatusTable.changes`).
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import simplejson
+import threading
+import time
+
+__all__ = ['StatusTable']
+
+_missing = object()
+
+class StatusTable(object):
+    """ Statuses of the watches (dicts like `twillmanager.watch.Watch.dict`,
+        with ``alive`` and ``building`` flags), by watch id.
+
+        Every change increments ``version``. Versions start from the time
+        the table was created (in milliseconds), so they keep growing when
+        the process is restarted. The JSON of the whole table is regenerated
+        when it's requested after a change.
+
+        The table is synchronized, it may be used from many threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._statuses = {}
+        self._versions = {} # id -> version of the last change of the status
+        self._removed = {} # id -> version in which the watch was removed
+        self._json = None
+        self._closed = False
+        self.start_version = self.version = int(time.time() * 1000)
+
+    def __contains__(self, id):
+        with self._lock:
+            return id in self._statuses
+
+    def update(self, id, fields):
+        """ Sets given fields (dict) of the status of the watch (adding the watch if needed).
+            Returns whether the status has changed.
+        """
+        with self._lock:
+            status = self._statuses.get(id)
+            if status is None:
+                status = self._statuses[id] = {'id': id}
+                self._removed.pop(id, None)
+            elif all(status.get(k, _missing) == v for k, v in fields.iteritems()):
+                return False
+            status.update(fields)
+            self._changed(id)
+            return True
+
+    def remove(self, id):
+        """ Removes the watch from the table """
+        with self._lock:
+            if self._statuses.pop(id, None) is not None:
+                del self._versions[id]
+                self._changed(None)
+                self._removed[id] = self.version
+
+    def get(self, id):
+        """ Returns copy of the status of the watch (None if it's not in the table) """
+        with self._lock:
+            status = self._statuses.get(id)
+            return status and dict(status)
+
+    def etag(self):
+        """ Entity tag of the current version of the table """
+        with self._lock:
+            return '"%d"' % self.version
+
+    def json(self):
+        """ Returns a tuple (entity tag, the whole table serialized to JSON) """
+        with self._lock:
+            if self._json is None:
+                self._json = simplejson.dumps(dict((str(id), status) for id, status in self._statuses.iteritems()))
+            return '"%d"' % self.version, self._json
+
+    def changes(self, since, timeout=0):
+        """ Returns statuses changed after version `since`, as a dict with keys:
+
+            * ``version`` - the current version, to be passed as `since` next time,
+            * ``full`` - whether the whole table is returned (when `since` is not
+              a version of this table, e.g. it comes from before a restart),
+            * ``watches`` - dict mapping (string) ids of the watches to their statuses
+              (None for removed watches).
+
+            If there were no changes, waits for one up to `timeout` seconds.
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            full = not (self.start_version <= since <= self.version)
+            while not full and since == self.version and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            if full:
+                watches = dict((str(id), dict(status)) for id, status in self._statuses.iteritems())
+            else:
+                watches = dict((str(id), dict(self._statuses[id]))
+                               for id, version in self._versions.iteritems() if version > since)
+                watches.update((str(id), None) for id, version in self._removed.iteritems() if version > since)
+            return {'version': self.version, 'full': full, 'watches': watches}
+
+    def close(self):
+        """ Wakes up all the threads waiting for changes (and makes them not wait anymore) """
+        with self._lock:
+            self._closed = True
+            self._condition.notifyAll()
+
+    def _changed(self, id):
+        self.version += 1
+        if id is not None:
+            self._versions[id] = self.version
+        self._json = None
+        self._condition.notifyAll()
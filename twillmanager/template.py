@@ -0,0 +1,245 @@
+# encoding: utf-8
+
+""" A template process that worker processes are forked from.
+
+    The template is forked from the manager process early, before any threads
+    (of the web server, the status writer, the manager) are started and before
+    any requests are served. It preloads the twill stack and then only forks
+    workers on request, so starting a worker is cheap, and workers don't
+    inherit the state of the (multi-threaded) manager process, like locks
+    held by its threads.
+
+    The template waits for its workers to exit (selecting on a pipe inherited
+    by each of them) and tells the manager about it.
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import errno
+import multiprocessing
+import os
+import Queue
+import select
+import signal
+import threading
+
+from twillmanager.db import close_db_connection
+from twillmanager.log import logger
+
+__all__ = ['TemplateProcess', 'TemplateChild', 'preload']
+
+# modules imported by the template, so that the workers don't have to
+PRELOADED_MODULES = ['twill', 'twill.browser', 'twill.commands', 'twill.parse',
+                     '_mechanize_dist', '_mechanize_dist.ClientForm', '_mechanize_dist._http',
+                     'email.MIMEText', 'smtplib', 'ssl', 'sqlite3']
+
+def preload():
+    """ Imports the modules used by workers and initializes twill """
+    for name in PRELOADED_MODULES:
+        __import__(name)
+    import twill.namespaces
+    if not twill.namespaces.global_dict:
+        twill.namespaces.init_global_dict()
+
+class TemplateChild(object):
+    """ Worker process forked by the template, with (a part of) the interface
+        of `multiprocessing.Process`
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.exitcode = None
+        self._exited = threading.Event()
+
+    def is_alive(self):
+        return not self._exited.isSet()
+
+    def join(self, timeout=None):
+        self._exited.wait(timeout)
+
+    def wait(self):
+        """ Waits until the process exits """
+        while not self._exited.isSet():
+            # waiting with timeout, so that the thread may be interrupted
+            self._exited.wait(60)
+
+    def terminate(self):
+        if self.is_alive():
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError: # exited in the meantime
+                pass
+
+    def kill(self):
+        if self.is_alive():
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError: # exited in the meantime
+                pass
+
+    def exited(self, exitcode):
+        self.exitcode = exitcode
+        self._exited.set()
+
+class TemplateProcess(object):
+    """ Proxy of the template process (see the module documentation) """
+    # how long (seconds) `fork` waits for the template to start a worker
+    FORK_TIMEOUT = 10
+
+    def __init__(self, make_worker):
+        """ Create the template (call `start` to fork it)
+
+            :param make_worker: Callable taking a pool slot, returning an instance
+                of `twillmanager.async.Worker` to be run by a new process. Called
+                in the template process.
+        """
+        self.make_worker = make_worker
+        self.process = None
+        self.connection = None
+        self._lock = threading.Lock() # one fork request at a time
+        self._started = Queue.Queue(0)
+        self._requests = 0 # number of fork requests sent
+        self._awaited = None # number of the request `fork` waits for...
+        self._reply_lock = threading.Lock() # ...changed under this lock
+        self._children = {} # pid -> `TemplateChild`
+        self._reader = None
+
+    def start(self):
+        """ Forks the template process (should be done before starting any threads) """
+        self.connection, template_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self.main, args=(template_connection,))
+        # not daemonic, since it starts the workers; it exits when its connection is closed
+        self.process.start()
+        template_connection.close()
+
+        self._reader = threading.Thread(target=self.read_messages)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def fork(self, slot):
+        """ Starts a worker for given pool slot. Returns its `TemplateChild`.
+
+            If the template doesn't answer in time, the worker it may start
+            later is killed (see `read_messages`).
+        """
+        with self._lock:
+            self._requests += 1
+            with self._reply_lock:
+                self._awaited = self._requests
+            self.connection.send(('fork', (self._requests, slot)))
+            try:
+                child = self._started.get(True, self.FORK_TIMEOUT)
+            except Queue.Empty:
+                child = None
+            with self._reply_lock:
+                self._awaited = None
+                # a reply put just before the request was given up
+                if child is None and not self._started.empty():
+                    self.kill_late(self._started.get_nowait())
+        if child is None:
+            raise RuntimeError("Template process failed to start a worker (slot: %s)" % slot)
+        return child
+
+    def kill_late(self, child):
+        """ Kills a worker started after its fork request was given up """
+        if child is not None:
+            logger.warn("Template process started a worker (pid: %s) too late, killing it" % child.pid)
+            child.kill()
+
+    def stop(self, timeout=5):
+        """ Stops the template (its workers should be stopped before) """
+        try:
+            self.connection.send(('quit', None))
+        except IOError: # already dead
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+    def read_messages(self):
+        """ Thread main function, receives messages from the template """
+        while True:
+            try:
+                name, argument = self.connection.recv()
+            except (EOFError, IOError):
+                break
+            if name in ('started', 'failed'):
+                request, pid = argument
+                child = None
+                if pid is not None:
+                    child = self._children[pid] = TemplateChild(pid)
+                with self._reply_lock:
+                    if request == self._awaited:
+                        self._started.put(child)
+                    else:
+                        self.kill_late(child)
+            elif name == 'exited':
+                pid, exitcode = argument
+                child = self._children.pop(pid, None)
+                if child is not None:
+                    child.exited(exitcode)
+
+        # the workers of the template are terminated when it exits
+        for pid in self._children.keys():
+            self._children.pop(pid).exited(None)
+
+    def main(self, connection):
+        """ Template process main function """
+        self.connection.close()
+        # to make sure the inherited connection is not used
+        close_db_connection()
+        preload()
+
+        children = {} # sentinel (read end of a pipe held by the worker) -> process
+        while True:
+            try:
+                readable = select.select([connection] + children.keys(), [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for item in readable:
+                if item is not connection:
+                    process = children.pop(item)
+                    process.join()
+                    os.close(item)
+                    connection.send(('exited', (process.pid, process.exitcode)))
+                    continue
+
+                try:
+                    command, argument = connection.recv()
+                except EOFError: # the manager is gone
+                    return
+                if command == 'quit':
+                    return
+                elif command == 'fork':
+                    request, slot = argument
+                    try:
+                        sentinel, write = os.pipe()
+                        process = multiprocessing.Process(target=run_worker,
+                                                          args=(connection, self.make_worker(slot)))
+                        process.daemon = True
+                        try:
+                            process.start()
+                        finally:
+                            os.close(write)
+                    except Exception, e:
+                        logger.error("Failed to start worker (slot: %s): %s" % (slot, e))
+                        connection.send(('failed', (request, None)))
+                    else:
+                        children[sentinel] = process
+                        connection.send(('started', (request, process.pid)))
+                else:
+                    logger.warn("Unknown command to template process: %s" % command)
+
+def run_worker(connection, worker):
+    """ Worker process main function """
+    # the connection is only used by the template
+    connection.close()
+    worker.main()
@@ -1,15 +1,55 @@
 # encoding: utf-8
 
 from __future__ import absolute_import
+from __future__ import with_statement
 
+import BaseHTTPServer
+import errno
+import httplib
 from mock import Mock, patch
 import multiprocessing
+import os
+import Queue
 from nose.tools import *
+import random
+import signal
+import simplejson
+import socket
+import SocketServer
+import sqlite3
+import ssl
+from StringIO import StringIO
+import tempfile
+import threading
+import time
+from urllib2 import URLError
+
+import twill
+import twill.browser
+import twill.commands
+import twill.errors
+import twill.grammar
+import twill.namespaces
+import twill.parse
+from _mechanize_dist import _http
+from _mechanize_dist._http import ConnectionPool
 
 import twillmanager.mail
 from twillmanager.async import Worker, WorkerProxy
-from twillmanager.db import create_tables, create_db_connection
-from twillmanager.watch import Watch
+from twillmanager.board import StatusBoard, IDLE, RUNNING, CLAIMED
+from twillmanager.db import (create_tables, create_db_connection, get_db_connection, close_db_connection,
+    get_pool, PoolTimeout, QueryStats, query_stats)
+from twillmanager.engine import ThreadEngine, create_engine
+from twillmanager.events import EventHub, format_event
+from twillmanager.history import Aggregate, Run, rollup, summarize, load_aggregates, MINUTE, HOUR, DAY
+from twillmanager.metrics import Histogram, Metrics, render
+from twillmanager.scheduler import Scheduler
+from twillmanager.status import StatusTable
+from twillmanager.template import TemplateProcess
+from twillmanager.transfer import (validate_twill_form, import_watches, export_json, export_csv,
+    read_json, read_csv, FIELDS)
+from twillmanager.watch import Watch, WorkerSet, STATUS_OK, STATUS_TIMEOUT, STATUS_UNKNOWN, create_ssl_context
+from twillmanager.writer import StatusWriter
 
 class Test_Watch(object):
     def setUp(self):
@@ -90,6 +130,20 @@ class Test_Watch(object):
         w3loaded = Watch.load(w1.id + w2.id, self.connection)
         assert w3loaded is None
 
+    def test_old_database_is_upgraded(self):
+        self.connection.execute("DROP TABLE twills")
+        self.connection.execute("CREATE TABLE twills(id INTEGER PRIMARY KEY, name VARCHAR(255) UNIQUE NOT NULL, "
+            "interval INTEGER NOT NULL, script TEXT, emails TEXT, status VARCHAR(100) NOT NULL, time INTEGER, "
+            "reminder_interval INTEGER, last_alert INTEGER)")
+        self.connection.execute("INSERT INTO twills(name, interval, script, status) VALUES ('old', 10, 'go old', 'OK')")
+        create_tables(self.connection)
+
+        w = Watch.load_by_name('old', self.connection)
+        assert_equal(None, w.duration)
+        w.duration = 1.5
+        w.update_status(self.connection)
+        assert_equal(1.5, Watch.load(w.id, self.connection).duration)
+
     def test_load_all(self):
         w1 = Watch('www.google.com', 10, "go google")
         w1.save(self.connection)
@@ -107,12 +161,289 @@ class Test_Watch(object):
         self.compare_watches(w3, watches[2])
 
 
+    def test_status_since(self):
+        w = Watch('codesprinters', 10, "go codesprinters")
+        w.save(self.connection)
+        for status, time in [('FAILED', 100.0), ('FAILED', 110.0), (STATUS_OK, 120.0), (STATUS_OK, 130.0)]:
+            w.status, w.time = status, time
+            w.update_status(self.connection)
+            if time == 110.0:
+                assert_equal(100.0, Watch.load(w.id, self.connection).status_since)
+        assert_equal(120.0, Watch.load(w.id, self.connection).status_since)
+
+    def test_load_page(self):
+        for n, (status, time) in enumerate([(STATUS_OK, 50.0), ('FAILED', 10.0), ('FAILED', 40.0),
+                                            (STATUS_OK, None), ('FAILED', 30.0), (STATUS_OK, 20.0),
+                                            ('UNKNOWN', None)]):
+            w = Watch('watch %d' % n, 10, "go codesprinters %d" % n)
+            w.save(self.connection)
+            if time is not None:
+                w.status, w.time = status, time
+                w.update_status(self.connection)
+
+        def load_all_pages(**kwargs):
+            names = []
+            after = None
+            while True:
+                watches, after = Watch.load_page(self.connection, after=after, limit=3, **kwargs)
+                assert len(watches) <= 3
+                names.extend([w.name for w in watches])
+                if after is None:
+                    return names
+
+        assert_equal(['watch %d' % n for n in xrange(7)], load_all_pages())
+        assert_equal(['watch 1', 'watch 2', 'watch 4'], load_all_pages(status='FAILED'))
+        assert_equal(['watch 0', 'watch 2', 'watch 4', 'watch 5', 'watch 1', 'watch 6', 'watch 3'],
+                     load_all_pages(sort='time'))
+        assert_equal(['watch 1', 'watch 4'], load_all_pages(failing_since=30.0))
+        assert_equal(['watch 5'], load_all_pages(name_prefix='watch 5'))
+        assert_equal([], load_all_pages(name_prefix='x'))
+
+        # characters outside the BMP and GLOB wildcards in the names
+        for name in [u'watch \U0001f600', u'watch [*?]', u'watch ab']:
+            Watch(name, 10, "go codesprinters").save(self.connection)
+        assert_equal(['watch %d' % n for n in xrange(7)] + [u'watch [*?]', u'watch ab', u'watch \U0001f600'],
+                     load_all_pages(name_prefix=u'watch '))
+        assert_equal([u'watch \U0001f600'], load_all_pages(name_prefix=u'watch \U0001f600'))
+        assert_equal([u'watch [*?]'], load_all_pages(name_prefix=u'watch [*'))
+        assert_equal([], load_all_pages(name_prefix=u'watch ?'))
+
+        # only the listed columns are loaded, the script when it's needed
+        watches, after = Watch.load_page(self.connection, limit=1)
+        assert not watches[0].is_loaded('script')
+        assert_equal("go codesprinters 0", watches[0].script)
+        assert_raises(ValueError, Watch.load_page, self.connection, after='garbage')
+
+    def test_lazy_columns(self):
+        w = Watch('codesprinters', 10, "go codesprinters", emails="a@example.com")
+        w.save(self.connection)
+
+        loaded = Watch.load(w.id, self.connection, ['name'])
+        assert loaded.is_loaded('id') and loaded.is_loaded('name')
+        assert not loaded.is_loaded('script')
+        assert not hasattr(loaded, '__dict__')
+        assert_raises(AttributeError, getattr, loaded, 'no_such_column')
+
+        # all the missing columns are loaded at once
+        assert_equal("go codesprinters", loaded.script)
+        assert loaded.is_loaded('emails')
+        assert_equal("a@example.com", loaded.emails)
+
+        loaded = Watch.load(w.id, self.connection, ['id'])
+        w.delete(self.connection)
+        assert_raises(AttributeError, getattr, loaded, 'script')
+
+    def test_listing_uses_indexes(self):
+        plan = self.connection.execute("EXPLAIN QUERY PLAN SELECT id FROM twills WHERE status = ? ORDER BY name LIMIT 10", ('OK',)).fetchall()
+        assert 'twills_status' in ' '.join(str(row[-1]) for row in plan)
+        plan = self.connection.execute("EXPLAIN QUERY PLAN SELECT id FROM twills WHERE name > ? ORDER BY name LIMIT 10", ('a',)).fetchall()
+        assert 'SCAN' not in ' '.join(str(row[-1]) for row in plan)
+
     def compare_watches(self, w1, w2):
         assert_equal(w1.name, w2.name)
         assert_equal(w1.script, w2.script)
         assert_equal(w1.interval, w2.interval)
 
 
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class Test_Scheduler(object):
+    """ Tests for scheduler.Scheduler """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = Scheduler(self.clock)
+
+    def test_empty(self):
+        assert_equal(None, self.scheduler.next_deadline())
+        assert_equal([], self.scheduler.pop_due())
+
+    def test_due_in_deadline_order(self):
+        self.scheduler.add(1, 30)
+        self.scheduler.add(2, 10)
+        self.scheduler.add(3, 20)
+
+        assert_equal(1010.0, self.scheduler.next_deadline())
+        self.clock.now = 1025.0
+        assert_equal([2, 3], self.scheduler.pop_due())
+        assert_equal(1030.0, self.scheduler.next_deadline())
+
+    def test_removed_watch_is_not_due(self):
+        self.scheduler.add(1, 10)
+        self.scheduler.add(2, 20)
+        self.scheduler.remove(1)
+
+        assert 1 not in self.scheduler
+        assert_equal(1, len(self.scheduler))
+        self.clock.now = 1100.0
+        assert_equal([2], self.scheduler.pop_due())
+
+    def test_readding_reschedules(self):
+        self.scheduler.add(1, 10)
+        self.scheduler.add(1, 50, delay=0)
+
+        assert_equal(1000.0, self.scheduler.next_deadline())
+        assert_equal([1], self.scheduler.pop_due())
+        assert_equal(1050.0, self.scheduler.next_deadline())
+
+    def test_change_interval_keeps_place(self):
+        self.scheduler.add(1, 60)
+        self.clock.now = 1030.0
+        self.scheduler.change_interval(1, 40)
+        assert_equal(1040.0, self.scheduler.next_deadline())
+
+        # the next run would have been in the past
+        self.scheduler.change_interval(1, 10)
+        assert_equal(1030.0, self.scheduler.next_deadline())
+        assert_equal([1], self.scheduler.pop_due())
+        assert_equal(1040.0, self.scheduler.next_deadline())
+
+        self.scheduler.change_interval(2, 10)
+        assert_equal(1040.0, self.scheduler.deadlines[2])
+
+    def test_next_run_is_based_on_deadline(self):
+        self.scheduler.add(1, 10)
+
+        self.clock.now = 1013.0 # dispatched late
+        assert_equal([1], self.scheduler.pop_due())
+        assert_equal(1020.0, self.scheduler.next_deadline())
+
+    def test_missed_runs_are_skipped(self):
+        self.scheduler.add(1, 10)
+
+        self.clock.now = 1047.0
+        assert_equal([1], self.scheduler.pop_due())
+        assert_equal(1050.0, self.scheduler.next_deadline())
+
+    def test_jitter_does_not_accumulate(self):
+        scheduler = Scheduler(self.clock, jitter=0.1, random=lambda: 0.5)
+        scheduler.add(1, 100)
+        assert_equal(1105.0, scheduler.next_deadline())
+
+        self.clock.now = 1105.0
+        assert_equal([1], scheduler.pop_due())
+        assert_equal(1205.0, scheduler.next_deadline())
+
+    def test_spread(self):
+        self.scheduler.add_spread([(1, 60), (2, 60), (3, 60), (4, 60)])
+
+        assert_equal({1: 1000.0, 2: 1015.0, 3: 1030.0, 4: 1045.0}, self.scheduler.deadlines)
+
+
+class Test_StatusTable(object):
+    def test_json_is_regenerated_on_change(self):
+        table = StatusTable()
+        table.update(1, {'id': 1, 'name': 'codesprinters', 'status': STATUS_OK, 'alive': True})
+        etag, data = table.json()
+        assert_equal({'1': {'id': 1, 'name': 'codesprinters', 'status': STATUS_OK, 'alive': True}}, simplejson.loads(data))
+        assert_equal(etag, table.etag())
+        assert table.json()[1] is data
+
+        # updates that don't change anything keep the version
+        table.update(1, {'status': STATUS_OK})
+        assert_equal(etag, table.etag())
+
+        table.update(1, {'status': 'FAILED'})
+        new_etag, new_data = table.json()
+        assert_not_equal(etag, new_etag)
+        assert_equal('FAILED', simplejson.loads(new_data)['1']['status'])
+        assert_equal('FAILED', table.get(1)['status'])
+
+        table.remove(1)
+        assert 1 not in table
+        assert_equal(None, table.get(1))
+        assert_equal({}, simplejson.loads(table.json()[1]))
+
+    def test_changes_since_version(self):
+        table = StatusTable()
+        table.update(1, {'status': STATUS_OK})
+        table.update(2, {'status': STATUS_OK})
+        version = table.version
+
+        table.update(2, {'status': 'FAILED'})
+        table.update(3, {'status': STATUS_OK})
+        changes = table.changes(version)
+        assert_false(changes['full'])
+        assert_equal(table.version, changes['version'])
+        assert_equal(['2', '3'], sorted(changes['watches']))
+        assert_equal('FAILED', changes['watches']['2']['status'])
+
+        table.remove(3)
+        changes = table.changes(changes['version'])
+        assert_equal({'3': None}, changes['watches'])
+
+        # unknown versions (e.g. from before a restart) get the whole table
+        changes = table.changes(table.start_version - 1)
+        assert changes['full']
+        assert_equal(['1', '2'], sorted(changes['watches']))
+
+    def test_changes_wait_for_change(self):
+        table = StatusTable()
+        table.update(1, {'status': STATUS_OK})
+        version = table.version
+
+        start = time.time()
+        assert_equal({}, table.changes(version, 0.1)['watches'])
+        assert time.time() - start >= 0.09
+
+        timer = threading.Timer(0.1, table.update, (1, {'status': 'FAILED'}))
+        timer.start()
+        changes = table.changes(version, 10)
+        assert_equal('FAILED', changes['watches']['1']['status'])
+        timer.join()
+
+        table.close()
+        start = time.time()
+        table.changes(table.version, 10)
+        assert time.time() - start < 1
+
+class Test_EventHub(object):
+    def test_events_are_sent_to_all_subscribers(self):
+        hub = EventHub(buffer_size=10)
+        first = hub.subscribe()
+        second = hub.subscribe()
+        hub.publish('start', {'id': 1})
+        hub.publish('end', {'id': 1, 'status': STATUS_OK})
+
+        for subscription in (first, second):
+            assert_equal((1, 'start', {'id': 1}), subscription.get(0))
+            assert_equal((2, 'end', {'id': 1, 'status': STATUS_OK}), subscription.get(0))
+            assert_equal(None, subscription.get(0))
+
+        first.close()
+        assert_equal(1, len(hub))
+        assert_equal('id: 2\nevent: end\ndata: {"id": 1}\n\n', format_event((2, 'end', {'id': 1})))
+
+    def test_slow_subscriber_is_dropped(self):
+        hub = EventHub(buffer_size=2, max_subscribers=2)
+        slow = hub.subscribe()
+        fast = hub.subscribe()
+        assert_equal(None, hub.subscribe())
+
+        for n in xrange(3):
+            hub.publish('update', {'id': n})
+            assert_equal(n + 1, fast.get(0)[0])
+
+        assert slow.dropped and slow.closed
+        assert_equal(None, slow.get(10))
+        assert_equal(1, len(hub))
+        assert_equal(1, hub.dropped)
+        assert hub.subscribe() is not None
+
+    def test_close_wakes_up_subscribers(self):
+        hub = EventHub()
+        subscription = hub.subscribe()
+        threading.Timer(0.1, hub.close).start()
+        start = time.time()
+        assert_equal(None, subscription.get(10))
+        assert time.time() - start < 5
+        assert subscription.closed
+        assert_equal(0, len(hub))
+
 class Test_AsyncWorkerProxy(object):
     """ Tests for async.WorkerProxy"""
     def test_messages_are_queued(self):
@@ -132,6 +463,119 @@ class Test_AsyncWorkerProxy(object):
         assert_equal(('two',(1,None)), calls[2])
         assert_equal(('three',('a','b','c')), calls[3])
 
+    def test_worker_ignoring_sigterm_is_killed(self):
+        ready = multiprocessing.Event()
+        worker_proxy = StubbornWorkerProxy(ready)
+        worker_proxy.start(True)
+        assert ready.wait(10)
+
+        worker_proxy.terminate()
+        worker_proxy.join(0.3)
+        assert worker_proxy.is_alive()
+
+        worker_proxy.kill()
+        worker_proxy.join(10)
+        assert not worker_proxy.is_alive()
+
+    def test_wait_returns_when_worker_exits(self):
+        ready = multiprocessing.Event()
+        worker_proxy = StubbornWorkerProxy(ready)
+        worker_proxy.start(True)
+        assert ready.wait(10)
+
+        waiter = threading.Thread(target=worker_proxy.wait)
+        waiter.start()
+        waiter.join(0.2)
+        assert waiter.is_alive()
+
+        worker_proxy.kill()
+        waiter.join(10)
+        assert not waiter.is_alive()
+        worker_proxy.join()
+
+class StubbornWorker(Worker):
+    """ Worker that ignores SIGTERM """
+    def __init__(self, queue, ready):
+        Worker.__init__(self, queue)
+        self.ready = ready
+
+    def main(self):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self.ready.set()
+        time.sleep(60)
+
+class StubbornWorkerProxy(WorkerProxy):
+    def __init__(self, ready):
+        WorkerProxy.__init__(self)
+        self.ready = ready
+
+    def make_worker(self, queue):
+        return StubbornWorker(queue, self.ready)
+
+class ExitingWorker(Worker):
+    """ Worker that exits at once, as if it crashed """
+    def main(self):
+        pass
+
+class ExitingWorkerProxy(WorkerProxy):
+    def __init__(self, slot):
+        WorkerProxy.__init__(self)
+        self.slot = slot
+
+    def make_worker(self, queue):
+        return ExitingWorker(queue)
+
+class ReportingWorker(Worker):
+    """ Worker reporting its parent process, then sleeping """
+    def __init__(self, results):
+        Worker.__init__(self, None)
+        self.results = results
+
+    def main(self):
+        self.results.put(os.getppid())
+        time.sleep(60)
+
+class Test_TemplateProcess(object):
+    """ Tests for template.TemplateProcess """
+    def test_workers_are_forked_from_template(self):
+        results = multiprocessing.Queue(0)
+        template = TemplateProcess(lambda slot: ReportingWorker(results))
+        template.start()
+        try:
+            child = template.fork(0)
+            assert_equal(template.process.pid, results.get(True, 10))
+            assert child.is_alive()
+
+            child.terminate()
+            child.join(10)
+            assert not child.is_alive()
+            assert_equal(-signal.SIGTERM, child.exitcode)
+        finally:
+            template.stop()
+        assert not template.is_alive()
+
+    def test_worker_started_too_late_is_killed(self):
+        results = multiprocessing.Queue(0)
+        def make_worker(slot):
+            if slot == 0:
+                time.sleep(1)
+            return ReportingWorker(results)
+        template = TemplateProcess(make_worker)
+        template.FORK_TIMEOUT = 0.2
+        template.start()
+        try:
+            assert_raises(RuntimeError, template.fork, 0)
+            template.FORK_TIMEOUT = 10
+            # the reply about the late worker isn't taken for this one
+            child = template.fork(1)
+            deadline = time.time() + 10
+            while template._children.keys() != [child.pid]:
+                assert time.time() < deadline, template._children
+                time.sleep(0.05)
+            assert child.is_alive()
+        finally:
+            template.stop()
+
 
 class Test_AsyncWorker(object):
     """ Tests for async.Worker"""
@@ -160,9 +604,863 @@ class Test_AsyncWorker(object):
         worker.third.assert_called_with(1,2)
         assert not worker.running
         
+class Test_ThreadEngine(object):
+    """ Tests for engine.ThreadEngine """
+    def test_calls_run_concurrently(self):
+        engine = ThreadEngine(3)
+        lock = threading.Lock()
+        all_running = threading.Event()
+        running = []
+
+        def call(n):
+            with lock:
+                running.append(n)
+                if len(running) == 3:
+                    all_running.set()
+            # only returns early if all three calls run at the same time
+            all_running.wait(5)
+
+        for n in xrange(3):
+            engine.spawn(call, n)
+        engine.join()
+
+        assert all_running.is_set()
+
+    def test_failing_call_releases_slot(self):
+        engine = ThreadEngine(1)
+        done = []
+
+        def fail():
+            raise ValueError("failed")
+
+        engine.spawn(fail)
+        engine.spawn(done.append, 1)
+        engine.join()
+
+        assert_equal([1], done)
+
+    def test_create_engine(self):
+        assert create_engine({}) is None
+        assert isinstance(create_engine({'workers.concurrency': '2'}), ThreadEngine)
+        assert_raises(RuntimeError, create_engine, {'workers.engine': 'fibers'})
+
+class Test_TwillThreadState(object):
+    """ Tests for running twill scripts in several threads at once """
+    def test_output_and_variables_are_per_thread(self):
+        outputs = {}
+
+        def run(n):
+            out = StringIO()
+            twill.set_output(out)
+            try:
+                twill.parse._execute_script(['setlocal x %d' % n, 'echo $x'])
+            finally:
+                twill.set_output(None)
+            outputs[n] = out.getvalue()
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert_equal({0: '0\n', 1: '1\n', 2: '2\n', 3: '3\n'}, outputs)
+
+    def test_browser_is_per_thread(self):
+        browsers = []
+        thread = threading.Thread(target=lambda: browsers.append(twill.get_browser()))
+        thread.start()
+        thread.join()
+
+        assert browsers[0] is not twill.get_browser()
+        twill.commands.config('readonly_controls_writeable', '1')
+        try:
+            assert twill.commands._options['readonly_controls_writeable']
+            thread = threading.Thread(target=lambda: browsers.append(twill.commands._options['readonly_controls_writeable']))
+            thread.start()
+            thread.join()
+            assert not browsers[1]
+        finally:
+            twill.commands.reset_browser()
+
+class Test_TwillContext(object):
+    """ Tests for running twill scripts in explicit contexts """
+    def test_contexts_are_isolated(self):
+        out1, out2 = StringIO(), StringIO()
+        c1 = twill.TwillContext(out=out1)
+        c2 = twill.TwillContext(out=out2)
+
+        twill.execute_string('setglobal x one\nconfig use_tidy 0\necho $x', context=c1)
+        twill.execute_string('setglobal x two\necho $x', context=c2)
+        twill.execute_string('echo $x', context=c1)
+
+        assert_equal('one\none\n', out1.getvalue())
+        assert_equal('two\n', out2.getvalue())
+        assert not c1.get_options()['use_tidy']
+        assert c2.get_options()['use_tidy']
+        assert c1.get_browser() is not c2.get_browser()
+        assert 'x' not in twill.namespaces.global_dict
+
+    def test_previous_context_is_restored(self):
+        context = twill.TwillContext(out=StringIO(), err=StringIO())
+        current = twill.get_context()
+
+        assert_raises(Exception, twill.execute_string, 'code 200', context=context)
+        assert twill.get_context() is current
+
+    def test_contexts_in_threads(self):
+        contexts = [twill.TwillContext(out=StringIO()) for n in xrange(4)]
+
+        def run(n):
+            twill.parse._execute_script(['setlocal x %d' % n, 'echo $x'], context=contexts[n])
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert_equal(['0\n', '1\n', '2\n', '3\n'], [c.out.getvalue() for c in contexts])
+
+class Test_CompiledScripts(object):
+    """ Tests for compiling twill scripts once and executing them many times """
+    def test_compiled_script_is_cached(self):
+        script = u'echo "compiled once"\n# comment\n\ncode 200'
+        compiled = twill.parse.compile_string(script)
+
+        assert twill.parse.compile_string(script) is compiled
+        assert_equal(['echo', 'code'], [c.cmd for c in compiled])
+        assert_equal(twill.commands.echo, compiled[0].func)
+
+    def test_variables_are_substituted_on_each_run(self):
+        compiled = twill.parse.compile_string('echo $x ${x}!')
+
+        for value in ('one', 'two'):
+            context = twill.TwillContext(out=StringIO())
+            context.global_dict['x'] = value
+            twill.parse.execute_compiled(compiled, context=context)
+            assert_equal('%s %s!\n' % (value, value), context.out.getvalue())
+
+    def test_errors_are_raised_when_line_is_reached(self):
+        compiled = twill.parse.compile_string('echo before\n!!!\nno_such_command')
+        context = twill.TwillContext(out=StringIO(), err=StringIO())
+
+        assert_raises(twill.errors.TwillParseError, twill.parse.execute_compiled, compiled, context=context)
+        assert_equal('before\n', context.out.getvalue())
+
+        compiled = twill.parse.compile_string('no_such_command')
+        assert_raises(twill.errors.TwillNameError, twill.parse.execute_compiled, compiled, context=context)
+
+class Test_Tokenizer(object):
+    """ Differential tests of twill.parse.tokenize_line against the pyparsing grammar """
+
+    corpus = [
+        '', '   ', '\n', '!!!', '  1abc', '#comment', '  # indented comment',
+        'go http://example.com/', 'go http://example.com/#anchor',
+        'fv 1 q "twill manager"', "fv 1 q 'twill manager'",
+        'echo "a \\"quoted\\" word"', "echo 'it''s'", 'echo "say ""hi"""',
+        'echo "" \'\'', 'echo """"', 'echo "a"""', 'echo "a""',
+        'echo "backslash at end\\', 'echo "escaped \\ space"', 'echo "a\\\\" b',
+        'echo x"y"z', 'echo "a"b', 'echo\t"a\tb"\tc', 'echo "unterminated',
+        'echo "multi\nline"', 'echo a\rb', 'echo $var ${var} __args__',
+        'code 200 # trailing comment', 'code 200# glued comment', 'code "#not a comment"',
+        'run "print \'x\'"', 'cmd_1 a,b;c=d&e', 'echo \x0bvertical tab',
+        u'echo zażółć', u'echo "zażółć gęślą"', u'echo \'jaźń\' x',
+        u'żółw', 'echo \xc5\xbc "\xc5\xbc"',
+    ]
+
+    def check(self, line):
+        try:
+            expected = twill.grammar.parse(line)
+        except twill.grammar.ParseException, e:
+            try:
+                twill.parse.tokenize_line(line)
+            except twill.errors.TwillParseError, error:
+                assert_equal((e.loc, str(e)), (error.loc, str(error)))
+            else:
+                raise AssertionError("%r was parsed" % line)
+        else:
+            assert_equal(expected, twill.parse.tokenize_line(line))
+
+    def test_corpus(self):
+        for line in self.corpus:
+            self.check(line)
+
+    def test_random_lines(self):
+        pieces = list(u'ab_1 \t"\'\\#\n\r.$ż') + [u'""', u"''", u'\\"', u'go ']
+        rnd = random.Random(1234)
+        for n in xrange(5000):
+            line = u''.join(rnd.choice(pieces) for i in xrange(rnd.randint(0, 12)))
+            if rnd.random() < 0.5:
+                line = u'go ' + line
+            self.check(line)
+            self.check(line.encode('utf-8'))
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP/1.1 server on a free local port, counting connections it accepted """
+    daemon_threads = True
+
+    def __init__(self):
+        server = self
+        self.connections = 0
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                server.connections += 1
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                body = '<html><body>page %s</body></html>' % self.path
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server_port
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+class FakeConnection(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class Test_ConnectionPool(object):
+    """ Tests for keep-alive connections of the twill browser """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.pool = ConnectionPool(max_per_host=2, idle_timeout=30, clock=self.clock)
+
+    def test_connections_are_reused_per_host(self):
+        conn = FakeConnection()
+        self.pool.put('a', conn)
+
+        assert self.pool.get('b') is None
+        assert self.pool.get('a') is conn
+        assert self.pool.get('a') is None
+
+    def test_max_per_host(self):
+        conns = [FakeConnection() for n in xrange(3)]
+        for conn in conns:
+            self.pool.put('a', conn)
+
+        assert_equal(2, len(self.pool))
+        assert_equal([False, False, True], [conn.closed for conn in conns])
+
+    def test_idle_connections_are_evicted(self):
+        old, new = FakeConnection(), FakeConnection()
+        self.pool.put('a', old)
+        self.clock.now += 20
+        self.pool.put('b', new)
+        self.clock.now += 20
+
+        assert self.pool.get('a') is None
+        assert old.closed
+        assert self.pool.get('b') is new
+
+    def test_only_safe_requests_are_retried(self):
+        created = []
+
+        class FailingConnection(FakeConnection):
+            """ Connection failing to send requests with given error """
+            sock = True
+
+            def __init__(self, host, error=socket.error(errno.ECONNREFUSED, "Connection refused")):
+                created.append(self)
+                self.error = error
+
+            def set_debuglevel(self, level):
+                pass
+
+            def request(self, *args):
+                raise self.error
+
+        handler = _http.HTTPHandler(connection_pool=self.pool)
+        for error, data, retried in [(socket.error(errno.ECONNRESET, "Connection reset by peer"), None, True),
+                                     (httplib.BadStatusLine("''"), None, True),
+                                     (socket.error(errno.ECONNRESET, "Connection reset by peer"), 'a=1', False),
+                                     (socket.timeout("timed out"), None, False)]:
+            del created[:]
+            pooled = FailingConnection('example.com', error)
+            self.pool.put((FailingConnection, 'example.com'), pooled)
+            request = _http.Request('http://example.com/', data)
+            assert_raises((URLError, httplib.HTTPException), handler.do_open, FailingConnection, request)
+            assert pooled.closed
+            assert_equal(retried and 2 or 1, len(created))
+
+    def test_failed_new_connection_is_closed(self):
+        created = []
+
+        class BadResponseConnection(FakeConnection):
+            """ Connection getting an invalid response to every request """
+            sock = True
+
+            def __init__(self, host):
+                created.append(self)
+
+            def set_debuglevel(self, level):
+                pass
+
+            def request(self, *args):
+                raise httplib.BadStatusLine("''")
+
+        handler = _http.HTTPHandler(connection_pool=self.pool)
+        request = _http.Request('http://example.com/')
+        assert_raises(httplib.BadStatusLine, handler.do_open, BadResponseConnection, request)
+        assert_equal(1, len(created))
+        assert created[0].closed
+        assert_equal(0, len(self.pool))
+
+    def test_browser_keeps_connection_alive(self):
+        server = KeepAliveServer()
+        try:
+            context = twill.TwillContext(out=StringIO())
+            script = 'go %(url)s/a\nfind "page /a"\ngo %(url)s/b\nfind "page /b"\ngo %(url)s/c' % dict(url=server.url)
+            twill.parse.execute_string(script, context=context)
+
+            assert_equal(1, server.connections)
+            pool = context.get_browser()._browser._ua_handlers['http'].connection_pool
+            assert_equal(1, len(pool))
+
+            context.close()
+            assert_equal(0, len(pool))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class Test_Journeys(object):
+    """ Tests for timing of page loads by the twill browser """
+    def test_page_loads_are_timed(self):
+        server = KeepAliveServer()
+        try:
+            context = twill.TwillContext(out=StringIO(), err=StringIO())
+            script = 'go %(url)s/a\ngo %(url)s/b\nfind "no such text"' % dict(url=server.url)
+            assert_raises(twill.errors.TwillAssertionError, twill.parse.execute_string, script, context=context)
+            journeys = context.get_browser().journeys
+
+            assert_equal([('open', server.url + '/a', 200), ('open', server.url + '/b', 200)],
+                         [(j['action'], j['url'], j['code']) for j in journeys])
+            for journey in journeys:
+                for phase in twill.browser.JOURNEY_PHASES:
+                    assert journey[phase] >= 0
+                assert journey['total'] >= journey['ttfb'] > 0
+            # the connection is reused by the second request
+            assert journeys[0]['connect'] > 0
+            assert_equal(0, journeys[1]['connect'])
+            context.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class Test_SSLContexts(object):
+    """ Tests for SSL contexts shared by HTTPS connections """
+    def tearDown(self):
+        twill.set_ssl_context_factory(None)
+
+    def test_contexts_are_shared(self):
+        factory = Mock(side_effect=lambda: Mock())
+        twill.set_ssl_context_factory(factory)
+
+        context = _http.get_ssl_context()
+        assert _http.get_ssl_context() is context
+        client_context = _http.get_ssl_context('key.pem', 'cert.pem')
+        assert client_context is not context
+        assert _http.get_ssl_context('key.pem', 'cert.pem') is client_context
+        client_context.load_cert_chain.assert_called_once_with('cert.pem', 'key.pem')
+        assert_equal(2, factory.call_count)
+
+    def test_create_ssl_context(self):
+        assert_equal(ssl.CERT_REQUIRED, create_ssl_context({}).verify_mode)
+        assert_equal(ssl.CERT_NONE, create_ssl_context({'ssl.verify': False}).verify_mode)
+
+class Test_History(object):
+    def setUp(self):
+        self.connection = create_db_connection({'sqlite.file':':memory:'})
+        create_tables(self.connection)
+
+    def test_percentile_is_interpolated_within_bucket(self):
+        aggregate = Aggregate()
+        for n in xrange(100):
+            aggregate.add(1.0 + n / 100.0, STATUS_OK)  # 1.00 - 1.99
+        assert_almost_equal(1.495, aggregate.mean(), 6)
+        assert 1.8 < aggregate.percentile(0.95) <= 1.99
+        assert_equal(1.99, aggregate.percentile(1.0))
+        assert_equal(None, Aggregate().percentile(0.95))
+
+    def test_rollup(self):
+        day = 100 * DAY
+        runs = []
+        # a run every minute for two hours, 10% of them failing & slow
+        for n in xrange(120):
+            if n % 10 == 9:
+                runs.append(Run(1, day + n * MINUTE, 30.0, 'FAILED', 3))
+            else:
+                runs.append(Run(1, day + n * MINUTE, 0.2, STATUS_OK))
+        Run.insert_many(runs, self.connection)
+
+        assert_equal(120, rollup(self.connection, now=day + 2 * HOUR))
+        assert_equal(0, rollup(self.connection, now=day + 2 * HOUR))
+        assert_equal(120, len(load_aggregates(self.connection, 1, MINUTE, day, day + 2 * HOUR)))
+        assert_equal(2, len(load_aggregates(self.connection, 1, HOUR, day, day + 2 * HOUR)))
+
+        # runs stored later are added to existing aggregates
+        Run.insert_many([Run(1, day + 30, 0.2, STATUS_OK)], self.connection)
+        rollup(self.connection, now=day + 2 * HOUR)
+
+        week = summarize(self.connection, 1, day - 7 * DAY, day + 2 * HOUR)
+        assert_equal(121, week.runs)
+        assert_equal({STATUS_OK: 109, 'FAILED': 12}, week.statuses)
+        assert_equal(30.0, week.duration_max)
+        assert 20 < week.percentile(0.95) <= 30
+        assert week.percentile(0.5) <= 0.25
+
+        # old runs & aggregates are removed
+        rollup(self.connection, now=day + 3 * DAY)
+        assert_equal([], Run.load_recent(1, self.connection))
+        assert_equal(121, summarize(self.connection, 1, day, day + 3 * DAY).runs)
+        rollup(self.connection, now=day + 30 * DAY)
+        assert_equal(0, summarize(self.connection, 1, day, day + 30 * DAY, MINUTE).runs)
+        assert_equal(121, summarize(self.connection, 1, day, day + 30 * DAY).runs)
+
+    def test_runs_stored_again_are_counted_once(self):
+        day = 100 * DAY
+        runs = [Run(1, day + n * MINUTE, 0.2, STATUS_OK) for n in xrange(10)]
+        Run.insert_many(runs, self.connection)
+        assert_equal(10, rollup(self.connection, now=day + HOUR))
+
+        # e.g. a batch written again after an error
+        Run.insert_many(runs + [Run(1, day + 10 * MINUTE, 0.2, STATUS_OK)], self.connection)
+        assert_equal(1, rollup(self.connection, now=day + HOUR))
+        assert_equal(0, rollup(self.connection, now=day + HOUR))
+        assert_equal(11, summarize(self.connection, 1, day, day + HOUR).runs)
+        assert_equal(11, len(Run.load_recent(1, self.connection)))
+
+class Test_StatusWriter(object):
+    def setUp(self):
+        fd, self.file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.config = {'sqlite.file': self.file, 'writer.batch_size': 3, 'writer.flush_interval': 60}
+        self.connection = create_db_connection(self.config)
+        create_tables(self.connection)
+        self.watch = Watch('codesprinters', 10, "go codesprinters")
+        self.watch.save(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.file + suffix):
+                os.remove(self.file + suffix)
+
+    def result(self, n, status=STATUS_OK):
+        return (self.watch.id, status, 1000.0 + n, 0.5, None, Run(self.watch.id, 1000.0 + n, 0.5, status))
+
+    def test_results_are_written_in_batches(self):
+        writer = StatusWriter(self.config)
+        writer.start()
+        try:
+            for n in xrange(3):
+                writer.put(self.result(n))
+            # a full batch is written without waiting for the flush interval
+            for n in xrange(100):
+                if writer.stats()['commits']:
+                    break
+                time.sleep(0.05)
+            assert_equal(1, writer.stats()['commits'])
+            assert_equal(3, len(Run.load_recent(self.watch.id, self.connection)))
+
+            writer.put(self.result(3, 'FAILED'))
+        finally:
+            writer.stop()
+
+        stats = writer.stats()
+        assert_equal(2, stats['commits'])
+        assert_equal(4, stats['results_written'])
+        assert stats['max_commit_latency'] >= stats['mean_commit_latency'] > 0
+        loaded = Watch.load(self.watch.id, self.connection)
+        assert_equal('FAILED', loaded.status)
+        assert_equal(1003.0, loaded.time)
+        assert_equal(4, len(Run.load_recent(self.watch.id, self.connection)))
+
+    def test_results_are_reported_when_stored(self):
+        reported = []
+        writer = StatusWriter(self.config, on_result=lambda id, result: reported.append((id, result)))
+        writer.start()
+        try:
+            writer.put(self.result(0))
+            writer.abandon(42)
+            for n in xrange(100):
+                if reported:
+                    break
+                time.sleep(0.05)
+            # abandoned runs are reported at once, results when the batch is written
+            assert_equal([(42, None)], reported)
+            assert_equal(0, writer.stats()['commits'])
+        finally:
+            writer.stop()
+        assert_equal([(42, None), (self.watch.id, STATUS_OK)],
+                     [(id, result and result[1]) for id, result in reported])
+
+    def test_failed_batch_is_written_again(self):
+        reported = []
+        self.config['writer.flush_interval'] = 0.05
+        writer = StatusWriter(self.config, on_result=lambda id, result: reported.append(id))
+        with patch('twillmanager.writer.apply_results', Mock(side_effect=[sqlite3.OperationalError("database is locked"), None])) as apply:
+            writer.start()
+            try:
+                writer.put(self.result(0))
+                for n in xrange(100):
+                    if reported:
+                        break
+                    time.sleep(0.05)
+            finally:
+                writer.stop()
+        assert_equal(2, apply.call_count)
+        assert_equal([self.watch.id], reported)
+        assert_equal(1, writer.stats()['commits'])
+
+class Test_StatusBoard(object):
+    def test_lanes_written_by_other_process(self):
+        board = StatusBoard(2)
+        try:
+            process = multiprocessing.Process(target=lambda: (board.start(1, 7, 100.0),
+                                                              board.finish(1, 7, 2, 101.0, 1.0),
+                                                              board.start(1, 8, 102.0)))
+            process.start()
+            process.join()
+            assert board.wait(10)
+
+            lanes = board.snapshot()
+            assert_equal((IDLE, -1, 0), (lanes[0].state, lanes[0].status, lanes[0].runs))
+            lane = lanes[1]
+            assert_equal((RUNNING, 8, 102.0), (lane.state, lane.watch_id, lane.started))
+            assert_equal((2, 101.0, 1.0, 1), (lane.status, lane.time, lane.duration, lane.runs))
+            assert not board.wait(0)
+        finally:
+            board.close()
+
+    def test_lane_left_by_dead_writer_is_reset(self):
+        board = StatusBoard(1)
+        try:
+            board.start(0, 7, 100.0)
+            board.lanes[0].seq += 1 # the writer died writing the lane
+            assert board.read(0) is None
+
+            assert_equal(7, board.reset(0).watch_id)
+            assert_equal(IDLE, board.read(0).state)
+        finally:
+            board.close()
+
+class Test_Metrics(object):
+    def test_histogram(self):
+        histogram = Histogram([0.1, 1])
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value)
+        assert_equal(([2, 1, 1], 5.65), histogram.snapshot())
+
+    def test_render(self):
+        worker_set = Mock()
+        worker_set.metrics = Metrics()
+        worker_set.status_table = StatusTable()
+        worker_set.status_table.update(1, {'name': u'w"1'})
+        worker_set.board = StatusBoard(2)
+        worker_set.writer = StatusWriter({'sqlite.file': ':memory:'})
+        worker_set.worker_restarts = 0
+        try:
+            worker_set.metrics.run_ended(1, 'OK', 0.2, [{'dns': 0.001, 'connect': 0, 'ttfb': 0.02}])
+            worker_set.metrics.run_ended(1, 'FAILED', 2.0, [])
+            worker_set.metrics.run_started(0.003)
+            worker_set.board.start(0, 1, time.time())
+            worker_set.board.record_mail(1, 0.2)
+
+            lines = render(worker_set).splitlines()
+            for line in ['# TYPE twillmanager_runs_total counter',
+                         'twillmanager_runs_total{watch_id="1",watch="w\\"1",status="OK"} 1',
+                         'twillmanager_run_duration_seconds_bucket{watch_id="1",watch="w\\"1",le="0.25"} 1',
+                         'twillmanager_run_duration_seconds_bucket{watch_id="1",watch="w\\"1",le="+Inf"} 2',
+                         'twillmanager_run_duration_seconds_count{watch_id="1",watch="w\\"1"} 2',
+                         'twillmanager_http_phase_seconds_count{phase="dns"} 1',
+                         'twillmanager_http_phase_seconds_count{phase="connect"} 0',
+                         'twillmanager_scheduler_lag_seconds_bucket{le="0.005"} 1',
+                         'twillmanager_worker_lanes 2',
+                         'twillmanager_worker_lanes_busy 1',
+                         'twillmanager_mail_send_seconds_bucket{le="0.25"} 1',
+                         'twillmanager_db_commit_seconds_count 0']:
+                assert line in lines, line
+        finally:
+            worker_set.board.close()
+
+    def test_runs_of_deleted_watches_are_not_counted(self):
+        watches = set([1, 2])
+        metrics = Metrics(watches)
+        metrics.run_ended(1, 'OK', 0.2, [])
+        metrics.run_ended(2, 'OK', 0.2, [])
+        watches.discard(2)
+        metrics.remove(2)
+        # the result of a run of a deleted watch stored after it was deleted
+        metrics.run_ended(2, 'OK', 0.2, [{'dns': 0.001}])
+        runs, durations = metrics.snapshot()
+        assert_equal({(1, 'OK'): 1}, runs)
+        assert_equal([1], durations.keys())
+
+class Test_Database(object):
+    """ Tests for twillmanager.db """
+    def setUp(self):
+        fd, self.file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.config = {'sqlite.file': self.file, 'sqlite.pool_size': 2, 'sqlite.pool_timeout': 0.1}
+
+    def tearDown(self):
+        close_db_connection()
+        get_pool(self.config).close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.file + suffix):
+                os.remove(self.file + suffix)
+
+    def test_connection_pragmas(self):
+        connection = create_db_connection(self.config)
+        # checked from another connection, the mode is persistent
+        assert_equal('wal', sqlite3.connect(self.file).execute("PRAGMA journal_mode").fetchone()[0])
+        assert_equal(1, connection.execute("PRAGMA synchronous").fetchone()[0]) # NORMAL
+        assert_equal(5000, connection.execute("PRAGMA busy_timeout").fetchone()[0])
+        connection.close()
+
+    def test_pool_is_bounded(self):
+        pool = get_pool(self.config)
+        first = pool.acquire()
+        second = pool.acquire()
+        assert_raises(PoolTimeout, pool.acquire)
+
+        pool.release(first)
+        assert first is pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        assert_equal({'size': 2, 'open': 2, 'idle': 2, 'waits': 1}, pool.stats())
+
+    def test_thread_connection_is_returned_to_pool(self):
+        connection = get_db_connection(self.config)
+        assert connection is get_db_connection(self.config)
+        connection.execute("CREATE TABLE t(x INTEGER)")
+        connection.execute("INSERT INTO t VALUES (1)")
+        close_db_connection()
+        assert_equal(1, get_pool(self.config).stats()['idle'])
+
+        # uncommitted changes were rolled back
+        connection = get_db_connection(self.config)
+        assert_equal([], connection.execute("SELECT * FROM t").fetchall())
+
+    def test_query_stats(self):
+        stats = QueryStats()
+        stats.record("SELECT 1", 0.5)
+        stats.record("SELECT 1", 1.5)
+        assert_equal({'SELECT 1': {'count': 2, 'total': 2.0, 'max': 1.5}}, stats.dict())
+
+        connection = create_db_connection(self.config)
+        connection.execute("SELECT 2 + 2")
+        connection.cursor().execute("SELECT 2 + 2")
+        assert_equal(2, query_stats.dict()["SELECT 2 + 2"]['count'])
+        connection.close()
+
+class Test_Transfer(object):
+    """ Tests for twillmanager.transfer """
+    def setUp(self):
+        self.connection = create_db_connection({'sqlite.file':':memory:'})
+        create_tables(self.connection)
+        self.watch = Watch(u'zażółć', 10, "go codesprinters\ncode 200", emails="a@example.com", reminder_interval=60)
+        self.watch.save(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_export_and_import(self):
+        for exporter, reader in [(export_json, read_json), (export_csv, read_csv)]:
+            exported = ''.join(exporter(Watch.iterate_all(self.connection, FIELDS)))
+            definitions = list(reader(StringIO(exported)))
+            definitions.append({'name': 'google', 'interval': 20, 'script': 'go google'})
+
+            created, updated, errors = import_watches(self.connection, definitions)
+            assert_equal([], errors)
+            assert_equal([self.watch.id], updated)
+            assert_equal(1, len(created))
+
+            loaded = Watch.load(self.watch.id, self.connection)
+            for field in FIELDS:
+                assert_equal(getattr(self.watch, field), getattr(loaded, field))
+            assert_equal(2, len(Watch.load_all(self.connection)))
+            Watch.load(created[0], self.connection).delete(self.connection)
+
+    def test_nothing_is_imported_if_a_definition_is_invalid(self):
+        definitions = [{'name': 'google', 'interval': 20, 'script': 'go google'},
+                       {'name': 'yahoo', 'interval': 'often', 'script': 'go yahoo'},
+                       {'name': 'google', 'interval': 20, 'script': 'go google'}]
+        created, updated, errors = import_watches(self.connection, definitions)
+        assert_equal(([], []), (created, updated))
+        assert_equal([2, 3], [number for number, error in errors])
+        assert_equal(None, Watch.load_by_name('google', self.connection))
+
+    def test_read_json(self):
+        assert_equal([{'name': 'a'}, {'name': 'b'}], list(read_json(StringIO('{"name": "a"}\n\n{"name": "b"}\n'))))
+        assert_equal([{'name': 'a'}, {'name': 'b'}], list(read_json(StringIO('[{"name": "a"},\n{"name": "b"}]'))))
+        assert_equal([{'name': 'a'}], list(read_json(StringIO('\xef\xbb\xbf\n  \n[{"name": "a"}]\n'))))
+        assert_equal([{'name': 'a'}], list(read_json(StringIO('\xef\xbb\xbf{"name": "a"}\n'))))
+        assert_raises(ValueError, list, read_json(StringIO('{"name": "a"}\n{"name": ')))
+        assert_raises(ValueError, list, read_json(StringIO('"name"')))
+
+    def test_form_rejects_name_of_other_watch(self):
+        valid_dict, errors = validate_twill_form(self.connection,
+            {'name': self.watch.name, 'interval': '10', 'script': 'go google'})
+        assert_equal([u"Watch with this name already exists"], errors)
+        valid_dict, errors = validate_twill_form(self.connection,
+            {'name': self.watch.name, 'interval': '10', 'script': 'go google'}, self.watch)
+        assert_equal([], errors)
+
 class Test_WatchWorker(object):
     """ Tests for watch.Worker """
 
+    def test_execute_runs_watch_given_by_id(self):
+        connection = create_db_connection({'sqlite.file':':memory:'})
+        create_tables(connection)
+        w = Watch('codesprinters', 10, "go codesprinters")
+        w.save(connection)
+
+        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), 3, {})
+        worker.connection = connection
+        worker.execute_script = Mock(return_value=(STATUS_OK, '', [], None))
+        worker.execute(w.id)
+
+        loaded = Watch.load(w.id, connection)
+        assert_equal(STATUS_OK, loaded.status)
+        assert loaded.duration is not None
+
+        runs = Run.load_recent(w.id, connection)
+        assert_equal(1, len(runs))
+        assert_equal(STATUS_OK, runs[0].status)
+        assert_equal(loaded.duration, runs[0].duration)
+
+    def test_watch_taken_from_queue_is_claimed_on_board(self):
+        queue = multiprocessing.Queue(0)
+        board = StatusBoard(1)
+        try:
+            worker = twillmanager.watch.Worker(queue, 0, {}, board=board, lanes=[0])
+            worker.connection = create_db_connection({'sqlite.file':':memory:'})
+            create_tables(worker.connection)
+            worker.free_lanes = Queue.Queue(0)
+            worker.free_lanes.put(0)
+            worker.run = Mock()
+            queue.put(('execute', (7,)))
+            worker.execute_command(worker.next_command())
+            assert_equal((CLAIMED, 7), (board.read(0).state, board.read(0).watch_id))
+            worker.run.assert_called_with(7, 0)
+
+            # a watch that can't be run is unclaimed
+            del worker.run
+            worker.run(7, 0)
+            assert_equal(IDLE, board.read(0).state)
+            assert_equal(0, board.read(0).runs)
+            assert_equal(0, worker.free_lanes.get_nowait())
+        finally:
+            board.close()
+
+    def test_execute_script_reports_failing_line(self):
+        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), 0, {})
+        worker.watch = Watch('failing', 10, "echo first\n\n# comment\nno_such_command")
+        status, output, journeys, failing_line = worker.execute_script()
+        assert_equal('FAILED', status)
+        assert_equal(4, failing_line)
+        assert_equal([], journeys)
+
+    def test_execute_script_times_out_on_silent_server(self):
+        # the connection is accepted (by the backlog), but never answered
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            worker = twillmanager.watch.Worker(multiprocessing.Queue(0), 0, {})
+            worker.watch = Watch('silent', 10, "echo first\ngo http://127.0.0.1:%d/" % listener.getsockname()[1], timeout=0.5)
+            start = time.time()
+            status, output, journeys, failing_line = worker.execute_script()
+            assert_equal(STATUS_TIMEOUT, status)
+            assert_equal(2, failing_line)
+            assert time.time() - start < 2
+        finally:
+            listener.close()
+
+    def test_cancelled_script_is_interrupted(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            worker = twillmanager.watch.Worker(multiprocessing.Queue(0), 0, {})
+            worker.watchdog.start()
+            worker.watch = Watch('silent', 10, "go http://127.0.0.1:%d/" % listener.getsockname()[1], timeout=60)
+            start = time.time()
+            status, output, journeys, failing_line = worker.execute_script(lambda: time.time() > start + 0.2)
+            assert_equal('FAILED', status)
+            assert_equal(1, failing_line)
+            assert time.time() - start < 2
+        finally:
+            worker.watchdog.stop()
+            listener.close()
+
+    @patch('twill.parse.execute_compiled')
+    def test_script_run_by_engine_is_interrupted_after_deadline(self, execute_compiled):
+        # blocked outside of twill's sockets, no signal reaches it
+        execute_compiled.side_effect = lambda compiled, context: [time.sleep(0.01) for n in xrange(1000)]
+        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), 0, {})
+        worker.engine = ThreadEngine(1)
+        worker.watchdog.start()
+        try:
+            worker.watch = Watch('blocked', 10, "echo blocked", timeout=0.2)
+            start = time.time()
+            status, output, journeys, failing_line = worker.execute_script()
+            assert_equal(STATUS_TIMEOUT, status)
+            assert 'Script timed out' in output
+            assert time.time() - start < 5
+        finally:
+            worker.watchdog.stop()
+
+    def test_sleep_stops_at_deadline(self):
+        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), 0, {'workers.run_timeout': 0.2})
+        worker.watch = Watch('sleeping', 10, "sleep 30\necho never")
+        start = time.time()
+        status, output, journeys, failing_line = worker.execute_script()
+        assert_equal(STATUS_TIMEOUT, status)
+        assert_equal(1, failing_line)
+        assert time.time() - start < 2
+        assert 'never' not in output
+
+    def test_execute_skips_missing_watch(self):
+        connection = create_db_connection({'sqlite.file':':memory:'})
+        create_tables(connection)
+
+        writer = Mock()
+        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), 0, {}, writer=writer)
+        worker.connection = connection
+        worker.execute_script = Mock()
+        worker.execute(42)
+
+        assert not worker.execute_script.called
+        assert not writer.put.called
+        writer.abandon.assert_called_with(42)
+
+    def test_run_that_failed_to_load_watch_is_abandoned(self):
+        writer = Mock()
+        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), 0, {}, writer=writer)
+        worker.connection = Mock()
+        worker.connection.cursor.side_effect = sqlite3.OperationalError("database is locked")
+        worker.execute(42)
+
+        writer.abandon.assert_called_with(42)
+        assert not writer.put.called
+
     @patch('twillmanager.mail.create_mailer')
     def test_status_notify_change(self, create_mailer_mock):
         """ Test sending e-mails"""
@@ -178,7 +1476,7 @@ class Test_WatchWorker(object):
 
         config = {'mail.from': 'test@codesprinters.com'}
 
-        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), id=1, config=config)
+        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), slot=0, config=config)
         worker.watch = watch
         worker.status_notify('FAILED', "OK", "Is ok now")
 
@@ -205,7 +1503,7 @@ class Test_WatchWorker(object):
 
         config = {'mail.from': 'test@codesprinters.com'}
 
-        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), id=1, config=config)
+        worker = twillmanager.watch.Worker(multiprocessing.Queue(0), slot=0, config=config)
         worker.watch = watch
         worker.status_notify('FAILED', "FAILED", "Kick it")
 
@@ -217,3 +1515,367 @@ class Test_WatchWorker(object):
         assert_equals('Watch codesprinters.com status is still FAILED', args[2])
         assert_equals('Script:\ngo "http://codesprinters.com"\n\nResult:\nKick it', args[3])
 
+
+class Test_WorkerSet(object):
+    """ Tests for watch.WorkerSet """
+    def setUp(self):
+        fd, self.file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.config = {'sqlite.file': self.file, 'workers.pool_size': 2, 'workers.concurrency': 2,
+                       'workers.template': False, 'writer.flush_interval': 0.05,
+                       'scheduler.spread_startup': False}
+        self.connection = create_db_connection(self.config)
+        create_tables(self.connection)
+        self.clock = FakeClock()
+        self.worker_sets = []
+
+    def tearDown(self):
+        for worker_set in self.worker_sets:
+            worker_set.stop_workers()
+            worker_set.finish()
+        close_db_connection()
+        self.connection.close()
+        get_pool(self.config).close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.file + suffix):
+                os.remove(self.file + suffix)
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline, "Condition not met in %s seconds" % timeout
+            time.sleep(0.05)
+
+    def make_worker_set(self, options={}):
+        """ Creates a `WorkerSet` driven by the test (see `WorkerSet.manage`), with the fake clock """
+        config = dict(self.config, **options)
+        worker_set = WorkerSet(config, self.clock)
+        self.worker_sets.append(worker_set)
+        return worker_set
+
+    def add_watch(self, name, interval=60):
+        watch = Watch(name, interval, "echo %s" % name)
+        watch.save(self.connection)
+        return watch.id
+
+    def queued(self, worker_set):
+        jobs = []
+        try:
+            while True:
+                jobs.append(worker_set.job_queue.get(True, 0.5))
+        except Queue.Empty:
+            return jobs
+
+    def test_dispatch_queues_watch_once(self):
+        worker_set = self.make_worker_set()
+        worker_set.dispatch(7)
+        worker_set.dispatch(7)
+        assert_equal([('execute', (7,))], self.queued(worker_set))
+        assert_equal(set([7]), worker_set.pending)
+        assert_equal(1000.0, worker_set.planned[7])
+
+    def test_due_watches_are_dispatched(self):
+        worker_set = self.make_worker_set()
+        id = self.add_watch('due')
+        worker_set.add_all([id])
+        assert worker_set.is_alive(id)
+        assert worker_set.manage()
+        assert_equal([], self.queued(worker_set))
+
+        self.clock.now = 1061.0
+        assert worker_set.manage()
+        assert_equal([('execute', (id,))], self.queued(worker_set))
+        assert_equal(set([id]), worker_set.pending)
+        assert_equal(1060.0, worker_set.planned[id])
+        assert_equal(1120.0, worker_set.scheduler.next_deadline())
+
+    def test_read_board_notices_started_runs(self):
+        worker_set = self.make_worker_set()
+        id = self.add_watch('started')
+        worker_set.add(id)
+        subscription = worker_set.events.subscribe()
+        worker_set.dispatch(id, 990.0)
+        worker_set.board.start(1, id, 1000.5)
+        worker_set.read_board()
+        worker_set.read_board()
+
+        assert worker_set.is_building(id)
+        assert_equal(['start'], [type for n, type, data in iter(lambda: subscription.get(0), None)])
+        counts, lag = worker_set.metrics.scheduler_lag.snapshot()
+        assert_equal(10.5, lag)
+        assert_equal(1, sum(counts))
+
+    def test_end_of_run_releases_watch(self):
+        worker_set = self.make_worker_set()
+        id = self.add_watch('ended')
+        worker_set.add(id)
+        worker_set.dispatch(id)
+        worker_set.board.start(0, id, 1000.0)
+        worker_set.read_board()
+        worker_set.board.finish(0, id, 0, 1001.0, 1.0)
+        worker_set.run_ended(id, (id, STATUS_OK, 1001.0, 1.0, None, None))
+        assert worker_set.manage()
+
+        assert_equal(set(), worker_set.pending)
+        assert not worker_set.is_building(id)
+        assert_equal(STATUS_OK, worker_set.status_table.get(id)['status'])
+        # it may be dispatched again
+        worker_set.dispatch(id)
+        assert_equal([('execute', (id,)), ('execute', (id,))], self.queued(worker_set))
+
+    def test_check_now_schedules_releases_and_dispatches(self):
+        worker_set = self.make_worker_set()
+        id = self.add_watch('checked')
+        worker_set.quarantined.add(id)
+        worker_set.crashes[id] = 3
+        worker_set.check_now(id)
+        assert worker_set.manage()
+
+        assert worker_set.is_alive(id)
+        assert worker_set.is_building(id)
+        assert not worker_set.is_quarantined(id)
+        assert_equal({}, worker_set.crashes)
+        assert_equal([('execute', (id,))], self.queued(worker_set))
+
+    def test_restart_cancels_run(self):
+        worker_set = self.make_worker_set({'workers.stop_timeout': 10})
+        id = self.add_watch('restarted')
+        worker_set.add(id)
+        worker_set.board.start(1, id, 999.0)
+        worker_set.restart(id)
+        assert worker_set.manage()
+
+        assert worker_set.board.is_cancelled(1, 999.0)
+        assert not worker_set.board.is_cancelled(0, 999.0)
+        assert_equal({1: (999.0, 1010.0)}, worker_set.cancelled)
+        assert_equal(1010.0, worker_set.next_deadline())
+        assert worker_set.is_alive(id)
+        assert_equal(1060.0, worker_set.scheduler.next_deadline())
+
+        # several scripts run by the worker - the run is left to finish
+        worker_set.terminate_worker = Mock()
+        self.clock.now = 1010.0
+        assert worker_set.manage()
+        assert not worker_set.terminate_worker.called
+        assert_equal({}, worker_set.cancelled)
+
+    def test_restart_terminates_worker_running_one_script_if_run_does_not_end(self):
+        worker_set = self.make_worker_set({'workers.pool_size': 2, 'workers.concurrency': 1})
+        worker_set.terminate_worker = Mock()
+        first, second = self.add_watch('first'), self.add_watch('second')
+        worker_set.board.start(0, first, 999.0)
+        worker_set.board.start(1, second, 999.0)
+        worker_set.restart(first)
+        worker_set.restart(second)
+        assert worker_set.manage()
+
+        # the first run ends when cancelled, the second doesn't
+        worker_set.board.finish(0, first, -1, 1000.5, 1.5)
+        self.clock.now = 1010.0
+        assert worker_set.manage()
+        worker_set.terminate_worker.assert_called_once_with(1)
+
+    def test_reload_keeps_place_in_schedule(self):
+        worker_set = self.make_worker_set()
+        id = self.add_watch('reloaded', 60)
+        worker_set.add(id)
+        watch = Watch.load(id, self.connection)
+        watch.name = 'renamed'
+        watch.interval = 30
+        watch.save(self.connection)
+        self.clock.now = 1010.0
+        worker_set.reload(id)
+        assert worker_set.manage()
+
+        assert_equal(1030.0, worker_set.scheduler.next_deadline())
+        assert_equal('renamed', worker_set.status_table.get(id)['name'])
+        assert_equal([], self.queued(worker_set))
+
+    def test_reload_schedules_stopped_watch(self):
+        worker_set = self.make_worker_set()
+        id = self.add_watch('stopped', 60)
+        worker_set.add(id)
+        worker_set.remove(id)
+        assert not worker_set.is_alive(id)
+        worker_set.reload(id)
+        worker_set.reload(self.add_watch('new', 60))
+        worker_set.reload(1234) # no such watch
+        assert worker_set.manage()
+
+        assert worker_set.is_alive(id)
+        assert_equal(2, len(worker_set.scheduler))
+        assert 1234 not in worker_set.status_table
+
+    def test_reschedule_restarts_intervals(self):
+        worker_set = self.make_worker_set()
+        ids = [self.add_watch('first', 60), self.add_watch('second', 120)]
+        worker_set.add_all(ids)
+        self.clock.now = 1030.0
+        worker_set.reschedule(ids)
+        assert worker_set.manage()
+
+        assert_equal(1090.0, worker_set.scheduler.deadlines[ids[0]])
+        assert_equal(1150.0, worker_set.scheduler.deadlines[ids[1]])
+
+    def exited(self, worker_set, slot=0):
+        """ Waits for the (exiting) worker in the slot and handles its exit """
+        worker = worker_set.workers[slot]
+        worker.join(10)
+        worker_set.worker_exited(slot, worker.process.pid)
+
+    def restarted(self, worker_set, slot=0):
+        """ Lets the time to restart the worker in the slot come """
+        worker = worker_set.workers[slot]
+        self.clock.now = worker_set.restart_times[slot]
+        assert worker_set.manage()
+        assert worker is not worker_set.workers[slot]
+
+    def test_workers_dying_at_start_are_restarted_with_growing_delays(self):
+        worker_set = self.make_worker_set({'workers.pool_size': 1, 'workers.restart_delay': 1,
+                                           'workers.max_restart_delay': 5})
+        worker_set.create_worker_proxy = ExitingWorkerProxy
+        worker_set.start_worker(0)
+        delays = []
+        for n in xrange(5):
+            self.exited(worker_set)
+            delays.append(worker_set.restart_times[0] - self.clock.now)
+            assert_equal(worker_set.restart_times[0], worker_set.next_deadline())
+            self.restarted(worker_set)
+        assert_equal([1, 2, 4, 5, 5], delays)
+        assert_equal(5, worker_set.worker_restarts)
+
+        # a worker that was running for a while is restarted at once
+        self.clock.now += 5
+        self.exited(worker_set)
+        assert_equal(self.clock.now, worker_set.restart_times[0])
+        assert_equal(0, worker_set.failures[0])
+        assert_equal(6, worker_set.worker_restarts)
+
+    def test_terminated_worker_is_restarted_at_once(self):
+        worker_set = self.make_worker_set({'workers.pool_size': 1})
+        worker_set.create_worker_proxy = ExitingWorkerProxy
+        worker_set.start_worker(0)
+        worker_set.terminated[0] = (worker_set.workers[0], 1005.0)
+        self.exited(worker_set)
+        assert_equal(1000.0, worker_set.restart_times[0])
+        assert_equal({}, worker_set.terminated)
+        assert_equal(0, worker_set.worker_restarts)
+
+    def test_watch_crashing_workers_is_quarantined(self):
+        worker_set = self.make_worker_set({'workers.pool_size': 1, 'workers.concurrency': 2,
+                                           'workers.quarantine_after': 2})
+        worker_set.create_worker_proxy = ExitingWorkerProxy
+        id = self.add_watch('crashing')
+        worker_set.add(id)
+        worker_set.start_worker(0)
+
+        worker_set.dispatch(id)
+        worker_set.board.start(1, id, self.clock.now)
+        self.exited(worker_set)
+        assert_equal(IDLE, worker_set.board.read(1).state)
+        assert_equal(set(), worker_set.pending)
+        assert_equal({id: 1}, worker_set.crashes)
+        assert_equal(1, worker_set.status_table.get(id)['restarts'])
+        assert worker_set.is_alive(id)
+        assert not worker_set.is_building(id)
+
+        self.restarted(worker_set)
+        worker_set.dispatch(id)
+        worker_set.board.start(0, id, self.clock.now)
+        self.exited(worker_set)
+        assert worker_set.is_quarantined(id)
+        assert not worker_set.is_alive(id)
+        assert_equal({id: 2}, worker_set.restarts)
+
+        # until the user checks it
+        worker_set.check_now(id)
+        assert worker_set.manage()
+        assert not worker_set.is_quarantined(id)
+        assert worker_set.is_alive(id)
+        assert_equal({}, worker_set.crashes)
+        assert_equal(set([id]), worker_set.pending)
+
+    def test_restart_releases_quarantined_watch(self):
+        worker_set = self.make_worker_set()
+        id = self.add_watch('quarantined')
+        worker_set.quarantined.add(id)
+        worker_set.crashes[id] = 3
+        worker_set.restart(id)
+        assert worker_set.manage()
+        assert not worker_set.is_quarantined(id)
+        assert worker_set.is_alive(id)
+        assert_equal({}, worker_set.crashes)
+
+    def test_watch_claimed_by_dead_worker_is_released(self):
+        worker_set = self.make_worker_set({'workers.pool_size': 1, 'workers.concurrency': 1})
+        worker_set.create_worker_proxy = ExitingWorkerProxy
+        id = self.add_watch('claimed')
+        worker_set.add(id)
+        worker_set.start_worker(0)
+        worker_set.dispatch(id)
+        worker_set.board.claim(0, id)
+        self.exited(worker_set)
+
+        assert_equal(IDLE, worker_set.board.read(0).state)
+        assert_equal(set(), worker_set.pending)
+        assert_equal({}, worker_set.crashes)
+        worker_set.dispatch(id)
+        assert_equal([('execute', (id,)), ('execute', (id,))], self.queued(worker_set))
+
+    def test_finish_stops_all_threads(self):
+        worker_set = WorkerSet(dict(self.config, **{'workers.concurrency': 1, 'workers.template': True}))
+        worker_set.start()
+        stderr = StringIO()
+        with patch('sys.stderr', stderr):
+            worker_set.finish()
+            time.sleep(0.2)
+        # exceptions of threads are printed to stderr
+        assert 'Exception in thread' not in stderr.getvalue(), stderr.getvalue()
+        assert not [thread for thread in worker_set.exit_threads if thread.is_alive()]
+        assert not worker_set.manager_thread.is_alive()
+        worker_set.queue_command('exited', (0, 0))
+        assert_equal(0, len(worker_set.commands))
+
+    def test_quit(self):
+        worker_set = self.make_worker_set()
+        worker_set.queue_command('quit')
+        assert not worker_set.manage()
+
+    def running(self, worker_set, id):
+        return [entry for entry in worker_set.board.snapshot()
+                if entry is not None and entry.state == RUNNING and entry.watch_id == id]
+
+    def test_restart_cancels_only_the_run(self):
+        # the connection is accepted (by the backlog), but never answered
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        hanging = Watch('hanging', 3600, "go http://127.0.0.1:%d/" % listener.getsockname()[1], timeout=60)
+        hanging.save(self.connection)
+        other = Watch('other', 3600, "echo hi")
+        other.save(self.connection)
+        worker_set = WorkerSet(self.config)
+        worker_set.start()
+        try:
+            worker_set.check_now(hanging.id)
+            self.wait_for(lambda: self.running(worker_set, hanging.id))
+            pids = [worker.process.pid for worker in worker_set.workers]
+
+            # the other worker (and the main thread of this one) wait on the job queue meanwhile
+            start = time.time()
+            worker_set.restart(hanging.id)
+            self.wait_for(lambda: not self.running(worker_set, hanging.id) and hanging.id not in worker_set.pending)
+            assert time.time() - start < 5
+
+            worker_set.check_now(other.id)
+            # (the watch is added to the status table by the manager thread)
+            self.wait_for(lambda: (worker_set.status_table.get(other.id) or {}).get('status') == STATUS_OK)
+            # no worker was terminated
+            assert_equal(pids, [worker.process.pid for worker in worker_set.workers])
+            assert all(worker.is_alive() for worker in worker_set.workers)
+            # the result of the cancelled run is dropped
+            assert_equal(STATUS_UNKNOWN, Watch.load(hanging.id, self.connection).status)
+            assert worker_set.is_alive(hanging.id)
+        finally:
+            worker_set.finish()
+            listener.close()
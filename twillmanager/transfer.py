@@ -0,0 +1,204 @@
+# encoding: utf-8
+
+""" Validation of watch definitions, and their bulk import and export.
+
+    Definitions are dicts of `FIELDS`, read and written as JSON (one object per
+    line, so that thousands of them can be streamed) or CSV (with a header row).
+    Imports are all-or-nothing: definitions are validated like the watch form,
+    and stored in a single transaction only if all of them are valid.
+"""
+
+from __future__ import absolute_import
+
+import codecs
+import csv
+import simplejson
+from StringIO import StringIO
+
+from twillmanager.watch import Watch
+
+__all__ = ['FIELDS', 'FORMATS', 'validate_twill_form', 'import_watches',
+           'export_json', 'export_csv', 'read_json', 'read_csv']
+
+# Fields of exported and imported watch definitions
+FIELDS = ['name', 'interval', 'reminder_interval', 'timeout', 'emails', 'script']
+
+def validate_twill_form(connection, data, watch=None):
+    """ Checks if data (dictionary) contains valid watch definition.
+        Returns a tuple (valid_dict, list of errors),
+        where valid_dict contains the successfully validated values
+    """
+    # no need for any fancy form handling library for this single form
+    valid_dict = {}
+    errors = []
+
+    name = data.get('name', '')
+    if not name:
+        errors.append(u"Watch name is missing")
+    else:
+        other_watch = Watch.load_by_name(name, connection, ['id'])
+        if other_watch is not None and (watch is None or other_watch.id != watch.id):
+            errors.append(u"Watch with this name already exists")
+        else:
+            valid_dict['name'] = name
+
+    interval = data.get('interval', None)
+    if not interval:
+        errors.append(u"Interval is missing")
+    else:
+        try:
+            valid_dict['interval'] = int(interval)
+        except ValueError:
+            errors.append(u"Invalid number (interval)")
+
+    reminder_interval = data.get('reminder_interval', '').strip()
+    if reminder_interval:
+        try:
+            valid_dict['reminder_interval'] = int(reminder_interval)
+        except ValueError:
+            errors.append(u"Invalid number (reminder interval)")
+    else:
+        valid_dict['reminder_interval'] = None
+
+    timeout = data.get('timeout', '').strip()
+    if timeout:
+        try:
+            valid_dict['timeout'] = float(timeout)
+            if valid_dict['timeout'] <= 0:
+                errors.append(u"Timeout must be positive")
+        except ValueError:
+            errors.append(u"Invalid number (timeout)")
+    else:
+        valid_dict['timeout'] = None
+
+    script = data.get('script', None)
+    if not script or script.isspace():
+        errors.append(u"Script is missing")
+    else:
+        valid_dict['script'] = script
+
+    valid_dict['emails'] = data.get('emails', '')
+
+    return valid_dict, errors
+
+def form_data(definition):
+    """ Converts values of a definition to strings, like those posted by the watch form """
+    data = {}
+    for field in FIELDS:
+        value = definition.get(field)
+        if value is None:
+            data[field] = u''
+        elif isinstance(value, str):
+            data[field] = value.decode('utf-8')
+        else:
+            data[field] = unicode(value)
+    return data
+
+def import_watches(connection, definitions):
+    """ Creates watches from definitions, or updates the existing watches with the
+        same names, in a single transaction. Nothing is stored if any definition
+        is invalid.
+
+        Returns a tuple (ids of created watches, ids of updated watches, errors),
+        where errors is a list of tuples (number of the definition, message).
+
+        :param definitions: Iterable of dicts of `FIELDS` (e.g. from `read_json` or `read_csv`)
+    """
+    created = []
+    updated = []
+    errors = []
+    names = set()
+    try:
+        for number, definition in enumerate(definitions):
+            number += 1
+            data = form_data(definition)
+            if data['name'] in names:
+                errors.append((number, u"Watch %s is defined more than once" % data['name']))
+                continue
+            names.add(data['name'])
+
+            watch = data['name'] and Watch.load_by_name(data['name'], connection) or None
+            valid_dict, watch_errors = validate_twill_form(connection, data, watch)
+            errors.extend((number, error) for error in watch_errors)
+            if errors:
+                # nothing is going to be stored, the rest is only validated
+                continue
+
+            if watch is None:
+                watch = Watch(**valid_dict)
+                watch.insert(connection, commit=False)
+                created.append(watch.id)
+            else:
+                for k, v in valid_dict.iteritems():
+                    setattr(watch, k, v)
+                watch.update(connection, commit=False)
+                updated.append(watch.id)
+    except Exception:
+        connection.rollback()
+        raise
+
+    if errors:
+        connection.rollback()
+        return [], [], errors
+    connection.commit()
+    return created, updated, errors
+
+def definition(watch):
+    return dict((field, getattr(watch, field)) for field in FIELDS)
+
+def export_json(watches):
+    """ Generates definitions of the watches as JSON, one object per line """
+    for watch in watches:
+        yield simplejson.dumps(definition(watch)) + "\n"
+
+def export_csv(watches):
+    """ Generates definitions of the watches as CSV (UTF-8 encoded), with a header row """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for watch in watches:
+        writer.writerow([isinstance(value, unicode) and value.encode('utf-8') or value
+                         for value in [getattr(watch, field) for field in FIELDS]])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+def read_json(file):
+    """ Generates definitions read from a file of JSON objects, one per line
+        (a single JSON list of them is also accepted). Raises ValueError if the
+        file is not valid.
+    """
+    first = True
+    for number, line in enumerate(file):
+        if number == 0 and line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8):]
+        line = line.strip()
+        if not line:
+            continue
+        if first and line.startswith('['):
+            for item in simplejson.loads(line + file.read()):
+                yield check_definition(item)
+            return
+        first = False
+        try:
+            item = simplejson.loads(line)
+        except ValueError, e:
+            raise ValueError("Invalid JSON in line %d: %s" % (number + 1, e))
+        yield check_definition(item)
+
+def read_csv(file):
+    """ Generates definitions read from a CSV file (UTF-8 encoded) with a header row """
+    reader = csv.DictReader(file)
+    for row in reader:
+        yield check_definition(row)
+
+def check_definition(item):
+    if not isinstance(item, dict):
+        raise ValueError("Watch definition is not an object: %r" % (item,))
+    return item
+
+# format -> (exporter, reader, content type)
+FORMATS = {'json': (export_json, read_json, 'application/json'),
+           'csv': (export_csv, read_csv, 'text/csv')}
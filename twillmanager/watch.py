@@ -3,31 +3,74 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import base64
+import collections
+import functools
 import multiprocessing
+import simplejson
 from StringIO import StringIO
 import Queue
+import ssl
 import threading
 import time
 
 import twill
+import twill.browser
 import twill.commands
 import twill.parse
+from twill.errors import TwillTimeout
 
-from twillmanager.db import get_db_connection, close_db_connection
+from twillmanager.db import get_db_connection, close_db_connection, create_db_connection
+from twillmanager.history import Run
 import twillmanager.mail
 from twillmanager.log import logger
 import twillmanager.async
-
-__all__ = ['STATUS_FAILED', 'STATUS_OK', 'STATUS_UNKNOWN', 'Watch', 'WorkerSet']
+import twillmanager.engine
+from twillmanager.writer import StatusWriter, apply_results
+from twillmanager.scheduler import Scheduler
+from twillmanager.events import EventHub
+from twillmanager.status import StatusTable
+from twillmanager.template import TemplateProcess, TemplateChild
+from twillmanager.limits import ScriptTimeout, ScriptCancelled, Watchdog, script_limits, set_memory_limit
+from twillmanager.board import StatusBoard, IDLE, RUNNING, CLAIMED
+from twillmanager.metrics import Metrics
+
+__all__ = ['STATUS_FAILED', 'STATUS_OK', 'STATUS_TIMEOUT', 'STATUS_UNKNOWN', 'Watch', 'WorkerSet']
 
 # Consts for statuses
 STATUS_OK = 'OK'
 STATUS_FAILED = 'FAILED'
+STATUS_TIMEOUT = 'TIMEOUT' # the script didn't finish in time
 STATUS_UNKNOWN = 'UNKNOWN'
 
+# Statuses of watches that are down (alerts about them are repeated)
+FAILING_STATUSES = [STATUS_FAILED, STATUS_TIMEOUT]
+
+# Statuses by their codes on the status board of the workers (see `twillmanager.board`)
+STATUSES = [STATUS_UNKNOWN, STATUS_OK, STATUS_FAILED, STATUS_TIMEOUT]
+
+def format_time(value):
+    """ Formats check time of a watch (seconds since epoch) for the dashboard """
+    if value:
+        return time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(value));
+    else:
+        return None
+
+def format_duration(value):
+    """ Formats duration of a run (seconds) for the dashboard """
+    if value is not None:
+        return '%.2f s' % value
+    else:
+        return None
+
 class Watch(object):
     """ A simple data transfer object for describing watches (with data access methods
         for loading/storing watches into the database)
+
+        Watches may be loaded with only some of the columns (see ``columns``
+        parameters of the loaders). The other ones (like the script) are loaded
+        on first access, with the connection used to load the watch - so only
+        in the thread that loaded it.
     """
     # Rows in database table
     COLUMNS = ['id',
@@ -39,11 +82,32 @@ class Watch(object):
                'time',
                'reminder_interval',
                'last_alert',
+               'duration',
+               'status_since',
+               'timeout',
               ]
 
+    # Columns needed to list watches (see `load_page`) and show their statuses
+    LIST_COLUMNS = ['id',
+                    'name',
+                    'interval',
+                    'status',
+                    'time',
+                    'duration',
+                    'status_since',
+                   ]
+
+    # Orders of listed watches: name -> (column, descending)
+    SORTS = {'name': ('name', False),
+             'time': ('time', True)}
+
+    # attributes are the columns (unset until loaded) and the connection
+    # used to load the missing ones
+    __slots__ = COLUMNS + ['_connection']
+
     def __init__(self, name, interval, script,
             emails=None, status=STATUS_UNKNOWN, time=None,
-            reminder_interval=600, last_alert=None, id=None):
+            reminder_interval=600, last_alert=None, duration=None, status_since=None, timeout=None, id=None):
         """ Create a new Watch
 
             :param name: Name of the watch
@@ -55,6 +119,9 @@ class Watch(object):
             :param time: Last update time (as number of seconds since epoch - obtained by call to `time.time()`)
             :param reminder_interval: Interval (seconds) after which reminder that the watch is still down is sent
             :param last_alert: Time of last alert sent (as number of seconds since epoch - obtained by call to `time.time()`)
+            :param duration: How long (seconds) the last run of the script took
+            :param status_since: Time the watch got its current status (as number of seconds since epoch)
+            :param timeout: How long (seconds) a run of the script may take (None: ``workers.run_timeout``)
             :param id: Key in the database of the watch
         """
         self.name = name
@@ -65,13 +132,16 @@ class Watch(object):
         self.time = time
         self.reminder_interval = reminder_interval
         self.last_alert = last_alert
+        self.duration = duration
+        self.status_since = status_since
+        self.timeout = timeout
         self.id = id
 
     def formatted_time(self):
-        if self.time:
-            return time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(self.time));
-        else:
-            return None
+        return format_time(self.time)
+
+    def formatted_duration(self):
+        return format_duration(self.duration)
 
     def dict(self):
         """ Watch status data as dictionary (not a complete watch) """
@@ -80,21 +150,64 @@ class Watch(object):
         data['name'] = self.name
         data['status'] = self.status
         data['time'] = self.formatted_time();
+        data['duration'] = self.formatted_duration()
         return data
 
+    def __getattr__(self, name):
+        # called only for attributes that are not set - columns not loaded yet
+        if name not in self.COLUMNS:
+            raise AttributeError(name)
+        self.load_missing_columns()
+        return object.__getattribute__(self, name)
+
+    def is_loaded(self, name):
+        """ Whether the column has been loaded (or set) """
+        try:
+            object.__getattribute__(self, name)
+            return True
+        except AttributeError:
+            return False
+
+    def load_missing_columns(self):
+        """ Loads columns that were not loaded with the watch """
+        missing = [name for name in self.COLUMNS if not self.is_loaded(name)]
+        if not missing:
+            return
+        if not self.is_loaded('_connection'):
+            raise AttributeError("Columns %s of the watch are not loaded" % ', '.join(missing))
+        c = self._connection.cursor()
+        c.execute("SELECT " + self.columns(missing) + " FROM twills WHERE id = ?", (self.id,))
+        row = c.fetchone()
+        c.close()
+        if row is None:
+            raise AttributeError("Watch (id: %s) no longer exists" % self.id)
+        for name in missing:
+            setattr(self, name, row[name])
+        del self._connection
+
     @classmethod
-    def columns(cls):
-        return ','.join(cls.COLUMNS)
+    def columns(cls, columns=None):
+        return ','.join(columns or cls.COLUMNS)
 
     @classmethod
-    def construct_from_row(cls, row):
-        kwargs = dict()
-        for name in cls.COLUMNS:
-            try:
-                kwargs[name] = row[name]
-            except IndexError:
-                pass
-        return cls(**kwargs)
+    def select_columns(cls, columns=None):
+        """ Columns to be selected for given projection (id is always included) """
+        if columns is None:
+            return cls.COLUMNS
+        return ['id'] + [name for name in columns if name != 'id']
+
+    @classmethod
+    def construct_from_row(cls, row, connection=None):
+        """ Creates a watch from a database row (with any subset of the columns)
+
+            :param connection: Connection to load missing columns with
+        """
+        watch = cls.__new__(cls)
+        for name in row.keys():
+            setattr(watch, name, row[name])
+        if connection is not None and len(row.keys()) < len(cls.COLUMNS):
+            watch._connection = connection
+        return watch
 
     def save(self, connection):
         """ Save the watch into the database (using given connection) """
@@ -104,34 +217,37 @@ class Watch(object):
             self.update(connection)
         
 
-    def insert(self, connection):
+    def insert(self, connection, commit=True):
         """ Insert the watch into the database (using given connection) """
         c = connection.cursor()
-        c.execute("INSERT INTO twills (name, interval, script, emails, status, time, reminder_interval, last_alert) VALUES (?,?,?,?,?,?,?,?)",
-            (self.name, self.interval, self.script, self.emails, self.status, self.time, self.reminder_interval, self.last_alert))
+        c.execute("INSERT INTO twills (name, interval, script, emails, status, time, reminder_interval, last_alert, duration, timeout) VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (self.name, self.interval, self.script, self.emails, self.status, self.time, self.reminder_interval, self.last_alert, self.duration, self.timeout))
         self.id = c.lastrowid
         c.close()
-        connection.commit()
+        if commit:
+            connection.commit()
 
-    def update(self, connection):
+    def update(self, connection, commit=True):
         """ Update the watch into the database (using given connection) """
         assert self.id is not None
         c = connection.cursor()
-        c.execute("UPDATE twills SET name=?, interval=?, script=?, emails=?, status=?, time=?, reminder_interval=?, last_alert=? WHERE id = ?",
-            (self.name, self.interval, self.script, self.emails, self.status, self.time, self.reminder_interval, self.last_alert, self.id))
+        c.execute("UPDATE twills SET name=?, interval=?, script=?, emails=?, status=?, time=?, reminder_interval=?, last_alert=?, duration=?, timeout=? WHERE id = ?",
+            (self.name, self.interval, self.script, self.emails, self.status, self.time, self.reminder_interval, self.last_alert, self.duration, self.timeout, self.id))
         c.close()
-        connection.commit()
+        if commit:
+            connection.commit()
 
     def update_status(self, connection):
         """ Updates only information related to status check
-            (status, check time, messages).
+            (status, check time, duration, messages).
 
             This avoids overwriting script definition by a worker.
         """
         assert self.id is not None
         c = connection.cursor()
-        c.execute("UPDATE twills SET status=?, time=?, last_alert=? WHERE id = ?",
-            (self.status, self.time, self.last_alert, self.id))
+        c.execute("UPDATE twills SET status_since = CASE WHEN status = ? THEN status_since ELSE ? END, "
+                  "status=?, time=?, last_alert=?, duration=? WHERE id = ?",
+            (self.status, self.time, self.status, self.time, self.last_alert, self.duration, self.id))
         c.close()
         connection.commit()
 
@@ -139,137 +255,353 @@ class Watch(object):
         """ Deletes the watch from the database (using given connection) """
         c = connection.cursor()
         c.execute("DELETE FROM twills WHERE id = ?", (self.id,))
+        c.execute("DELETE FROM runs WHERE watch_id = ?", (self.id,))
+        c.execute("DELETE FROM run_aggregates WHERE watch_id = ?", (self.id,))
         c.close()
         connection.commit()
 
     @classmethod
-    def load(cls, id, connection):
-        """ Loads the watch with given id """
+    def load(cls, id, connection, columns=None):
+        """ Loads the watch with given id
+
+            :param columns: Columns to load (all by default), e.g. `LIST_COLUMNS`
+        """
         watch = None
         c = connection.cursor()
-        c.execute("SELECT " + cls.columns() + " FROM twills WHERE id = ?", (id,))
+        c.execute("SELECT " + cls.columns(cls.select_columns(columns)) + " FROM twills WHERE id = ?", (id,))
         for row in c:
-            watch = cls.construct_from_row(row)
+            watch = cls.construct_from_row(row, connection)
         c.close()
         return watch
 
     @classmethod
-    def load_by_name(cls, name, connection):
-        """ Loads the watch with given name """
+    def load_by_name(cls, name, connection, columns=None):
+        """ Loads the watch with given name
+
+            :param columns: Columns to load (all by default)
+        """
         watch = None
         c = connection.cursor()
-        c.execute("SELECT " + cls.columns() + " FROM twills WHERE name = ?", (name,))
+        c.execute("SELECT " + cls.columns(cls.select_columns(columns)) + " FROM twills WHERE name = ?", (name,))
         for row in c:
-            watch = cls.construct_from_row(row)
+            watch = cls.construct_from_row(row, connection)
         c.close()
         return watch
 
     @classmethod
-    def load_all(cls, connection):
-        """ Loads all watches """
+    def load_all(cls, connection, columns=None):
+        """ Loads all watches
+
+            :param columns: Columns to load (all by default)
+        """
+        return list(cls.iterate_all(connection, columns))
+
+    @classmethod
+    def iterate_all(cls, connection, columns=None):
+        """ Generates all watches (ordered by name), loading them as they're consumed
+
+            :param columns: Columns to load (all by default)
+        """
+        c = connection.cursor()
+        try:
+            c.execute("SELECT " + cls.columns(cls.select_columns(columns)) + " FROM twills ORDER BY name")
+            for row in c:
+                yield cls.construct_from_row(row, connection)
+        finally:
+            c.close()
+
+    @classmethod
+    def load_page(cls, connection, status=None, name_prefix=None, failing_since=None,
+                  sort='name', after=None, limit=50):
+        """ Loads a page of watches (only `LIST_COLUMNS`, so without scripts).
+            Returns a tuple (list of watches, cursor of the next page or None if
+            it's the last one).
+
+            :param status: Only watches with given status
+            :param name_prefix: Only watches with names starting with given string (case-sensitive)
+            :param failing_since: Only watches failing since given time (or earlier)
+            :param sort: Order of the watches: by ``name`` or by ``time`` of last
+                check (most recent first)
+            :param after: Cursor returned with the previous page
+            :param limit: Maximum number of watches on the page
+        """
+        column, descending = cls.SORTS[sort]
+        conditions = []
+        params = []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if name_prefix:
+            # GLOB is case-sensitive (unlike LIKE), its wildcards are escaped by
+            # brackets; the lower bound lets the search start in the index
+            pattern = name_prefix.replace('[', '[[]').replace('*', '[*]').replace('?', '[?]') + '*'
+            conditions.append("name >= ? AND name GLOB ?")
+            params.extend([name_prefix, pattern])
+        if failing_since is not None:
+            conditions.append("status IN (%s) AND status_since <= ?" % ','.join('?' * len(FAILING_STATUSES)))
+            params.extend(FAILING_STATUSES + [failing_since])
+
+        # keyset pagination: rows after the (sort key, id) of the last row of the previous page
+        if after is not None:
+            value, id = decode_cursor(after)
+            if not descending:
+                conditions.append("(%s > ? OR (%s = ? AND id > ?))" % (column, column))
+                params.extend([value, value, id])
+            elif value is None:
+                # NULLs come last in descending order
+                conditions.append("(%s IS NULL AND id < ?)" % column)
+                params.append(id)
+            else:
+                conditions.append("(%s < ? OR (%s = ? AND id < ?) OR %s IS NULL)" % (column, column, column))
+                params.extend([value, value, id])
+
+        query = "SELECT " + cls.columns(cls.LIST_COLUMNS) + " FROM twills"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        order = descending and "DESC" or "ASC"
+        query += " ORDER BY %s %s, id %s LIMIT ?" % (column, order, order)
+        params.append(limit + 1)
+
         watches = []
         c = connection.cursor()
-        c.execute("SELECT " + cls.columns() + " FROM twills ORDER BY name")
+        c.execute(query, params)
         for row in c:
-            watches.append(cls.construct_from_row(row))
+            watches.append(cls.construct_from_row(row, connection))
         c.close()
-        return watches
-    
 
-class WorkerProxy(twillmanager.async.WorkerProxy):
-    """ A proxy for controlling `Worker` processes """
-    def __init__(self, id, config):
-        twillmanager.async.WorkerProxy.__init__(self)
-        self.id = id
-        self.config = config
-        self.on_twill_start = None # executed when twill check starts
-        self.on_twill_end = None # executed when twill check starts
-
-    def set_twill_callbacks(self, on_start, on_end):
-        """ Sets callbacks to be executed when twill check starts and ends.
-            Must be set before starting the worker
+        next = None
+        if len(watches) > limit:
+            watches = watches[:limit]
+            last = watches[-1]
+            next = encode_cursor(getattr(last, column), last.id)
+        return watches, next
+
+def encode_cursor(value, id):
+    """ Encodes the position of a watch in a listing (see `Watch.load_page`) """
+    return base64.urlsafe_b64encode(simplejson.dumps([value, id]))
+
+def decode_cursor(cursor):
+    """ Decodes a cursor made by `encode_cursor`. Raises ValueError if it's invalid. """
+    try:
+        value, id = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+    return value, int(id)
+
+def create_ssl_context(config):
+    """ Creates SSL context for HTTPS connections made by watches.
+
+        Configured by ``ssl.ca_file`` (file with CA certificates to use instead of the
+        system ones) and ``ssl.verify`` (whether to verify server certificates) options.
+    """
+    context = ssl.create_default_context(cafile=config.get('ssl.ca_file', None))
+    if not config.get('ssl.verify', True):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+def format_journey(journey):
+    """ Formats a page load timed by twill (see `twill.browser.TwillBrowser.journeys`) for logging """
+    phases = ", ".join(["%s: %.3fs" % (phase, journey[phase]) for phase in twill.browser.JOURNEY_PHASES])
+    return "%s %s (%s) in %.3fs - %s" % (journey['action'], journey['url'], journey['code'], journey['total'], phases)
+
+def format_step(journey):
+    """ Converts a page load timed by twill to a step stored in the history of runs
+        (timings rounded to milliseconds)
+    """
+    step = dict(action=journey['action'], url=journey['url'], code=journey['code'])
+    for phase in twill.browser.JOURNEY_PHASES + ('total',):
+        step[phase] = round(journey[phase], 3)
+    return step
 
-            :param on_start: Executed when twill starts. A zero-argument callable
-            :param on_start: Executed when twill end. A zero-argument callable
+class WorkerProxy(twillmanager.async.WorkerProxy):
+    """ A proxy for controlling `Worker` processes of the pool """
+    def __init__(self, slot, config, queue, writer=None, template=None, board=None, lanes=()):
+        """ :param slot: Number of the pool slot taken by the worker
+            :param config: Configuration dict to be passed to the worker
+            :param queue: Job queue shared by all the workers of the pool
+            :param writer: `StatusWriter` storing results of the runs
+            :param template: `TemplateProcess` to fork the worker from
+                (if not given, or dead, it's forked from the current process)
+            :param board: `StatusBoard` the worker writes the state of its runs to...
+            :param lanes: ...into these lanes (one for each script it may run at once)
         """
-        assert not self.already_started(), "Can't call set_twill_callbacks on worker that is already started"
-        self.on_twill_start = on_start
-        self.on_twill_end = on_end
+        twillmanager.async.WorkerProxy.__init__(self, queue)
+        self.slot = slot
+        self.config = config
+        self.writer = writer
+        self.template = template
+        self.board = board
+        self.lanes = lanes
 
     def make_worker(self, queue):
-        return Worker(queue, self.id, self.config, self.on_twill_start, self.on_twill_end)
-
-    def quit(self):
-        """ Send 'quit' signal to the worker """
-        self.queue_command('quit')
-
-    def execute(self):
-        """ Send 'execute the script now' signal to the worker """
-        self.queue_command('execute')
+        return Worker(queue, self.slot, self.config, self.writer, self.board, self.lanes)
+
+    def start(self, daemon=False):
+        if self.template is None or not self.template.is_alive():
+            if self.template is not None:
+                logger.warn("Template process is dead, forking worker (slot: %s) from the manager" % self.slot)
+            return twillmanager.async.WorkerProxy.start(self, daemon)
+        assert not self.already_started(), "The worker is already started"
+        try:
+            self.process = self.template.fork(self.slot)
+        except RuntimeError, e:
+            logger.error("%s, forking it from the manager" % e)
+            twillmanager.async.WorkerProxy.start(self, daemon)
+
+    def wait(self):
+        if isinstance(self.process, TemplateChild):
+            self.process.wait()
+        else:
+            twillmanager.async.WorkerProxy.wait(self)
 
 class Worker(twillmanager.async.Worker):
-    """ Worker - a process that monitors if given twill script executes properly"""
-    def __init__(self, queue, id, config, on_start=None, on_end=None):
+    """ Worker - a process of the pool that checks if twill scripts of the
+        watches it is told to run execute properly
+    """
+    def __init__(self, queue, slot, config, writer=None, board=None, lanes=()):
         """ Creates a new `Worker`
-            :param queue: The command queue, as needed by `twillmanager.async.Worker`
-            :param id: Id (database primary key) of the watch to use
+            :param queue: The job queue, as needed by `twillmanager.async.Worker`
+            :param slot: Number of the pool slot taken by the worker
             :param config: Configuration dict to be used (needed for e-mail addresses etc)
-            :param on_start: Callable (zero-argument) to be invoked when
-                twill script starts execution
-            :param on_end: Callable (zero-argument) to be invoked when twill
-                script finishes execution (disregarding status)
+            :param writer: `StatusWriter` storing results of the runs. If not given,
+                the worker stores them itself.
+            :param board: `StatusBoard` to write the state of the runs to
+            :param lanes: Lanes of the board used by the worker, one for each
+                script it may run at once (``workers.concurrency``)
         """
         twillmanager.async.Worker.__init__(self, queue)
-        self.id = id
+        self.slot = slot
         self.config = config
-        self.watch = None
-        self.connection = None
-        self.on_start = on_start
-        self.on_end = on_end
+        self.engine = None
+        self.writer = writer
+        self.run_timeout = float(config.get('workers.run_timeout', 300))
+        self.cpu_limit = config.get('workers.cpu_limit', None)
+        self.memory_limit = config.get('workers.memory_limit', None)
+        self.board = board
+        self.lanes = lanes
+        # scripts may be run by several threads of the engine at once,
+        # each of them has its own watch and database connection
+        self._local = threading.local()
+        self.free_lanes = None
+        self.next_lane = None # lane taken for the next job (see `next_command`)
+        # interrupts the runs cancelled by the manager
+        self.watchdog = Watchdog()
+
+    def _get_watch(self):
+        return getattr(self._local, 'watch', None)
+
+    def _set_watch(self, watch):
+        self._local.watch = watch
+
+    watch = property(_get_watch, _set_watch, doc="The watch being run by current thread")
+
+    def _get_connection(self):
+        # the threads live as long as the worker, so they don't take connections from the pool
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = create_db_connection(self.config)
+        return self._local.connection
+
+    def _set_connection(self, connection):
+        self._local.connection = connection
+
+    connection = property(_get_connection, _set_connection, doc="Database connection of current thread")
 
     def main(self):
         """ Process main function """
         # to make sure we do not use inherited descriptor
         # from the parent process
         close_db_connection()
-        self.connection = get_db_connection(self.config)
-        self.watch = Watch.load(self.id, self.connection)
-
-
-        if self.watch:
-            logger.info("Starting worker for watch `%s` (id: %s)" % (self.watch.name, self.id))
-            self.tick_interval = self.watch.interval
-            twillmanager.async.Worker.main(self)
-        else:
-            logger.warn("Failed to start worker for watch (id: %s) - no such watch" % self.id)
-
-    def tick(self):
-        """ Executed every self.watch.interval seconds """
-        self.execute()
+        if self.memory_limit:
+            set_memory_limit(int(self.memory_limit))
+        self.engine = twillmanager.engine.create_engine(self.config)
+        if self.board is not None:
+            self.free_lanes = Queue.Queue(0)
+            for lane in self.lanes:
+                self.free_lanes.put(lane)
+        if self.engine or self.board is not None:
+            self.watchdog.start()
+        if self.engine and self.cpu_limit:
+            logger.warn("workers.cpu_limit is not enforced when scripts are run in threads (workers.concurrency > 1)")
+        self.connection = create_db_connection(self.config)
+        # all scripts run by the worker share SSL contexts
+        twill.set_ssl_context_factory(functools.partial(create_ssl_context, self.config))
+
+        logger.info("Starting worker (slot: %s)" % self.slot)
+        twillmanager.async.Worker.main(self)
 
     def quit(self):
         self.running = False
+        if self.engine:
+            self.engine.join()
+        self.watchdog.stop()
+
+    def next_command(self):
+        """ Takes the next command from the queue - once there is a free lane of
+            the board for it, so that a watch taken from the queue is claimed
+            on the board at once (see `execute`), and isn't lost if the worker dies.
+        """
+        if self.free_lanes is not None and self.next_lane is None:
+            self.next_lane = self.free_lanes.get()
+        return twillmanager.async.Worker.next_command(self)
 
+    def execute(self, id):
+        """ Runs the script of the watch with given id (in the background, if
+            the worker uses an engine running several scripts at once).
+        """
+        lane = None # lane of the status board (if the worker writes to one)
+        if self.free_lanes is not None:
+            lane, self.next_lane = self.next_lane, None
+            if lane is None:
+                lane = self.free_lanes.get()
+            self.board.claim(lane, id)
+        if self.engine:
+            self.engine.spawn(self.run, id, lane)
+        else:
+            self.run(id, lane)
 
-    def execute(self):
-        """ Called by `tick` and when `execute` schedules immediate script execution."""
-        try: # large try block to ensure on_end is called
-            if self.on_start:
-                self.on_start()
+    def run(self, id, lane=None):
+        """ Runs the script of the watch with given id and updates its status.
+            Unless the result is stored, the run is reported abandoned to the writer.
 
-            new_status, output = self.execute_script()
+            :param lane: Lane of the status board claimed for the run (see `execute`)
+        """
+        self.watch = None
+        start = None
+        stored = False
+        try: # large try block to ensure the end of the run is reported
+            self.watch = Watch.load(id, self.connection)
+            if not self.watch:
+                logger.warn("Failed to run watch (id: %s) - no such watch" % id)
+                return
+
+            start = time.time()
+            cancelled = None
+            if lane is not None:
+                self.board.start(lane, id, start)
+                cancelled = functools.partial(self.board.is_cancelled, lane, start)
+            new_status, output, journeys, failing_line = self.execute_script(cancelled)
+            if cancelled and cancelled():
+                # restarted by the manager - the result is dropped
+                logger.info("Run of watch `%s` (id: %s) was cancelled" % (self.watch.name, id))
+                return
 
             old_status = self.watch.status
             self.watch.status = new_status
             self.watch.time = time.time()
-            self.watch.update_status(self.connection)
+            self.watch.duration = self.watch.time - start
 
-            msg = "Status for watch `%s` (id: %s): %s" % (self.watch.name, self.id, new_status)
+            msg = "Status for watch `%s` (id: %s): %s" % (self.watch.name, id, new_status)
 
             if new_status != STATUS_OK:
                 logger.warn(msg)
             else:
                 logger.info(msg)
+            for journey in journeys:
+                logger.debug("Watch `%s` (id: %s) loaded %s" % (self.watch.name, id, format_journey(journey)))
+
+            run = Run(id, start, self.watch.duration, new_status, failing_line,
+                      [format_step(journey) for journey in journeys])
 
             # when was last e-mail alert sent
             if self.watch.last_alert is None:
@@ -288,40 +620,118 @@ class Worker(twillmanager.async.Worker):
                 last_alert_was_long_ago = False
 
 
-            if status_has_changed or (last_alert_was_long_ago and new_status == STATUS_FAILED):
-                logger.info("Sending notification for watch `%s` (id: %s)" % (self.watch.name, self.id))
-                self.status_notify(old_status, new_status, output)
-                self.watch.last_alert = time.time()
-                self.watch.update_status(self.connection)
+            if status_has_changed or (last_alert_was_long_ago and new_status in FAILING_STATUSES):
+                logger.info("Sending notification for watch `%s` (id: %s)" % (self.watch.name, id))
+                mail_start = time.time()
+                try:
+                    if self.status_notify(old_status, new_status, output) and lane is not None:
+                        self.board.record_mail(lane, time.time() - mail_start)
+                    self.watch.last_alert = time.time()
+                except Exception, e:
+                    if lane is not None:
+                        self.board.record_mail(lane, time.time() - mail_start, failed=True)
+                    logger.error("Failed to send notification for watch `%s` (id: %s): %s" % (self.watch.name, id, e))
+
+            # the end of the run is written to the board before the result
+            # is stored (see `WorkerSet.read_board`)
+            if lane is not None:
+                self.board.finish(lane, id, STATUSES.index(new_status), self.watch.time, self.watch.duration)
+            # status and alert time are stored at once
+            self.store_result(run)
+            stored = True
         except Exception, e:
-            logger.error("Worker `%s` (id: %s) failed with exception: %s" % (self.watch.name, self.id, e.message))
-            raise
+            # the worker is shared by all watches, so a failure of one
+            # of them must not take it down
+            logger.error("Worker (slot: %s) failed running watch `%s` (id: %s) with exception: %s"
+                         % (self.slot, self.watch and self.watch.name, id, e))
         finally:
-            if self.on_end:
-                self.on_end()
-
-    def execute_script(self):
-        """ Executes twill script. Returns a tuple status, output """
+            if lane is not None:
+                if start is None:
+                    self.board.unclaim(lane)
+                elif not stored:
+                    self.board.finish(lane, id, -1, time.time(), 0.0)
+                self.free_lanes.put(lane)
+            if not stored and self.writer:
+                self.writer.abandon(id)
+
+    def store_result(self, run):
+        """ Stores the status of the watch and the run in its history
+            (through the writer, if the worker has one)
+        """
+        result = (self.watch.id, self.watch.status, self.watch.time, self.watch.duration, self.watch.last_alert, run)
+        if self.writer:
+            self.writer.put(result)
+        else:
+            apply_results(self.connection, [result])
+
+    def script_timeout(self):
+        """ How long (seconds) the script of the watch may run (None: no limit) """
+        if self.watch.timeout:
+            return self.watch.timeout
+        return self.run_timeout or None
+
+    def execute_script(self, cancelled=None):
+        """ Executes twill script. Returns a tuple status, output, journeys
+            (timings of the pages loaded, see `twill.browser.TwillBrowser.journeys`),
+            failing line (number of the script line that failed, counted from 1,
+            or None)
+
+            The script times out after `script_timeout` seconds, and is interrupted
+            if it doesn't time out by itself (see `twillmanager.limits`). Scripts
+            run by the main thread of the worker (with no engine) are also
+            interrupted if they use more than ``workers.cpu_limit`` seconds of CPU time.
+
+            :param cancelled: Callable returning whether the run was cancelled;
+                the script is interrupted then (see `twillmanager.limits.Watchdog`)
+        """
         out = StringIO()
+        # each run gets its own browser, namespaces and output
+        context = twill.TwillContext(out=out, err=out)
+        timeout = self.script_timeout()
+        if timeout:
+            context.deadline = time.time() + timeout
         # execute the twill, catching any exceptions
         try:
-            twill.set_errout(out)
-            twill.set_output(out)
-            twill.parse._execute_script(self.watch.script.split("\n"))
+            # scripts are parsed once and then cached by their hash
+            compiled = twill.parse.compile_string(self.watch.script)
+            # signals reach only the main thread, the watchdog ends scripts run by the engine
+            with self.watchdog.guard(context, cancelled, context.deadline if self.engine else None):
+                if self.engine:
+                    twill.parse.execute_compiled(compiled, context=context)
+                else:
+                    with script_limits(timeout, self.cpu_limit and float(self.cpu_limit)):
+                        twill.parse.execute_compiled(compiled, context=context)
             status = STATUS_OK
+            failing_line = None
         except Exception, e:
-            status = STATUS_FAILED
+            # socket operations fail in various ways when the deadline passes
+            timed_out = context.remaining() is not None and context.remaining() <= 0
+            # a cancelled script may also fail on its aborted requests first
+            if isinstance(e, ScriptCancelled) or (cancelled and cancelled()):
+                status = STATUS_FAILED
+                out.write("\nScript cancelled\n")
+            elif isinstance(e, ScriptTimeout):
+                status = STATUS_TIMEOUT
+                out.write("\n%s\n" % e)
+            elif isinstance(e, TwillTimeout) or timed_out:
+                status = STATUS_TIMEOUT
+                out.write("\nScript timed out after %s seconds\n" % timeout)
+            else:
+                status = STATUS_FAILED
+            failing_line = context.lineno is not None and context.lineno + 1 or None
         finally:
-            twill.commands.reset_error()
-            twill.commands.reset_output()
-        return status, out.getvalue()
+            journeys = context.get_browser().journeys
+            context.close()
+        return status, out.getvalue(), journeys, failing_line
 
     def status_notify(self, old_status, new_status, message):
-        """ Sends out notifications about watch status change """
+        """ Sends out notifications about watch status change.
+            Returns whether there was anyone to notify.
+        """
         recipients = self.watch.emails
 
         if not recipients:
-            return
+            return False
 
         # strip
         recipients = [r.strip() for r in recipients.split(',')]
@@ -329,7 +739,7 @@ class Worker(twillmanager.async.Worker):
         recipients = [r for r in recipients if r]
 
         if len(recipients) == 0:
-            return
+            return False
 
         sender = self.config['mail.from']
 
@@ -342,133 +752,649 @@ class Worker(twillmanager.async.Worker):
 
         mailer = twillmanager.mail.create_mailer(self.config)
         mailer.send_mail(sender, recipients, subject, body)
+        return True
         
 
 class WorkerSet(object):
-    """ Object managing spawning of workers."""
-    def __init__(self, config):
-        """ Create a new `WorkerSet`.
+    """ Object managing the schedule of watches and the pool of worker processes.
+
+        All the watches are kept in a single `Scheduler`. When a watch becomes
+        due, its id is put into the job queue shared by a fixed number
+        (``workers.pool_size`` config option) of worker processes, so the
+        resources used don't depend on the number of watches.
+
+        Operations that may take long (loading watches, restarting worker processes)
+        are done by the manager thread - the methods called by the dashboard only
+        queue commands for it. Scheduling flags of the watches are read from a
+        snapshot, without waiting for the lock.
+
+        The workers report starts of the runs on a shared-memory status board
+        (see `twillmanager.board`); their ends are noticed when the results
+        are stored by the status writer, so a watch isn't run again before
+        the result of its previous run is stored.
+    """
+    def __init__(self, config, clock=time.time):
+        """ Create a new `WorkerSet` (see `start`).
 
             :param config: Configuration dict to be passed to spawned workers
+            :param clock: Zero-argument callable returning current time (in seconds)
         """
         # synchronization between threads (WorkerSet is used from CherryPy)
         self._lock = threading.RLock()
-        self.workers = {}
+        self.clock = clock
+        self.scheduler = Scheduler(clock, jitter=float(config.get('scheduler.jitter', 0.0)))
         self.now_building = {}
+        self.pending = set() # ids of watches queued or running in the pool
+        # id -> (alive, building, quarantined) - entries are replaced under
+        # the lock, but read without locking (see `worker_status_dict`)
+        self.flags = {}
         self.config = config
+        # how long workers may take to exit when asked to (see `stop_workers`)
+        self.stop_timeout = float(config.get('workers.stop_timeout', 10))
+        # how long terminated (SIGTERM) workers may take to exit before they're killed (SIGKILL)
+        self.kill_timeout = float(config.get('workers.kill_timeout', 5))
+        self.terminated = {} # slot -> (`WorkerProxy` terminated by the manager thread, time to kill it)
+        self.cancelled = {} # lane -> (start time of the run cancelled in it, time it must have ended by)
+
+        # workers that die soon after they're started are restarted with
+        # exponentially growing delays (``workers.restart_delay`` doubled after
+        # each failure, up to ``workers.max_restart_delay`` seconds)
+        self.restart_delay = float(config.get('workers.restart_delay', 1))
+        self.max_restart_delay = float(config.get('workers.max_restart_delay', 60))
+        # a watch is quarantined (not run until restarted, edited or checked
+        # by the user) when that many workers in a row died while running it
+        self.quarantine_after = int(config.get('workers.quarantine_after', 3))
+        self.restart_times = {} # slot -> time the (dead) worker is to be started again
+        self.started_times = {} # slot -> time the worker was started
+        self.failures = {} # slot -> number of times in a row the worker died soon after start
+        self.worker_restarts = 0 # total number of workers restarted after they died
+        self.crashes = {} # id -> number of workers in a row that died running the watch
+        self.restarts = {} # id -> total number of workers that died running the watch
+        self.quarantined = set()
+        # statuses of the watches, as served to the dashboard
+        self.status_table = StatusTable()
+        # changes of the statuses are also pushed to subscribers
+        self.events = EventHub(int(config.get('events.buffer_size', 100)),
+                               int(config.get('events.max_subscribers', 100)))
+
+        # the only writer of results of the runs; the manager thread is told
+        # about ends of the runs when their results are stored
+        self.writer = StatusWriter(config, on_result=self.run_ended)
+
+        self.pool_size = int(config.get('workers.pool_size', 4))
+        self.concurrency = int(config.get('workers.concurrency', 1))
+        self.job_queue = multiprocessing.Queue(0)
+
+        # the workers write the state of their runs (the watches they run) to
+        # the board, read by the manager thread (see `read_board`) - it must be
+        # created before the workers and the template are forked
+        self.board = StatusBoard(self.pool_size * self.concurrency)
+        self.started_runs = {} # lane -> (id, start time) of the run last seen running in it
+        self.planned = {} # id -> time the queued run of the watch was planned for
+        self.metrics = Metrics(self.status_table)
+
+        # thread that dispatches due watches to the pool, checks for workers
+        # that died unexpectedly and follows their runs on the board. Other threads
+        # tell it what to do with commands (see `queue_command`), ringing the board
+        self.commands = collections.deque()
+        self.closing = False
+        self.manager_thread = None
+        self.exit_threads = [] # threads waiting for the workers to exit (see `start_worker`)
+        self.next_liveness_check = 0
+
+        self.template = None
+        self.workers = [None] * self.pool_size
+
+    def start(self):
+        """ Starts the workers, the status writer and the manager thread """
+        # workers are forked from a template process, forked before any threads are started
+        if self.config.get('workers.template', True):
+            self.template = TemplateProcess(self.make_worker)
+            self.template.start()
+
+        self.writer.start()
+        for slot in xrange(self.pool_size):
+            self.start_worker(slot)
 
-        # thread that checks for workers that died unexpectedly
-        # and listens to their status update messages
-        # only tuples (command, argument) should be put into that queue.
-        self.manager_thread_queue = multiprocessing.Queue(0)
         self.manager_thread = threading.Thread(target=self.manager_thread_main)
         self.manager_thread.daemon = True
         self.manager_thread.start()
 
+    def queue_command(self, command, argument=None):
+        """ Queues a command for the manager thread (see `manager_thread_main`).
+            Commands queued once the set is closing (see `finish`) are dropped.
+        """
+        if self.closing:
+            return
+        self.commands.append((command, argument))
+        self.board.ring()
+
     def worker_status_dict(self, id):
-        with self._lock:
-            return {'alive': self.is_alive(id), 'building': self.is_building(id)}
+        alive, building, quarantined = self.flags.get(id, (False, False, False))
+        return {'alive': alive, 'building': building, 'quarantined': quarantined}
 
-    def get(self, id):
-        return self.workers.get(id, None)
+    def worker_stats(self):
+        """ Statistics of worker restarts and live state of the runs (read from the
+            status board) as dictionary
+        """
+        now = self.clock()
+        lanes = []
+        for lane, entry in enumerate(self.board.snapshot()):
+            if entry is None:
+                continue
+            lanes.append({'slot': lane // self.concurrency,
+                          'watch_id': entry.watch_id or None,
+                          'running_for': now - entry.started if entry.state == RUNNING else None,
+                          'runs': entry.runs,
+                          'last_status': STATUSES[entry.status] if entry.runs and entry.status >= 0 else None,
+                          'last_duration': entry.duration if entry.runs else None})
+        with self._lock:
+            return {'restarts': self.worker_restarts,
+                    'restarting': dict((str(slot), max(restart_time - now, 0))
+                                       for slot, restart_time in self.restart_times.iteritems()),
+                    'watch_restarts': dict((str(id), count) for id, count in self.restarts.iteritems()),
+                    'quarantined': sorted(self.quarantined),
+                    'busy': len([lane for lane in lanes if lane['running_for'] is not None]),
+                    'lanes': lanes}
+
+    def update_status_table(self, id, fields=None, event='update'):
+        """ Updates the status of a watch known to the status table
+            (given fields and scheduling flags) and publishes the event
+            (with the new status) to the subscribers of ``events``.
+
+            ``update`` events are published only if the status has changed,
+            other ones (``add``, ``start`` and ``end`` of runs) always.
+        """
+        with self._lock:
+            if id in self.scheduler or id in self.now_building or id in self.quarantined:
+                self.flags[id] = (id in self.scheduler, self.now_building.get(id, False), id in self.quarantined)
+            else:
+                self.flags.pop(id, None)
+            if id in self.status_table:
+                fields = dict(fields or {})
+                fields.update(self.worker_status_dict(id))
+                if self.status_table.update(id, fields) or event != 'update':
+                    self.events.publish(event, self.status_table.get(id))
 
     def finish(self):
         """ Call this to clean up when the application is shut down """
-        self.manager_thread_queue.put(('quit', None))
-        self.manager_thread.join()
+        self.status_table.close()
+        self.events.close()
+        if self.manager_thread is not None:
+            self.queue_command('quit')
+            self.manager_thread.join()
+        # exits of the workers stopped now are not handled anymore
+        self.closing = True
+        if self.manager_thread is not None:
+            self.stop_workers()
+            if self.template is not None:
+                self.template.stop()
+            self.writer.stop()
+        self.board.close()
+
+    def stop_workers(self):
+        """ Asks the workers to quit and waits for them up to ``workers.stop_timeout``
+            seconds. Workers still running after that are terminated (SIGTERM),
+            and killed (SIGKILL) if they don't exit within ``workers.kill_timeout`` seconds.
+            Then waits (up to a second) for the threads noticing their exits.
+        """
+        started = [worker for worker in self.workers if worker is not None]
+        workers = started + [worker for worker, kill_time in self.terminated.values()]
+        # runs that haven't started yet are dropped
+        try:
+            while True:
+                self.job_queue.get_nowait()
+        except Queue.Empty:
+            pass
+        for worker in started:
+            self.job_queue.put(('quit', ()))
+        for timeout, stop in [(self.stop_timeout, WorkerProxy.terminate),
+                              (self.kill_timeout, WorkerProxy.kill)]:
+            deadline = time.time() + timeout
+            for worker in workers:
+                worker.join(max(deadline - time.time(), 0))
+            workers = [worker for worker in workers if worker.is_alive()]
+            for worker in workers:
+                logger.warn("Worker (slot: %s) did not exit in time, stopping it" % worker.slot)
+                stop(worker)
+        for worker in workers:
+            worker.join(1)
+        # processes started by a worker may keep its end of the pipe open
+        # (and the thread waiting) longer
+        deadline = time.time() + 1
+        with self._lock:
+            threads = list(self.exit_threads)
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
 
     def is_alive(self, id):
-        """ Check if worker with given id is alive """
-        with self._lock:
-            return id in self.workers and self.workers[id].is_alive()
+        """ Check if watch with given id is scheduled """
+        return self.worker_status_dict(id)['alive']
 
     def is_building(self, id):
-        """ Check if worker with given id is currently building"""
-        with self._lock:
-            return self.now_building.get(id, False)
+        """ Check if watch with given id is currently building"""
+        return self.worker_status_dict(id)['building']
+
+    def is_quarantined(self, id):
+        """ Check if watch with given id is not run, because it crashed workers """
+        return self.worker_status_dict(id)['quarantined']
 
     def check_now(self, id):
-        """ Tell the worker with given id to check immediately.
-            This also restarts the worker if it died.
+        """ Tell the pool to check watch with given id immediately.
+            This also schedules the watch if it was stopped.
+
+            The watch is dispatched by the manager thread, this method returns at once.
         """
-        with self._lock:
-            self.restart(id)
-            self.now_building[id] = True
-            self.workers[id].execute()
+        self.queue_command('check_now', id)
+
+    def reload(self, id):
+        """ Reads the watch with given id (changed in the database) again and
+            reschedules it in place (see `Scheduler.change_interval`).
+            This also schedules the watch if it was stopped.
+
+            The watch is reloaded by the manager thread, this method returns at once.
+        """
+        self.queue_command('reload', id)
+
+    def reschedule(self, ids):
+        """ Schedules given watches again, e.g. after their definitions were changed
+            (the first runs of all of them are spread like in `add_all`).
+
+            The watches are rescheduled by the manager thread, this method returns at once.
+        """
+        self.queue_command('reschedule', list(ids))
 
     def restart(self, id):
-        """ Restarts given worker. """
+        """ Reschedules given watch. If it's being run, the run is cancelled
+            (see `cancel_run`).
+
+            The watch is restarted by the manager thread, this method returns at once.
+        """
+        self.queue_command('restart', id)
+
+    def cancel_run(self, id):
+        """ Cancels the run of watch with given id in progress (if there is one):
+            the worker running it interrupts the script and drops its result.
+            If the run doesn't end in ``workers.stop_timeout`` seconds, the worker
+            is terminated - provided it runs one script at a time, otherwise
+            the run is left to finish (it would take the other runs down).
+            Called by the manager thread.
+        """
         with self._lock:
-            self.remove(id)
-            self.add(id)
+            for lane, entry in enumerate(self.board.snapshot()):
+                if entry is not None and entry.state == RUNNING and entry.watch_id == id:
+                    logger.info("Cancelling run of watch (id: %s) in worker (slot: %s)" % (id, lane // self.concurrency))
+                    self.board.cancel(lane, entry.started)
+                    self.cancelled[lane] = (entry.started, self.clock() + self.stop_timeout)
+
+    def check_cancelled(self):
+        """ Handles the cancelled runs that didn't end in time (see `cancel_run`).
+            Called by the manager thread.
+        """
+        with self._lock:
+            for lane, (started, end_time) in self.cancelled.items():
+                if end_time > self.clock():
+                    continue
+                del self.cancelled[lane]
+                entry = self.board.read(lane)
+                if entry is None or entry.state != RUNNING or entry.started != started:
+                    continue # ended
+                if self.concurrency == 1:
+                    logger.warn("Cancelled run of watch (id: %s) did not end in time, terminating its worker" % entry.watch_id)
+                    self.terminate_worker(lane // self.concurrency)
+                else:
+                    logger.warn("Cancelled run of watch (id: %s) did not end in time, leaving it to finish" % entry.watch_id)
+
+    def terminate_worker(self, slot):
+        """ Terminates (SIGTERM) the worker in given slot. Its watch is considered
+            finished when the process exits, it's killed (SIGKILL) if it doesn't
+            in ``workers.kill_timeout`` seconds. Called by the manager thread
+            (only for workers running one script at a time, see `cancel_run`).
+        """
+        with self._lock:
+            worker = self.workers[slot]
+            if slot not in self.terminated and worker.is_alive():
+                logger.info("Terminating worker (slot: %s)" % slot)
+                worker.terminate()
+                self.terminated[slot] = (worker, self.clock() + self.kill_timeout)
 
     def add(self, id):
-        """ Adds worker for watch with given id.
-            
-            It is safe to call this method even if the worker is already running.
+        """ Schedules watch with given id.
+
+            It is safe to call this method even if the watch is already scheduled.
         """
         with self._lock:
-            if id in self.workers:
+            if id in self.scheduler:
                 return
 
-            def on_start():
-                self.manager_thread_queue.put(('start', id))
+            watch = Watch.load(id, get_db_connection(self.config), Watch.LIST_COLUMNS)
+            if not watch:
+                logger.warn("Failed to schedule watch (id: %s) - no such watch" % id)
+                return
 
-            def on_end():
-                self.manager_thread_queue.put(('end', id))
+            self.scheduler.add(id, watch.interval)
+            self.now_building.setdefault(id, False)
+            self.status_table.update(id, watch.dict())
+            self.update_status_table(id, event='add')
 
-            worker = WorkerProxy(id, self.config)
-            worker.set_twill_callbacks(on_start, on_end)
-            
-            self.workers[id] = worker
-            self.now_building[id] = False
-            worker.start(True)
+        # the manager thread may be sleeping until a later deadline
+        self.queue_command('wakeup')
+
+    def add_all(self, ids):
+        """ Schedules watches with given ids. Unless the ``scheduler.spread_startup``
+            config option is off, their first runs are spread evenly over their intervals.
+        """
+        # the watches are loaded before taking the lock (there may be many of them)
+        connection = get_db_connection(self.config)
+        watches = []
+        for id in ids:
+            watch = Watch.load(id, connection, Watch.LIST_COLUMNS)
+            if not watch:
+                logger.warn("Failed to schedule watch (id: %s) - no such watch" % id)
+                continue
+            watches.append(watch)
+
+        with self._lock:
+            ids_and_intervals = []
+            for watch in watches:
+                if watch.id in self.scheduler:
+                    continue
+                ids_and_intervals.append((watch.id, watch.interval))
+                self.now_building.setdefault(watch.id, False)
+                self.status_table.update(watch.id, watch.dict())
+
+            if self.config.get('scheduler.spread_startup', True):
+                self.scheduler.add_spread(ids_and_intervals)
+            else:
+                for id, interval in ids_and_intervals:
+                    self.scheduler.add(id, interval)
+
+            for id, interval in ids_and_intervals:
+                self.update_status_table(id, event='add')
+
+        self.queue_command('wakeup')
 
     def remove(self, id):
-        """ Removes worker for watch with given id.
+        """ Removes watch with given id from the schedule.
+            A run that is already in progress is allowed to finish.
+
+            It is safe to call this method even if the watch is not scheduled.
+        """
+        with self._lock:
+            self.scheduler.remove(id)
+            if id not in self.pending:
+                self.now_building.pop(id, None)
+            self.update_status_table(id)
+
+    def delete(self, id):
+        """ Removes watch with given id (deleted from the database) from the schedule
+            and the status table.
+        """
+        with self._lock:
+            self.remove(id)
+            self.release(id)
+            self.flags.pop(id, None)
+            self.planned.pop(id, None)
+            self.status_table.remove(id)
+            self.metrics.remove(id)
+            self.events.publish('delete', {'id': id})
+
+    def dispatch(self, id, planned=None):
+        """ Puts watch with given id into the job queue, unless it's already there
+            or being run (runs of a single watch never overlap).
+
+            :param planned: Time the run was planned for (default: now)
+        """
+        with self._lock:
+            if id in self.pending:
+                return
+            self.pending.add(id)
+            self.planned[id] = planned or self.clock()
+            self.job_queue.put(('execute', (id,)))
+
+    def lanes(self, slot):
+        """ Lanes of the status board used by the worker in given pool slot """
+        return range(slot * self.concurrency, (slot + 1) * self.concurrency)
+
+    def create_worker_proxy(self, slot):
+        """ Creates a (not started) proxy of the worker for given pool slot """
+        return WorkerProxy(slot, self.config, self.job_queue, self.writer, self.template,
+                           self.board, self.lanes(slot))
+
+    def make_worker(self, slot):
+        """ Creates the `Worker` for given pool slot (called by the template process) """
+        return self.create_worker_proxy(slot).make_worker(self.job_queue)
 
-            It is safe to call this method even if the worker is not running.
+    def start_worker(self, slot):
+        """ Starts a worker process in given pool slot """
+        with self._lock:
+            worker = self.create_worker_proxy(slot)
+            self.workers[slot] = worker
+            worker.start(True)
+            self.started_times[slot] = self.clock()
+
+        # the manager thread is told at once when the worker exits
+        def wait_for_exit():
+            worker.wait()
+            self.queue_command('exited', (slot, worker.process.pid))
+        thread = threading.Thread(target=wait_for_exit)
+        thread.daemon = True
+        thread.start()
+        with self._lock:
+            self.exit_threads = [t for t in self.exit_threads if t.is_alive()] + [thread]
+
+    def release(self, id):
+        """ Releases the watch from quarantine, forgetting its crashes """
+        with self._lock:
+            self.quarantined.discard(id)
+            self.crashes.pop(id, None)
+
+    def worker_exited(self, slot, pid):
+        """ Handles exit of a worker process. The worker is started again, at once
+            if it was terminated or had been running for a while - otherwise
+            with a delay growing exponentially with the number of such failures.
+            The watches it was running, or had taken from the job queue, may be
+            dispatched again. Called by the manager thread.
         """
         with self._lock:
-            if id in self.workers:
-                worker = self.workers[id]
-                worker.quit()
-                del self.workers[id]
-                del self.now_building[id]
-                if worker.process:
-                    worker.process.join()
+            terminated, kill_time = self.terminated.get(slot, (None, None))
+            if terminated is not None and terminated.process.pid == pid:
+                del self.terminated[slot]
+            worker = self.workers[slot]
+            if worker.process.pid != pid or slot in self.restart_times:
+                return # handled already
+            worker.join()
+
+            for lane in self.lanes(slot):
+                self.cancelled.pop(lane, None)
+                entry = self.board.reset(lane)
+                if entry.state == IDLE:
+                    continue
+                id = entry.watch_id
+                self.pending.discard(id)
+                if entry.state == CLAIMED:
+                    # taken from the queue, but not run - not the watch's fault
+                    logger.warn("Worker (slot: %s) died before running watch (id: %s)" % (slot, id))
+                elif terminated is None:
+                    logger.warn("Worker (slot: %s) died while running watch (id: %s)" % (slot, id))
+                    self.crashes[id] = self.crashes.get(id, 0) + 1
+                    self.restarts[id] = self.restarts.get(id, 0) + 1
+                    if self.crashes[id] >= self.quarantine_after and id in self.scheduler:
+                        logger.error("Watch (id: %s) crashed %d workers in a row, quarantining it" % (id, self.crashes[id]))
+                        self.quarantined.add(id)
+                        self.scheduler.remove(id)
+                if id in self.scheduler:
+                    self.now_building[id] = False
+                else:
+                    self.now_building.pop(id, None)
+                self.update_status_table(id, {'restarts': self.restarts.get(id, 0)})
 
-    def manager_thread_main(self):
-        """ Checks for workers that died unexpectedly and listens to their
-            status update messages.
+            if terminated is not None or self.clock() - self.started_times[slot] >= self.max_restart_delay:
+                self.failures[slot] = 0
+                delay = 0
+            else:
+                logger.warn("Worker (slot: %s) died %.1fs after it was started" % (slot, self.clock() - self.started_times[slot]))
+                self.failures[slot] = self.failures.get(slot, 0) + 1
+                delay = min(self.restart_delay * 2 ** (self.failures[slot] - 1), self.max_restart_delay)
+            if terminated is None:
+                self.worker_restarts += 1
+            self.restart_times[slot] = self.clock() + delay
+
+    def run_ended(self, id, result):
+        """ Called (by the writer thread) when the result of a run is stored """
+        fields = {}
+        if result is not None:
+            id, status, check_time, duration, last_alert, run = result
+            fields = {'status': status, 'time': format_time(check_time), 'duration': format_duration(duration)}
+            self.metrics.run_ended(id, status, duration, run and run.steps or [])
+        self.queue_command('end', (id, fields))
+
+    def read_board(self):
+        """ Notices the runs started by the workers since the board was read last.
+
+            The end of each run is written to the board before its result is
+            stored, so a run seen running hasn't been reported to `run_ended` yet.
         """
-        while True:
-            # wait up to 60 seconds
-            try:
-                command, argument = self.manager_thread_queue.get(True, 60)
-
-                if command == 'quit':
-                    break
-                elif command == 'start':
-                    with self._lock:
-                        self.now_building[argument] = True
-                elif command == 'end':
-                    with self._lock:
-                        self.now_building[argument] = False
+        with self._lock:
+            for lane, entry in enumerate(self.board.snapshot()):
+                if entry is None or entry.state != RUNNING:
+                    continue
+                run = (entry.watch_id, entry.started)
+                if self.started_runs.get(lane) == run:
+                    continue
+                self.started_runs[lane] = run
+                id = entry.watch_id
+                planned = self.planned.pop(id, None)
+                if planned is not None:
+                    self.metrics.run_started(entry.started - planned)
+                if id in self.scheduler:
+                    self.now_building[id] = True
+                self.update_status_table(id, event='start')
+
+    def execute_command(self, command, argument):
+        """ Executes a command queued by `queue_command`. Called by the manager thread. """
+        if command == 'wakeup':
+            pass
+        elif command == 'exited':
+            self.worker_exited(*argument)
+        elif command == 'check_now':
+            id = argument
+            with self._lock:
+                self.release(id)
+                self.add(id)
+                if id in self.scheduler:
+                    self.now_building[id] = True
+                    self.dispatch(id)
+                    self.update_status_table(id)
+        elif command == 'restart':
+            id = argument
+            with self._lock:
+                self.cancel_run(id)
+                self.release(id)
+                self.remove(id)
+                self.add(id)
+        elif command == 'reschedule':
+            ids = argument
+            with self._lock:
+                for id in ids:
+                    self.remove(id)
+            self.add_all(ids)
+        elif command == 'reload':
+            id = argument
+            watch = Watch.load(id, get_db_connection(self.config), Watch.LIST_COLUMNS)
+            with self._lock:
+                self.release(id)
+                if not watch:
+                    logger.warn("Failed to reload watch (id: %s) - no such watch" % id)
+                elif id in self.status_table:
+                    self.scheduler.change_interval(id, watch.interval)
+                    self.now_building.setdefault(id, False)
+                    self.update_status_table(id, watch.dict())
+                else:
+                    self.add(id)
+        elif command == 'end':
+            id, fields = argument
+            with self._lock:
+                self.pending.discard(id)
+                self.crashes.pop(id, None)
+                if id in self.scheduler:
+                    self.now_building[id] = False
                 else:
-                    logger.warn("Unknown command to manager thread: %s" % command)
+                    self.now_building.pop(id, None)
+                self.update_status_table(id, fields, event='end')
+        else:
+            logger.warn("Unknown command to manager thread: %s" % command)
 
-            except Queue.Empty:
-                pass
+    def next_deadline(self):
+        """ Time the manager thread has to act by, even if nothing wakes it up
+            (None if there is no such time)
+        """
+        with self._lock:
+            deadline = self.scheduler.next_deadline()
+
+            times = [kill_time for worker, kill_time in self.terminated.values()]
+            times.extend(self.restart_times.values())
+            times.extend([end_time for started, end_time in self.cancelled.values()])
+            if times:
+                deadline = min([deadline or times[0]] + times)
+        return deadline
+
+    def manage(self):
+        """ Executes queued commands, follows the runs on the status board,
+            dispatches due watches and checks for workers that died unexpectedly.
+            Returns False if told to quit. Called by the manager thread.
+        """
+        while self.commands:
+            command, argument = self.commands.popleft()
+            if command == 'quit':
+                return False
+            self.execute_command(command, argument)
 
-            # this one is to remove zombie processes
-            multiprocessing.active_children()
+        self.read_board()
+        self.check_cancelled()
 
-            with self._lock:
-                ids_to_restart = []
-                for id, worker in self.workers.items():
-                    if not worker.is_alive():
-                        ids_to_restart.append(id)
+        with self._lock:
+            for id, planned in self.scheduler.pop_due_times():
+                self.dispatch(id, planned)
+
+            for slot, (worker, kill_time) in self.terminated.items():
+                if kill_time <= self.clock() and worker.is_alive():
+                    logger.warn("Worker (slot: %s) did not exit when terminated, killing it" % slot)
+                    worker.kill()
+                    self.terminated[slot] = (worker, self.clock() + 1)
+
+            # exits are normally noticed at once (see `start_worker`), unless
+            # processes started by the worker keep its end of the pipe open
+            if self.clock() >= self.next_liveness_check:
+                self.next_liveness_check = self.clock() + 1
+                for slot, worker in enumerate(self.workers):
+                    if worker is not None and slot not in self.restart_times and not worker.is_alive():
+                        self.worker_exited(slot, worker.process.pid)
+
+            for slot, restart_time in self.restart_times.items():
+                if restart_time <= self.clock():
+                    del self.restart_times[slot]
+                    self.start_worker(slot)
+        return True
+
+    def manager_thread_main(self):
+        """ Waits for commands, changes of the status board or the next deadline,
+            and then does what's due (see `manage`), until told to quit.
+        """
+        running = True
+        while running:
+            deadline = self.next_deadline()
+
+            # wait up to 60 seconds
+            if deadline is None:
+                timeout = 60
+            else:
+                timeout = min(max(deadline - self.clock(), 0), 60)
+
+            if not self.commands:
+                self.board.wait(timeout)
 
-                for id in ids_to_restart:
-                    self.restart(id)
+            running = self.manage()
+
+        # the connection used to reload watches
+        close_db_connection()
@@ -6,58 +6,55 @@ import cherrypy
 from mako.lookup import TemplateLookup
 import os.path
 import simplejson
-
-from twillmanager.db import get_db_connection, create_tables
-from twillmanager.watch import WorkerSet, Watch
-
-def validate_twill_form(connection, data, watch=None):
-    """ Checks if data (dictionary) contains valid watch definition.
-        Returns a tuple (valid_dict, list of errors),
-        where valid_dict contains the successfully validated values
+import threading
+import time
+import urllib
+
+from twillmanager.db import get_db_connection, close_db_connection, create_tables, get_pool, query_stats
+from twillmanager.events import format_event
+from twillmanager.history import Run, summarize, MINUTE, HOUR, DAY
+import twillmanager.metrics
+from twillmanager.transfer import validate_twill_form, import_watches, FIELDS, FORMATS
+from twillmanager.watch import WorkerSet, Watch, decode_cursor
+
+def etag_matches(etag, if_none_match):
+    """ Whether the entity tag matches ``If-None-Match`` header of a request """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+def listing_query(config, status=None, name=None, failing_for=None, sort='name', after=None):
+    """ Converts parameters of a watch listing request to keyword arguments of
+        `Watch.load_page`. Raises `cherrypy.HTTPError` if they're invalid.
+
+        :param failing_for: Minimum number of seconds the watches have been failing for
     """
-    # no need for any fancy form handling library for this single form
-    valid_dict = {}
-    errors = []
-
-    name = data.get('name', '')
-    if not name:
-        errors.append(u"Watch name is missing")
-    else:
-        other_watch = Watch.load_by_name(name, connection)
-        if other_watch is not None and other_watch.id != watch.id:
-            errors.append(u"Watch with this name already exists")
-        else:
-            valid_dict['name'] = name
-
-    interval = data.get('interval', None)
-    if not interval:
-        errors.append(u"Interval is missing")
-    else:
+    query = {'status': status or None,
+             'name_prefix': name or None,
+             'limit': int(config.get('dashboard.page_size', 50))}
+    if sort not in Watch.SORTS:
+        raise cherrypy.HTTPError(400, "Invalid sort order: %s" % sort)
+    query['sort'] = sort
+    if failing_for:
         try:
-            valid_dict['interval'] = int(interval)
+            query['failing_since'] = time.time() - float(failing_for)
         except ValueError:
-            errors.append(u"Invalid number (interval)")
-
-    reminder_interval = data.get('reminder_interval', '').strip()
-    if reminder_interval:
+            raise cherrypy.HTTPError(400, "Invalid number: %s" % failing_for)
+    if after:
         try:
-            valid_dict['reminder_interval'] = int(reminder_interval)
-        except ValueError:
-            errors.append(u"Invalid number (reminder interval)")
-    else:
-        valid_dict['reminder_interval'] = None
-
-    script = data.get('script', None)
-    if not script or script.isspace():
-        errors.append(u"Script is missing")
-    else:
-        valid_dict['script'] = script
-
-    valid_dict['emails'] = data.get('emails', '')
+            decode_cursor(after)
+        except ValueError, e:
+            raise cherrypy.HTTPError(400, str(e))
+        query['after'] = after
+    return query
 
-    return valid_dict, errors
+# database connections of request threads are returned to the pool after each request
+cherrypy.tools.db_connection = cherrypy.Tool('on_end_request', close_db_connection)
 
 class Controller(object):
+    _cp_config = {'tools.db_connection.on': True}
+
     template_directory = os.path.normpath(os.path.join(os.path.dirname(__file__), 'templates'))
     template_lookup = TemplateLookup(directories=[template_directory], default_filters=['unicode', 'h'])
 
@@ -72,6 +69,7 @@ class DashboardController(Controller):
     def __init__(self):
         self.worker_set = None
         self.config = None
+        self.waiting_requests = None
 
     def finish(self):
         """ Call this to clean up when the application is shut down """
@@ -85,27 +83,194 @@ class DashboardController(Controller):
         self.config = cfg
         create_tables(get_db_connection(self.config))
 
+        # requests waiting for changes (event streams and long polls of statuses)
+        # hold a thread of the server each, so they may take only some of the threads
+        threads = int(cherrypy.config.get('server.thread_pool', 10))
+        self.waiting_requests = threading.BoundedSemaphore(
+            int(cfg.get('dashboard.max_waiting_requests', max(threads // 2, 1))))
+
         self.worker_set = WorkerSet(cfg)
-        for w in Watch.load_all(get_db_connection(self.config)):
-            self.worker_set.add(w.id)
+        self.worker_set.start()
+        self.worker_set.add_all([w.id for w in Watch.load_all(get_db_connection(self.config), ['id'])])
+        close_db_connection()
 
     @cherrypy.expose
-    def index(self):
-        watches = Watch.load_all(get_db_connection(self.config))
-        return self.render('index.html', watches=watches, worker_set=self.worker_set)
+    def index(self, **kwargs):
+        """ A page of watches, filtered and sorted as requested (see `listing_query`) """
+        query = listing_query(self.config, **kwargs)
+        # statuses changed after the page is rendered are polled by the page
+        version = self.worker_set.status_table.version
+        watches, next = Watch.load_page(get_db_connection(self.config), **query)
+        params = dict((k, v) for k, v in kwargs.iteritems() if v and k != 'after')
+        next_url = None
+        if next:
+            next_params = dict((k, unicode(v).encode('utf-8')) for k, v in params.iteritems())
+            next_params['after'] = next
+            next_url = cherrypy.url('/') + '?' + urllib.urlencode(next_params)
+        return self.render('index.html', watches=watches, worker_set=self.worker_set, version=version,
+                           params=params, next_url=next_url)
 
     @cherrypy.expose
-    def status(self):
-        watches = Watch.load_all(get_db_connection(self.config))
+    def watches(self, **kwargs):
+        """ A page of watches as JSON (see `listing_query`): statuses of the watches
+            and cursor of the next page, to be passed as ``after`` parameter
+        """
+        query = listing_query(self.config, **kwargs)
+        watches, next = Watch.load_page(get_db_connection(self.config), **query)
 
-        data = {}
+        data = []
         for watch in watches:
-            data[str(watch.id)] = watch.dict()
-            data[str(watch.id)].update(self.worker_set.worker_status_dict(watch.id))
+            status = watch.dict()
+            status.update(self.worker_set.worker_status_dict(watch.id))
+            status['interval'] = watch.interval
+            status['status_since'] = watch.status_since
+            data.append(status)
+
+        cherrypy.response.headers['Content-Type'] = "application/json"
+        return simplejson.dumps({'watches': data, 'next': next})
+
+    @cherrypy.expose
+    def status(self, since=None):
+        """ Statuses of all the watches, served from the status table of the worker set.
+
+            With `since` (a version of the table), returns only statuses changed after
+            that version, waiting up to ``status.poll_timeout`` seconds for a change
+            (see `twillmanager.status.StatusTable.changes`). Such requests are refused
+            (503) if ``dashboard.max_waiting_requests`` requests wait already.
+        """
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Invalid version: %s" % since)
+            timeout = float(self.config.get('status.poll_timeout', 30))
+            if not self.waiting_requests.acquire(False):
+                raise cherrypy.HTTPError(503, "Too many waiting requests")
+            try:
+                data = self.worker_set.status_table.changes(since, timeout)
+            finally:
+                self.waiting_requests.release()
+
+            cherrypy.response.headers['Cache-Control'] = "no-cache"
+            cherrypy.response.headers['Content-Type'] = "application/json"
+            return simplejson.dumps(data)
+
+        etag, data = self.worker_set.status_table.json()
+
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = "no-cache"
+        if etag_matches(etag, cherrypy.request.headers.get('If-None-Match')):
+            cherrypy.response.status = 304
+            return ''
+
+        cherrypy.response.headers['Content-Type'] = "application/json"
+        return data
+
+    @cherrypy.expose
+    def events(self):
+        """ Stream of events about the watches (Server-Sent Events): ``add``,
+            ``update``, ``start`` and ``end`` of runs (with the status of the watch,
+            as returned by `status`) and ``delete`` (with the id of the watch).
+
+            Clients that don't keep up with the events get a ``dropped`` event
+            and the stream ends. Streams count as waiting requests (see `status`).
+        """
+        if not self.waiting_requests.acquire(False):
+            raise cherrypy.HTTPError(503, "Too many waiting requests")
+        subscription = self.worker_set.events.subscribe()
+        if subscription is None:
+            self.waiting_requests.release()
+            raise cherrypy.HTTPError(503, "Too many subscribers")
+        heartbeat = float(self.config.get('events.heartbeat', 15))
+
+        cherrypy.response.headers['Content-Type'] = "text/event-stream"
+        cherrypy.response.headers['Cache-Control'] = "no-cache"
+
+        def stream():
+            try:
+                yield "retry: 5000\n\n"
+                while not subscription.closed:
+                    event = subscription.get(heartbeat)
+                    if event is not None:
+                        yield format_event(event)
+                    elif not subscription.closed:
+                        # lets the server notice disconnected clients
+                        yield ": keep-alive\n\n"
+                if subscription.dropped:
+                    yield "event: dropped\ndata: {}\n\n"
+            finally:
+                subscription.close()
+                self.waiting_requests.release()
+        return stream()
+    events._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def stats(self):
+        """ Statistics of the status writer (queue depth, commit latency), event subscribers,
+            the database (connection pool, times of queries) and restarts of workers
+        """
+        data = {'writer': self.worker_set.writer.stats(),
+                'workers': self.worker_set.worker_stats(),
+                'events': {'subscribers': len(self.worker_set.events),
+                           'dropped': self.worker_set.events.dropped},
+                'database': {'pool': get_pool(self.config).stats(),
+                             'queries': query_stats.dict()}}
 
         cherrypy.response.headers['Content-Type'] = "application/json"
         return simplejson.dumps(data)
 
+    @cherrypy.expose
+    def metrics(self):
+        """ Metrics of the runs, the workers and the database in the Prometheus text format
+            (see `twillmanager.metrics`)
+        """
+        cherrypy.response.headers['Content-Type'] = twillmanager.metrics.CONTENT_TYPE
+        return twillmanager.metrics.render(self.worker_set, get_pool(self.config).stats()).encode('utf-8')
+
+    @cherrypy.expose
+    def export(self, format='json'):
+        """ Definitions of all the watches, streamed as JSON (one object per line) or CSV
+            (see `twillmanager.transfer`)
+        """
+        if format not in FORMATS:
+            raise cherrypy.HTTPError(400, "Invalid format: %s" % format)
+        exporter, reader, content_type = FORMATS[format]
+
+        cherrypy.response.headers['Content-Type'] = content_type
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="watches.%s"' % format
+        return exporter(Watch.iterate_all(get_db_connection(self.config), FIELDS))
+
+    export._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def import_watches(self, file=None, format=None):
+        """ Creates or updates watches defined in an uploaded file (JSON or CSV,
+            by default depending on the file name), all or none of them.
+            The imported watches are scheduled (by the manager thread of the worker set)
+            right after that.
+        """
+        if cherrypy.request.method != 'POST':
+            cherrypy.response.headers['Allow'] = 'POST'
+            raise cherrypy.HTTPError(405)
+        if file is None:
+            raise cherrypy.HTTPError(400, "No file uploaded")
+        if not format:
+            format = (file.filename or '').lower().endswith('.csv') and 'csv' or 'json'
+        if format not in FORMATS:
+            raise cherrypy.HTTPError(400, "Invalid format: %s" % format)
+        exporter, reader, content_type = FORMATS[format]
+
+        try:
+            created, updated, errors = import_watches(get_db_connection(self.config), reader(file.file))
+        except ValueError, e:
+            raise cherrypy.HTTPError(400, str(e))
+        self.worker_set.reschedule(created + updated)
+
+        if errors:
+            cherrypy.response.status = 400
+        cherrypy.response.headers['Content-Type'] = "application/json"
+        return simplejson.dumps({'created': len(created), 'updated': len(updated), 'errors': errors})
+
     @cherrypy.expose
     def new(self, **kwargs):
         watch = None
@@ -152,7 +317,7 @@ class WatchController(Controller):
 
     @cherrypy.expose
     def status(self):
-        watch = Watch.load(self.id, get_db_connection(self.config))
+        watch = Watch.load(self.id, get_db_connection(self.config), Watch.LIST_COLUMNS)
         if not watch:
             raise cherrypy.NotFound()
 
@@ -162,9 +327,28 @@ class WatchController(Controller):
         cherrypy.response.headers['Content-Type'] = "application/json"
         return simplejson.dumps(data)
 
+    @cherrypy.expose
+    def history(self):
+        """ Statistics of runs of the watch in the last hour, day and week,
+            computed from aggregates (see `twillmanager.history`)
+        """
+        connection = get_db_connection(self.config)
+        watch = Watch.load(self.id, connection, ['id'])
+        if not watch:
+            raise cherrypy.NotFound()
+
+        now = time.time()
+        data = {'hour': summarize(connection, self.id, now - HOUR, now, MINUTE).dict(),
+                'day': summarize(connection, self.id, now - DAY, now, HOUR).dict(),
+                'week': summarize(connection, self.id, now - 7 * DAY, now, HOUR).dict(),
+                'recent': [run.__dict__ for run in Run.load_recent(self.id, connection, 20)]}
+
+        cherrypy.response.headers['Content-Type'] = "application/json"
+        return simplejson.dumps(data)
+
     @cherrypy.expose
     def restart(self):
-        watch = Watch.load(self.id, get_db_connection(self.config))
+        watch = Watch.load(self.id, get_db_connection(self.config), ['id'])
         if not watch:
             raise cherrypy.NotFound()
         
@@ -179,7 +363,7 @@ class WatchController(Controller):
     @cherrypy.expose
     def check_now(self):
         """ Force a check immediately """
-        watch = Watch.load(self.id, get_db_connection(self.config))
+        watch = Watch.load(self.id, get_db_connection(self.config), ['id'])
         if not watch:
             raise cherrypy.NotFound()
 
@@ -205,7 +389,7 @@ class WatchController(Controller):
                         setattr(watch, k, v)
                     watch.update(connection)
                     connection.commit()
-                    self.worker_set.restart(self.id)
+                    self.worker_set.reload(self.id)
                     raise cherrypy.HTTPRedirect(cherrypy.url('/'), status=303)
             else:
                 errors = []
@@ -220,13 +404,13 @@ class WatchController(Controller):
         connection = get_db_connection(self.config)
 
         try:
-            watch = Watch.load(self.id, connection)
+            watch = Watch.load(self.id, connection, ['name'])
             if not watch:
                 raise cherrypy.NotFound()
 
             if cherrypy.request.method == 'POST':
                 watch.delete(connection)
-                self.worker_set.remove(self.id)
+                self.worker_set.delete(self.id)
                 connection.commit()
                 raise cherrypy.HTTPRedirect(cherrypy.url('/'), status=303)
 
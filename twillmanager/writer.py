@@ -0,0 +1,196 @@
+# encoding: utf-8
+
+""" The single writer of results of watch runs.
+
+    Workers don't write to the database themselves - they put results of runs
+    into a queue read by a `StatusWriter` thread of the manager process, which
+    applies them in grouped transactions. The database is written by one
+    connection only (in WAL mode, so readers don't block it), instead of each
+    worker committing (and syncing the disk) after every run.
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import multiprocessing
+import Queue
+import threading
+import time
+
+from twillmanager.db import create_db_connection
+from twillmanager.history import Run, rollup, MINUTE, DAY
+from twillmanager.log import logger
+from twillmanager.metrics import Histogram, COMMIT_BUCKETS
+
+__all__ = ['StatusWriter', 'apply_results']
+
+def apply_results(connection, results):
+    """ Stores results of watch runs in a single transaction.
+
+        :param results: List of tuples (watch id, status, check time, duration,
+            time of last alert, `twillmanager.history.Run` or None)
+    """
+    c = connection.cursor()
+    # status_since is computed from the previous status
+    c.executemany("UPDATE twills SET status_since = CASE WHEN status = ? THEN status_since ELSE ? END, "
+                  "status=?, time=?, last_alert=?, duration=? WHERE id = ?",
+        [(status, time, status, time, last_alert, duration, id) for id, status, time, duration, last_alert, run in results])
+    c.close()
+    Run.insert_many([result[5] for result in results if result[5] is not None], connection)
+    connection.commit()
+
+class StatusWriter(object):
+    """ Thread applying results of watch runs queued by the workers.
+
+        Results are written in batches: when ``writer.batch_size`` results are
+        waiting, or ``writer.flush_interval`` seconds after the oldest of them
+        was received. Results of a batch that failed to be written are kept and
+        written again after ``writer.flush_interval`` seconds. The writer also
+        periodically rolls up the history of runs (see `twillmanager.history.rollup`).
+    """
+    def __init__(self, config, clock=time.time, on_result=None):
+        """ Create a writer (call `start` to run it)
+
+            :param config: Configuration dict
+            :param clock: Zero-argument callable returning current time (in seconds)
+            :param on_result: Callable invoked by the writer thread with id of the watch
+                and the result (see `apply_results`) once it is stored - or None,
+                as soon as it is told that the run ended without a result (see `abandon`)
+        """
+        self.config = config
+        self.clock = clock
+        self.on_result = on_result
+        self.batch_size = int(config.get('writer.batch_size', 100))
+        self.flush_interval = float(config.get('writer.flush_interval', 0.2))
+        self.rollup_interval = float(config.get('history.rollup_interval', MINUTE))
+        self.queue = multiprocessing.Queue(0)
+        self.connection = None
+        self.thread = None
+
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.results_written = 0
+        self.commit_time = 0.0 # total time spent committing
+        self.last_commit_latency = None
+        self.max_commit_latency = 0.0
+        self.commit_latencies = Histogram(COMMIT_BUCKETS)
+
+    def put(self, result):
+        """ Queue a result (see `apply_results`) to be written. May be called from any process. """
+        self.queue.put(('result', result))
+
+    def abandon(self, id):
+        """ Tell that a run of watch with given id ended without a result. May be called from any process. """
+        self.queue.put(('abandoned', id))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.main)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Writes results queued so far and stops the thread """
+        self.queue.put(('quit', None))
+        self.thread.join()
+
+    def queue_depth(self):
+        """ Approximate number of results waiting in the queue (None if unknown) """
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def stats(self):
+        """ Statistics of the writer as dictionary """
+        with self._lock:
+            return {'queue_depth': self.queue_depth(),
+                    'commits': self.commits,
+                    'results_written': self.results_written,
+                    'mean_commit_latency': self.commits and self.commit_time / self.commits or None,
+                    'last_commit_latency': self.last_commit_latency,
+                    'max_commit_latency': self.max_commit_latency}
+
+    def main(self):
+        """ Thread main function """
+        self.connection = create_db_connection(self.config)
+        pending = []
+        oldest = None
+        next_rollup = self.clock() + self.rollup_interval
+        running = True
+        while running:
+            now = self.clock()
+            if pending:
+                deadline = min(oldest + self.flush_interval, next_rollup)
+            else:
+                deadline = next_rollup
+            try:
+                command, argument = self.queue.get(True, max(deadline - now, 0))
+                if command == 'quit':
+                    running = False
+                elif command == 'result':
+                    if not pending:
+                        oldest = self.clock()
+                    pending.append(argument)
+                elif command == 'abandoned':
+                    self.notify(argument, None)
+                else:
+                    logger.warn("Unknown command to status writer: %s" % command)
+            except Queue.Empty:
+                pass
+
+            now = self.clock()
+            if pending and (not running or len(pending) >= self.batch_size or now - oldest >= self.flush_interval):
+                if self.write(pending):
+                    # the runs end (and the watches may run again) only when
+                    # their results are stored
+                    for result in pending:
+                        self.notify(result[0], result)
+                    pending = []
+                elif running:
+                    oldest = now # written again after the flush interval
+                else:
+                    logger.error("Results of %d runs were not stored" % len(pending))
+            if now >= next_rollup:
+                next_rollup = now + self.rollup_interval
+                self.rollup_history()
+        self.connection.close()
+
+    def notify(self, id, result):
+        if self.on_result is not None:
+            try:
+                self.on_result(id, result)
+            except Exception, e:
+                logger.error("Failed to handle result of watch (id: %s): %s" % (id, e))
+
+    def write(self, results):
+        """ Writes results in one transaction and records how long it took.
+            Returns whether they were written.
+        """
+        start = self.clock()
+        try:
+            apply_results(self.connection, results)
+        except Exception, e:
+            self.connection.rollback()
+            logger.error("Failed to store results of %d runs: %s" % (len(results), e))
+            return False
+        latency = self.clock() - start
+        with self._lock:
+            self.commits += 1
+            self.results_written += len(results)
+            self.commit_time += latency
+            self.last_commit_latency = latency
+            self.max_commit_latency = max(self.max_commit_latency, latency)
+        self.commit_latencies.observe(latency)
+        logger.debug("Stored results of %d runs in %.3fs (queue depth: %s)" % (len(results), latency, self.queue_depth()))
+        return True
+
+    def rollup_history(self):
+        """ Aggregates recent runs and removes old history (see `twillmanager.history.rollup`) """
+        try:
+            rollup(self.connection,
+                   raw_retention=float(self.config.get('history.raw_retention', 2 * DAY)),
+                   minute_retention=float(self.config.get('history.minute_retention', 14 * DAY)),
+                   hour_retention=float(self.config.get('history.hour_retention', 400 * DAY)))
+        except Exception, e:
+            self.connection.rollback()
+            logger.error("Failed to roll up history of runs: %s" % e)